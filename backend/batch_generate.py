@@ -0,0 +1,221 @@
+"""Offline batch generation from a manifest.
+
+Runs the same pipeline as /api/generate (prompt optimization, image
+generation, history write-behind) for every row, N rows at a time.
+
+Run from the backend directory:
+    python batch_generate.py skus.jsonl --concurrency 8
+    python batch_generate.py skus.csv --limit 20
+
+Manifest rows (JSONL objects or CSV columns):
+    prompt (required), ratio (default 1:1), model (default nano_banana_2),
+    scenario (default general), images (list, or "a.jpg;b.jpg" in CSV; paths
+    relative to the manifest), id (optional, stable row key)
+
+Progress is appended to <manifest>.checkpoint.jsonl after every row; a rerun
+skips rows that already succeeded and retries the rest.
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.insert(0, current_dir)
+
+from config import config
+from models import MODEL_REGISTRY
+from services.task_service import task_service
+from services.history_writer import history_writer
+from main import run_generation_task
+
+
+def load_manifest(path: str) -> List[Dict[str, Any]]:
+    rows = []
+    if path.lower().endswith(".csv"):
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                images = row.get("images") or ""
+                row["images"] = [p.strip() for p in images.replace("|", ";").split(";") if p.strip()]
+                rows.append(row)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    raise SystemExit(f"{path}:{line_no}: invalid JSON: {e}")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for idx, row in enumerate(rows):
+        if not (row.get("prompt") or "").strip():
+            raise SystemExit(f"{path}: row {idx + 1} has no prompt")
+        row["ratio"] = row.get("ratio") or "1:1"
+        row["model"] = row.get("model") or "nano_banana_2"
+        row["scenario"] = row.get("scenario") or "general"
+        if row["model"] not in MODEL_REGISTRY:
+            raise SystemExit(f"{path}: row {idx + 1} uses unknown model {row['model']}")
+        images = row.get("images") or []
+        if isinstance(images, str):
+            images = [images]
+        row["images"] = [p if os.path.isabs(p) else os.path.join(base_dir, p) for p in images]
+        missing = [p for p in row["images"] if not os.path.exists(p)]
+        if missing:
+            raise SystemExit(f"{path}: row {idx + 1} references missing images: {', '.join(missing)}")
+        row["key"] = str(row.get("id") or row_key(row))
+    return rows
+
+
+def row_key(row: Dict[str, Any]) -> str:
+    """Stable identity for rows without an id: what would be generated."""
+    raw = json.dumps([row["prompt"], row["ratio"], row["model"], row["scenario"], [os.path.basename(p) for p in row["images"]]], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def load_checkpoint(path: str) -> Dict[str, Dict[str, Any]]:
+    """Latest record per row key."""
+    done = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn last line after a crash
+                done[record["key"]] = record
+    return done
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def run_row(row: Dict[str, Any], api_key: str, api_url: str, session: str) -> Dict[str, Any]:
+    image_bytes_list = []
+    for image_path in row["images"]:
+        with open(image_path, "rb") as f:
+            image_bytes_list.append(f.read())
+
+    task_id = task_service.create_task("batch_generation")
+    started = time.time()
+    # run_generation_task is async only in signature; each worker thread runs its own loop
+    asyncio.run(run_generation_task(
+        task_id, row["prompt"], row["ratio"], row["scenario"], row["model"], api_key, api_url, image_bytes_list, None,
+        session=session
+    ))
+    task = task_service.tasks.pop(task_id, None) or {}
+    result = task.get("result") or {}
+    return {
+        "key": row["key"],
+        "status": task.get("status", "failed"),
+        "history_id": result.get("id"),
+        "url": result.get("url") if (result.get("url") or "").startswith("/static/") else None,
+        "error": task.get("error"),
+        "seconds": round(time.time() - started, 2),
+        "finished_at": int(time.time())
+    }
+
+
+def format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate images for every row of a JSONL/CSV manifest.")
+    parser.add_argument("manifest", help="Path to a .jsonl or .csv manifest")
+    parser.add_argument("--concurrency", type=int, default=config.BATCH_CONCURRENCY, help="Rows generated at the same time")
+    parser.add_argument("--checkpoint", help="Progress file (default: <manifest>.checkpoint.jsonl)")
+    parser.add_argument("--limit", type=int, help="Process at most this many pending rows")
+    parser.add_argument("--api-key", default=None, help="Upstream API key (default: BANANA_API_KEY)")
+    parser.add_argument("--api-url", default=None, help="Upstream API base URL (default: BANANA_API_URL)")
+    args = parser.parse_args()
+
+    rows = load_manifest(args.manifest)
+    checkpoint_path = args.checkpoint or f"{args.manifest}.checkpoint.jsonl"
+    previous = load_checkpoint(checkpoint_path)
+    seen = set()
+    pending = []
+    for row in rows:
+        if row["key"] in seen:
+            continue
+        seen.add(row["key"])
+        if previous.get(row["key"], {}).get("status") != "succeed":
+            pending.append(row)
+    skipped = len(seen) - len(pending)
+    if args.limit:
+        pending = pending[:args.limit]
+
+    print(f"{len(rows)} rows in manifest, {skipped} already done, {len(pending)} to run with concurrency {args.concurrency}")
+    if not pending:
+        return
+
+    # Own journal (locked, so two batch runs cannot share it); leftovers of a crashed run are replayed here
+    history_writer.journal_dir = config.BATCH_JOURNAL_DIR
+    try:
+        history_writer.start()
+    except RuntimeError as e:
+        raise SystemExit(f"{e}: another batch run is still writing history")
+
+    checkpoint = Checkpoint(checkpoint_path)
+    session = f"batch:{os.path.basename(args.manifest)}"
+    started = time.time()
+    succeeded = failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency), thread_name_prefix="batch") as executor:
+        futures = {executor.submit(run_row, row, args.api_key, args.api_url, session): row for row in pending}
+        try:
+            for done_count, future in enumerate(as_completed(futures), 1):
+                row = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = {"key": row["key"], "status": "failed", "error": str(e), "finished_at": int(time.time())}
+                checkpoint.append(record)
+                if record["status"] == "succeed":
+                    succeeded += 1
+                else:
+                    failed += 1
+
+                elapsed = time.time() - started
+                rate = done_count / elapsed if elapsed else 0.0
+                eta = (len(pending) - done_count) / rate if rate else 0.0
+                outcome = record.get("url") or record.get("error") or record["status"]
+                print(
+                    f"[{done_count}/{len(pending)}] {row['key']} {record['status']}: {outcome} | "
+                    f"ok={succeeded} failed={failed} | {rate * 60:.1f} rows/min | ETA {format_eta(eta)}"
+                )
+        except KeyboardInterrupt:
+            print("Interrupted: finishing rows in flight, the rest run on the next invocation")
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            # Files are written behind; make sure everything reported is on disk
+            history_writer.flush(timeout=300)
+
+    elapsed = time.time() - started
+    print(f"Done in {format_eta(elapsed)}: {succeeded} succeeded, {failed} failed. Checkpoint: {checkpoint_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,88 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 class Config:
     BANANA_API_KEY = os.getenv("BANANA_API_KEY")
     BANANA_MODEL_KEY = os.getenv("BANANA_MODEL_KEY", "nano-banana-2")
     BANANA_API_URL = os.getenv("BANANA_API_URL", "https://ai.comfly.chat/v1")
+    # Stage-1 fingerprint extraction: "batch" (one multimodal call) or "parallel" (one call per image + merge)
+    FINGERPRINT_MODE = os.getenv("FINGERPRINT_MODE", "batch")
+    FINGERPRINT_CONCURRENCY = int(os.getenv("FINGERPRINT_CONCURRENCY", "4"))
+    # Speculative fingerprint prefetch (started on image upload, claimed by the later generation)
+    PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+    PREFETCH_MAX_PENDING = int(os.getenv("PREFETCH_MAX_PENDING", "8"))
+    PREFETCH_TTL_SECONDS = int(os.getenv("PREFETCH_TTL_SECONDS", "600"))
+    PREFETCH_CLAIM_WAIT_SECONDS = int(os.getenv("PREFETCH_CLAIM_WAIT_SECONDS", "90"))
+    # Opt-in speculative generation of Director Agent proposals
+    SPECULATION_TOP_K_MAX = int(os.getenv("SPECULATION_TOP_K_MAX", "3"))
+    SPECULATION_PER_CLIENT = int(os.getenv("SPECULATION_PER_CLIENT", "1"))
+    SPECULATION_MAX_GLOBAL = int(os.getenv("SPECULATION_MAX_GLOBAL", "4"))
+    SPECULATION_TTL_SECONDS = int(os.getenv("SPECULATION_TTL_SECONDS", "900"))
+    # Served under /static: history images, blobs and variants (benchmarks point this at a temp dir)
+    STATIC_DIR = os.getenv("STATIC_DIR", os.path.join(PROJECT_ROOT, "static"))
+    # History index (kept outside static/ so it is never served)
+    HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", os.path.join(PROJECT_ROOT, "data", "history.db"))
+    # Write-behind history persistence
+    HISTORY_JOURNAL_DIR = os.getenv("HISTORY_JOURNAL_DIR", os.path.join(PROJECT_ROOT, "data", "history_journal"))
+    HISTORY_WRITE_BATCH_SIZE = int(os.getenv("HISTORY_WRITE_BATCH_SIZE", "16"))
+    HISTORY_WRITE_BATCH_MS = int(os.getenv("HISTORY_WRITE_BATCH_MS", "50"))
+    # Failed writes are retried with backoff this many times, then wait for the journal replay on restart
+    HISTORY_WRITE_RETRIES = int(os.getenv("HISTORY_WRITE_RETRIES", "5"))
+    # History layout: "sharded" (YYYY/MM/DD/<hash>/) or "flat" (legacy single directory)
+    HISTORY_LAYOUT = os.getenv("HISTORY_LAYOUT", "sharded")
+    # Retention policies; 0 disables a policy
+    HISTORY_RETENTION_MAX_AGE_DAYS = int(os.getenv("HISTORY_RETENTION_MAX_AGE_DAYS", "0"))
+    HISTORY_RETENTION_MAX_TOTAL_BYTES = int(os.getenv("HISTORY_RETENTION_MAX_TOTAL_BYTES", "0"))
+    HISTORY_RETENTION_KEEP_PER_SESSION = int(os.getenv("HISTORY_RETENTION_KEEP_PER_SESSION", "0"))
+    HISTORY_RETENTION_ARCHIVE = os.getenv("HISTORY_RETENTION_ARCHIVE", "false").lower() == "true"
+    HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", os.path.join(PROJECT_ROOT, "data", "history_archive"))
+    HISTORY_RETENTION_INTERVAL_SECONDS = int(os.getenv("HISTORY_RETENTION_INTERVAL_SECONDS", "0"))
+    # Thumbnail / preview variants of history images (needs Pillow); formats in preference order
+    HISTORY_VARIANT_FORMATS = [f.strip() for f in os.getenv("HISTORY_VARIANT_FORMATS", "avif,webp,jpeg").split(",") if f.strip()]
+    HISTORY_VARIANTS_EAGER = os.getenv("HISTORY_VARIANTS_EAGER", "true").lower() == "true"
+    # Entries per /api/history/export, selected by ids or by filter (its member list is held in memory)
+    HISTORY_EXPORT_MAX_ENTRIES = int(os.getenv("HISTORY_EXPORT_MAX_ENTRIES", "1000"))
+
+    # Upload limits for /api/chat, /api/generate and /api/fingerprint/prefetch, enforced while the body
+    # streams (413 on the first one crossed); a field is every file or value sent under one name; 0 disables
+    UPLOAD_MAX_FILE_MB = float(os.getenv("UPLOAD_MAX_FILE_MB", "20"))
+    UPLOAD_MAX_FIELD_MB = float(os.getenv("UPLOAD_MAX_FIELD_MB", "60"))
+    UPLOAD_MAX_REQUEST_MB = float(os.getenv("UPLOAD_MAX_REQUEST_MB", "100"))
+    UPLOAD_MAX_FILES = int(os.getenv("UPLOAD_MAX_FILES", "16"))
+    # Process-wide budget for the bytes chats and generations hold in memory (uploads, upstream
+    # payloads, downloaded results); requests wait up to BYTE_BUDGET_WAIT_SECONDS, then get 503; 0 disables
+    BYTE_BUDGET_MB = float(os.getenv("BYTE_BUDGET_MB", "1024"))
+    BYTE_BUDGET_WAIT_SECONDS = float(os.getenv("BYTE_BUDGET_WAIT_SECONDS", "30"))
+    # Process pool for base64, hashing and image resizing; jobs under CPU_POOL_MIN_KB run inline; 0 workers = all inline
+    CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+    CPU_POOL_MIN_KB = float(os.getenv("CPU_POOL_MIN_KB", "256"))
+    # Thread pools per pipeline stage, so a slow upstream only saturates its own stage;
+    # chats beyond BULKHEAD_CHAT_MAX_QUEUE waiting for a thread get 503 (0 = unbounded)
+    BULKHEAD_CHAT_WORKERS = int(os.getenv("BULKHEAD_CHAT_WORKERS", "16"))
+    BULKHEAD_CHAT_MAX_QUEUE = int(os.getenv("BULKHEAD_CHAT_MAX_QUEUE", "32"))
+    BULKHEAD_PROMPT_WORKERS = int(os.getenv("BULKHEAD_PROMPT_WORKERS", "8"))
+    BULKHEAD_IMAGE_WORKERS = int(os.getenv("BULKHEAD_IMAGE_WORKERS", "8"))
+    BULKHEAD_DOWNLOAD_WORKERS = int(os.getenv("BULKHEAD_DOWNLOAD_WORKERS", "8"))
+    BULKHEAD_DISK_WORKERS = int(os.getenv("BULKHEAD_DISK_WORKERS", "4"))
+    # On-demand history variants wait on CPU-pool encodes here, not on the disk stage uploads spool through
+    BULKHEAD_VARIANT_WORKERS = int(os.getenv("BULKHEAD_VARIANT_WORKERS", "4"))
+    # Overall deadline per generation task, counted from submission (the frontend stops polling after
+    # 10 minutes). Upstream attempts get at most the time left; prompt optimization keeps
+    # DEADLINE_IMAGE_RESERVE_SECONDS for the image and is skipped if less than DEADLINE_MIN_PROMPT_SECONDS remain for it
+    TASK_DEADLINE_SECONDS = float(os.getenv("TASK_DEADLINE_SECONDS", "590"))
+    DEADLINE_IMAGE_RESERVE_SECONDS = float(os.getenv("DEADLINE_IMAGE_RESERVE_SECONDS", "180"))
+    DEADLINE_MIN_PROMPT_SECONDS = float(os.getenv("DEADLINE_MIN_PROMPT_SECONDS", "30"))
+    # Running generation tasks whose client stopped polling GET /api/tasks/{id} this long ago are cancelled.
+    # The frontend polls every 2 seconds, but browsers throttle timers in hidden tabs to about once a
+    # minute, so this leaves room for a few missed polls; a closed tab is cancelled at once by the
+    # pagehide DELETE. Tasks never polled are left alone; 0 disables
+    TASK_ABANDON_SECONDS = float(os.getenv("TASK_ABANDON_SECONDS", "300"))
+
+    # Offline batch generation (batch_generate.py)
+    BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+    # The server locks HISTORY_JOURNAL_DIR, so batch runs journal into their own directory
+    BATCH_JOURNAL_DIR = os.getenv("BATCH_JOURNAL_DIR", os.path.join(PROJECT_ROOT, "data", "batch_journal"))
 
 config = Config()
@@ -0,0 +1,218 @@
+"""Maintenance commands for the generation history store.
+
+Run from the backend directory:
+    python history_admin.py backfill
+    python history_admin.py reindex-search
+    python history_admin.py migrate-blobs [--dry-run]
+    python history_admin.py gc-blobs [--grace-seconds N] [--dry-run]
+    python history_admin.py reshard [--dry-run]
+    python history_admin.py retention [--max-age-days N] [--max-total-bytes N] [--keep-per-session N] [--archive] [--dry-run]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.insert(0, current_dir)
+
+from services.history_service import history_service, entry_stem
+from services.blob_store import blob_store
+from services.retention_service import retention_service
+
+
+def cmd_backfill(args):
+    indexed = history_service.backfill()
+    print(f"Indexed {indexed} history entries into {history_service.db_path}")
+
+
+def cmd_reindex_search(args):
+    indexed = history_service.rebuild_search_index()
+    print(f"Rebuilt full-text index for {indexed} history entries")
+
+
+def _write_json_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _iter_entries(history_dir):
+    """(directory, stem) of every {timestamp}.json, flat or sharded."""
+    for dirpath, dirnames, filenames in os.walk(history_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            stem, ext = os.path.splitext(name)
+            if ext == ".json" and stem.isdigit():
+                yield dirpath, stem
+
+
+def _legacy_originals(directory, stem, metadata):
+    """Pre blob-store {timestamp}_orig_{idx}.jpg files of an entry that still exist."""
+    if "original_blobs" in metadata:
+        return []
+    paths = [
+        os.path.join(directory, f"{stem}_orig_{idx}.jpg")
+        for idx in range(int(metadata.get("original_images_count") or 0))
+    ]
+    return [p for p in paths if os.path.exists(p)]
+
+
+def cmd_migrate_blobs(args):
+    """Move legacy {timestamp}_orig_{idx}.jpg files into the blob store (flat or resharded entries)."""
+    history_dir = history_service.history_dir
+    migrated_entries = 0
+    legacy_bytes = 0
+    for directory, stem in _iter_entries(history_dir):
+        meta_path = os.path.join(directory, f"{stem}.json")
+        with open(meta_path, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        legacy_paths = _legacy_originals(directory, stem, metadata)
+        if not legacy_paths:
+            continue
+        legacy_bytes += sum(os.path.getsize(p) for p in legacy_paths)
+        migrated_entries += 1
+        if args.dry_run:
+            continue
+
+        original_blobs = []
+        original_images = []
+        for slot, path in enumerate(legacy_paths):
+            with open(path, "rb") as f:
+                # Keyed by entry and slot: a rerun after a crash does not count the references twice
+                blob = blob_store.put(f.read(), owner=int(stem), slot=slot)
+            original_blobs.append(blob["hash"])
+            original_images.append(blob["url"])
+
+        rel_stem = os.path.relpath(os.path.join(directory, stem), history_dir).replace(os.sep, "/")
+        metadata["original_blobs"] = original_blobs
+        metadata["original_images"] = original_images
+        metadata.setdefault("timestamp", int(stem))
+        metadata.setdefault("path", rel_stem)
+        _write_json_atomic(meta_path, metadata)
+        image_url = f"/static/history/{rel_stem}.png" if os.path.exists(os.path.join(directory, f"{stem}.png")) else ""
+        history_service.record(metadata, image_url, original_images)
+        for path in legacy_paths:
+            os.remove(path)
+
+    stats = blob_store.stats()
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{action} {migrated_entries} entries ({legacy_bytes} bytes of legacy originals)")
+    print(f"Blob store now holds {stats['blobs']} blobs, {stats['bytes']} bytes, {stats['references']} references")
+
+
+def cmd_gc_blobs(args):
+    """Recount references from the history index, then delete unreferenced blobs."""
+    counts = {}
+    for blob_hash in history_service.iter_blob_references():
+        counts[blob_hash] = counts.get(blob_hash, 0) + 1
+    if args.dry_run:
+        result = blob_store.gc(grace_seconds=args.grace_seconds, dry_run=True, referenced=set(counts))
+    else:
+        blob_store.set_refcounts(counts)
+        result = blob_store.gc(grace_seconds=args.grace_seconds)
+    action = "Would remove" if args.dry_run else "Removed"
+    print(f"{action} {result['removed']} blobs, {result['bytes_freed']} bytes")
+
+
+def cmd_reshard(args):
+    """Move flat static/history/{timestamp}.* entries (with any legacy originals) into the sharded layout."""
+    history_dir = history_service.history_dir
+    moved = 0
+    for name in sorted(os.listdir(history_dir)):
+        stem, ext = os.path.splitext(name)
+        if ext != ".json" or not stem.isdigit():
+            continue
+        new_stem = entry_stem(int(stem), layout="sharded")
+        moved += 1
+        if args.dry_run:
+            continue
+
+        meta_path = os.path.join(history_dir, name)
+        with open(meta_path, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        files = history_service.files_for(int(stem), new_stem)
+        os.makedirs(os.path.dirname(files["metadata"]), exist_ok=True)
+        image_url = ""
+        old_image = os.path.join(history_dir, f"{stem}.png")
+        if os.path.exists(old_image):
+            os.replace(old_image, files["image"])
+            image_url = f"/static/history/{new_stem}.png"
+        # Not yet migrated to the blob store: the originals move with the entry, where migrate-blobs still finds them
+        original_images = None
+        legacy_paths = _legacy_originals(history_dir, stem, metadata)
+        if legacy_paths:
+            new_dir = os.path.dirname(files["metadata"])
+            original_images = []
+            for path in legacy_paths:
+                os.replace(path, os.path.join(new_dir, os.path.basename(path)))
+                original_images.append(f"/static/history/{os.path.dirname(new_stem)}/{os.path.basename(path)}")
+        metadata["path"] = new_stem
+        # Metadata moves last: a crash mid-way leaves a flat entry that reshard picks up again
+        _write_json_atomic(files["metadata"], metadata)
+        os.remove(meta_path)
+        history_service.update_path(int(stem), new_stem, image_url, metadata, original_images=original_images)
+
+    action = "Would move" if args.dry_run else "Moved"
+    print(f"{action} {moved} entries into the sharded layout")
+
+
+def cmd_retention(args):
+    report = retention_service.run(
+        dry_run=args.dry_run,
+        archive=args.archive or None,
+        max_age_days=args.max_age_days,
+        max_total_bytes=args.max_total_bytes,
+        keep_per_session=args.keep_per_session
+    )
+    for candidate in report["candidates"]:
+        print(f"{candidate['reason']:<16} {candidate['path']:<40} {candidate['size_bytes']:>10}  session={candidate['session'] or '-'}")
+    action = "Would remove" if args.dry_run else "Removed"
+    print(
+        f"{action} {len(report['candidates'])} of {report['entries']} entries, "
+        f"{report['bytes_freed']} of {report['total_bytes']} bytes ({report['protected']} protected per session)"
+    )
+    if report["archive"]:
+        print(f"Archived to {report['archive']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generation history maintenance.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backfill = subparsers.add_parser("backfill", help="Index existing static/history metadata files (including full-text search)")
+    backfill.set_defaults(func=cmd_backfill)
+
+    reindex = subparsers.add_parser("reindex-search", help="Rebuild the prompt full-text index from the history index")
+    reindex.set_defaults(func=cmd_reindex_search)
+
+    migrate = subparsers.add_parser("migrate-blobs", help="Move legacy *_orig_*.jpg originals into the blob store")
+    migrate.add_argument("--dry-run", action="store_true", help="Only report what would be migrated")
+    migrate.set_defaults(func=cmd_migrate_blobs)
+
+    gc = subparsers.add_parser("gc-blobs", help="Delete blobs no history entry references")
+    gc.add_argument("--grace-seconds", type=int, default=3600, help="Keep released blobs at least this long")
+    gc.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+    gc.set_defaults(func=cmd_gc_blobs)
+
+    reshard = subparsers.add_parser("reshard", help="Move flat history files into YYYY/MM/DD/<hash>/ shards")
+    reshard.add_argument("--dry-run", action="store_true", help="Only report what would be moved")
+    reshard.set_defaults(func=cmd_reshard)
+
+    retention = subparsers.add_parser("retention", help="Evict history entries by age, total size and per-session quota")
+    retention.add_argument("--max-age-days", type=int, default=None, help="Remove entries older than this (0 disables)")
+    retention.add_argument("--max-total-bytes", type=int, default=None, help="Evict least recently used entries above this size (0 disables)")
+    retention.add_argument("--keep-per-session", type=int, default=None, help="Never evict the newest N entries of a session")
+    retention.add_argument("--archive", action="store_true", help="Write evicted entries to a .tar.gz before removing them")
+    retention.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+    retention.set_defaults(func=cmd_retention)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
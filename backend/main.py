@@ -1,10 +1,8 @@
 import os
 import sys
 import json
-import base64
 import time
-import hashlib
-import requests
+import asyncio
 
 # Add parent directory to sys.path to support imports in production (Zeabur)
 # This allows both "from config import" and "from backend.config import" to work
@@ -16,16 +14,32 @@ if current_dir not in sys.path:
     sys.path.insert(0, current_dir)
 
 from typing import Optional
-from fastapi import FastAPI, UploadFile, Form, File, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, Form, File, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
+from static_files import CachedStaticFiles, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, is_hashed_asset, is_write_once_static
+from uploads import UploadLimitMiddleware, read_uploads, MB
 
 # Now imports should work regardless of how the script is run
 from services.banana_service import banana_service
-from services.prompt_service import prompt_service
+from services.prompt_service import prompt_service, parse_optimized_prompt
 from services.task_service import task_service
 from services.chat_service import chat_service
+from services.fingerprint_cache import fingerprint_cache, hash_images_async, fingerprint_from_dna, extract_dna_from_chat_response
+from services.prefetch_service import fingerprint_prefetcher, prefetch_owner
+from services.speculation_service import speculation_service, extract_proposals, proposal_generation_inputs, reply_analysis, reply_visual_dna, build_final_prompt
+from services.history_service import history_service
+from services.history_writer import history_writer
+from services.retention_service import retention_service
+from services.export_service import ExportTooLarge, build_history_export
+from services.variant_service import variant_service, VARIANT_SIZES, FORMAT_MEDIA_TYPES
+from services.byte_budget import byte_budget, chat_cost, generation_cost, Lease
+from services.cpu_pool import cpu_pool, b64encode, b64decode
+from services.deadline import Deadline, DeadlineExceeded, deadline_scope
+from services.cancellation import TaskCancelled, abortable_request, cancel_scope
+from services.bulkhead import BulkheadFull, bulkhead_stats, chat_bulkhead, prompt_bulkhead, image_bulkhead, download_bulkhead, disk_bulkhead, variant_bulkhead
+from config import config
+from models import MODEL_REGISTRY
 
 def debug_log(message: str):
     """Helper to log debug info to a file since terminal output might be truncated or hard to follow."""
@@ -39,6 +53,16 @@ def debug_log(message: str):
 
 app = FastAPI()
 
+# Oversized uploads are refused while they stream in; added before CORS so the 413 still carries CORS headers
+app.add_middleware(
+    UploadLimitMiddleware,
+    paths=("/api/chat", "/api/generate", "/api/fingerprint/prefetch"),
+    max_file=int(config.UPLOAD_MAX_FILE_MB * MB),
+    max_field=int(config.UPLOAD_MAX_FIELD_MB * MB),
+    max_request=int(config.UPLOAD_MAX_REQUEST_MB * MB),
+    max_files=config.UPLOAD_MAX_FILES
+)
+
 # Allow CORS for frontend
 app.add_middleware(
     CORSMiddleware,
@@ -48,10 +72,102 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def note_history_access(path: str):
+    # The index write shares a lock with the writer's batch commits: never on the event loop
+    if history_service.touch(path):
+        disk_bulkhead.submit(history_service.flush_access)
+
+@app.middleware("http")
+async def serve_pending_history(request: Request, call_next):
+    # History files still in the write-behind queue are served straight from memory
+    if request.method == "GET" and request.url.path.startswith("/static/"):
+        if request.url.path.startswith("/static/history/"):
+            note_history_access(request.url.path)
+        pending = history_writer.get_pending(request.url.path)
+        if pending:
+            data, media_type = pending
+            # data may be an mmap of a spooled upload; Response takes bytes or memoryview
+            data = memoryview(data)
+            # Same bytes as the file about to land, but revalidate so the on-disk ETag takes over
+            return Response(content=data, media_type=media_type, headers={"Cache-Control": REVALIDATE_CACHE_CONTROL})
+    return await call_next(request)
+
+@app.middleware("http")
+async def serve_history_variants(request: Request, call_next):
+    # /static/history/<path>.png?size=thumb|preview|full&format=avif|webp|jpeg|auto
+    # Without ?format the Accept header picks the most compact format the browser takes
+    path = request.url.path
+    params = request.query_params
+    if request.method != "GET" or not path.startswith("/static/history/") or not path.endswith(".png") or not ("size" in params or "format" in params):
+        return await call_next(request)
+    size = params.get("size", "full")
+    if size not in VARIANT_SIZES:
+        return JSONResponse(status_code=400, content={"detail": f"size must be one of {', '.join(VARIANT_SIZES)}"})
+    stem = path[len("/static/history/"):-len(".png")]
+    fmt = variant_service.negotiate(request.headers.get("accept", ""), params.get("format"))
+    if not fmt or ".." in stem.split("/") or history_writer.get_pending(path):
+        # No encoder available (or still in the write-behind queue): the original is served
+        return await call_next(request)
+    source_path = history_service.files_for(0, stem)["image"]
+    # Its own stage: a thread waiting on an encode must not hold up upload spooling on the disk stage
+    variant_path = await variant_bulkhead.run(variant_service.get_or_create, stem, source_path, size, fmt)
+    if not variant_path:
+        return await call_next(request)
+    note_history_access(path)
+    return FileResponse(variant_path, media_type=FORMAT_MEDIA_TYPES[fmt], headers={"Vary": "Accept", "Cache-Control": IMMUTABLE_CACHE_CONTROL})
+
+@app.on_event("startup")
+async def start_cpu_pool():
+    # Spawn the workers now rather than on the first request that needs them
+    cpu_pool.start()
+
+@app.on_event("startup")
+async def start_history_writer():
+    # Replays journal entries left by a crash before accepting new writes
+    history_writer.start()
+
+@app.on_event("shutdown")
+async def flush_history_writer():
+    history_writer.flush(timeout=30)
+    history_service.flush_access()
+
+@app.on_event("shutdown")
+async def stop_cpu_pool():
+    cpu_pool.shutdown()
+
+@app.on_event("startup")
+async def start_retention():
+    # Periodic retention sweep; disabled unless HISTORY_RETENTION_INTERVAL_SECONDS > 0
+    retention_service.start()
+
+@app.on_event("startup")
+async def start_abandon_watch():
+    # Cancels generations whose client stopped polling; disabled when TASK_ABANDON_SECONDS is 0
+    task_service.start_abandon_watch()
+
+@app.on_event("startup")
+async def backfill_history_index():
+    # First run with an empty index: index whatever static/history already holds
+    if history_service.count() == 0:
+        import threading
+        threading.Thread(target=history_service.backfill, daemon=True).start()
+
 @app.get("/api/health")
 async def health_check():
     return {"status": "ok", "timestamp": time.time()}
 
+@app.get("/api/metrics")
+async def metrics():
+    return {"byte_budget": byte_budget.snapshot(), "cpu_pool": cpu_pool.stats(), "bulkheads": bulkhead_stats()}
+
+async def admit(nbytes: int, label: str) -> Lease:
+    """Byte budget lease for a request; 503 if none frees up within BYTE_BUDGET_WAIT_SECONDS."""
+    lease = await byte_budget.acquire_async(nbytes, config.BYTE_BUDGET_WAIT_SECONDS, label)
+    if lease is None:
+        retry_after = str(max(1, round(config.BYTE_BUDGET_WAIT_SECONDS)))
+        raise HTTPException(status_code=503, detail="服务器繁忙，请稍后重试。", headers={"Retry-After": retry_after})
+    return lease
+
 @app.get("/")
 async def root():
     return {"message": "AI Image Gen Backend API is running"}
@@ -59,38 +175,183 @@ async def root():
 # Serve static files
 dist_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "dist")
 frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend")
-static_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static")
+static_path = config.STATIC_DIR
 
 # Ensure static directory exists
 os.makedirs(static_path, exist_ok=True)
 os.makedirs(os.path.join(static_path, "history"), exist_ok=True)
 
 # Mount static folder for history and other assets
-app.mount("/static", StaticFiles(directory=static_path), name="static")
+# Blobs, history images and variants never change once written, so browsers may cache them forever
+app.mount("/static", CachedStaticFiles(directory=static_path, immutable=is_write_once_static), name="static")
 
 if os.path.exists(dist_path):
-    app.mount("/assets", StaticFiles(directory=os.path.join(dist_path, "assets")), name="assets")
+    app.mount("/assets", CachedStaticFiles(directory=os.path.join(dist_path, "assets"), immutable=is_hashed_asset, compress=True), name="assets")
     
     @app.get("/")
     async def read_root():
-        return FileResponse(os.path.join(dist_path, "index.html"))
+        # index.html names the hashed bundles, so it must always be revalidated
+        return FileResponse(os.path.join(dist_path, "index.html"), headers={"Cache-Control": REVALIDATE_CACHE_CONTROL})
 else:
     # Fallback for local development
-    app.mount("/frontend", StaticFiles(directory=frontend_path), name="frontend")
+    app.mount("/frontend", CachedStaticFiles(directory=frontend_path, compress=True), name="frontend")
     
     @app.get("/")
     async def read_root():
-        return FileResponse(os.path.join(frontend_path, "index.html"))
+        return FileResponse(os.path.join(frontend_path, "index.html"), headers={"Cache-Control": REVALIDATE_CACHE_CONTROL})
 
 @app.get("/api/tasks/{task_id}")
 async def get_task_status(task_id: str):
     task = task_service.get_task(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
+    task_service.touch(task_id)
     return task
 
+@app.delete("/api/tasks/{task_id}")
+async def cancel_task(task_id: str):
+    # Aborts the task's in-flight upstream request and frees its stage thread and byte budget at once
+    if not task_service.cancel_task(task_id):
+        raise HTTPException(status_code=404, detail="Task not found or already finished")
+    return {"task_id": task_id, "status": "cancelled"}
+
+@app.post("/api/fingerprint/prefetch")
+async def prefetch_fingerprint(
+    request: Request,
+    api_key: Optional[str] = Form(None),
+    api_url: Optional[str] = Form(None),
+    client_id: Optional[str] = Form(None),
+    image: Optional[list[UploadFile]] = File(None)
+):
+    """Start stage-1 fingerprint extraction as soon as product images are attached.
+
+    Only a later /api/generate with the same client_id (or client address) and api_key claims it."""
+    image_bytes_list = await read_uploads(image)
+    owner = prefetch_owner(api_key, client_id or (request.client.host if request.client else None))
+    # Hashing large uploads is CPU work: keep it off the event loop
+    image_hashes = await hash_images_async(image_bytes_list)
+    return fingerprint_prefetcher.submit(image_bytes_list, image_hashes, owner, api_key, api_url)
+
+@app.get("/api/fingerprint/prefetch/{prefetch_id}")
+async def get_prefetch_status(prefetch_id: str):
+    job = fingerprint_prefetcher.get(prefetch_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Prefetch not found")
+    return job
+
+@app.delete("/api/fingerprint/prefetch/{prefetch_id}")
+async def cancel_prefetch(prefetch_id: str):
+    if not fingerprint_prefetcher.cancel(prefetch_id):
+        raise HTTPException(status_code=404, detail="Prefetch not found")
+    return {"prefetch_id": prefetch_id, "status": "cancelled"}
+
+@app.get("/api/history")
+async def list_history(
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    model: Optional[str] = None,
+    scenario: Optional[str] = None,
+    ratio: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None
+):
+    try:
+        # SQLite under the index lock the write-behind commits also take: off the event loop
+        return await disk_bulkhead.run(
+            history_service.list, cursor=cursor, limit=limit, model=model, scenario=scenario, ratio=ratio, date_from=date_from, date_to=date_to
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid history filter: {str(e)}")
+
+@app.get("/api/history/search")
+async def search_history(
+    q: str,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    model: Optional[str] = None,
+    scenario: Optional[str] = None,
+    ratio: Optional[str] = None
+):
+    try:
+        # FTS5 ranking under the shared index lock: off the event loop like /api/history
+        return await disk_bulkhead.run(history_service.search, q, cursor=cursor, limit=limit, model=model, scenario=scenario, ratio=ratio)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search cursor: {str(e)}")
+
+@app.get("/api/history/export")
+async def export_history(
+    request: Request,
+    ids: Optional[str] = None,
+    model: Optional[str] = None,
+    scenario: Optional[str] = None,
+    ratio: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None
+):
+    """ZIP of the selected entries (images, originals, metadata), streamed as it is built.
+
+    Same selection -> same bytes, so an interrupted download resumes with Range/If-Range.
+    """
+    try:
+        id_list = [int(i) for i in ids.split(",") if i.strip()] if ids else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of history ids")
+    max_entries = config.HISTORY_EXPORT_MAX_ENTRIES
+    if id_list and len(id_list) > max_entries:
+        raise HTTPException(status_code=400, detail=f"At most {max_entries} ids per export; split the selection")
+    try:
+        export = await disk_bulkhead.run(
+            build_history_export, ids=id_list, max_entries=max_entries,
+            model=model, scenario=scenario, ratio=ratio, date_from=date_from, date_to=date_to
+        )
+    except ExportTooLarge as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid history filter: {str(e)}")
+    if not export.members:
+        raise HTTPException(status_code=404, detail="No history entries match the selection")
+
+    etag = f'"{export.etag}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'attachment; filename="history-export-{export.etag[:8]}.zip"',
+        "Cache-Control": "no-cache"
+    }
+    start, end = 0, export.total_size - 1
+    status_code = 200
+    range_header = request.headers.get("range", "")
+    if_range = request.headers.get("if-range")
+    # Single byte range only; a changed selection (If-Range mismatch) restarts from zero
+    if range_header.startswith("bytes=") and "," not in range_header and (if_range is None or if_range == etag):
+        first, _, last = range_header[len("bytes="):].strip().partition("-")
+        try:
+            if first:
+                start, end = int(first), (int(last) if last else export.total_size - 1)
+            else:
+                start = max(export.total_size - int(last), 0)
+        except ValueError:
+            start, end = 0, export.total_size - 1
+        else:
+            if start >= export.total_size or start > end:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{export.total_size}"})
+            end = min(end, export.total_size - 1)
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{export.total_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    # Reads the files on the disk stage rather than AnyIO's default thread pool
+    return StreamingResponse(disk_bulkhead.iterate(export.iter_bytes(start, end)), status_code=status_code, media_type="application/zip", headers=headers)
+
+@app.delete("/api/speculations/{task_id}")
+async def cancel_speculation(task_id: str):
+    if not speculation_service.cancel(task_id):
+        raise HTTPException(status_code=404, detail="Speculative task not found or already confirmed")
+    return {"task_id": task_id, "status": "cancelled"}
+
 @app.post("/api/chat")
 async def chat(
+    request: Request,
+    background_tasks: BackgroundTasks,
     messages: str = Form(...),
     visual_dna: Optional[str] = Form(None),
     product_identity: Optional[str] = Form(None),
@@ -102,10 +363,14 @@ async def chat(
     thought_signature: Optional[str] = Form(None),
     thinking_level: Optional[str] = Form(None),
     grounding: Optional[str] = Form(None),
+    speculate: Optional[str] = Form(None),
+    speculate_top_k: Optional[int] = Form(None),
+    client_id: Optional[str] = Form(None),
     image: Optional[list[UploadFile]] = File(None),
     track_a: Optional[list[UploadFile]] = File(None),
     track_b: Optional[list[UploadFile]] = File(None)
 ):
+    budget_lease = None
     try:
         print(f">>> API CALL: /api/chat | Model: {model} | Grounding: {grounding}")
         # Convert grounding string to boolean
@@ -120,26 +385,11 @@ async def chat(
         else:
             messages_list = messages
             
-        image_bytes_list = []
-        if image:
-            for img in image:
-                content = await img.read()
-                if content:
-                    image_bytes_list.append(content)
-
-        track_a_bytes = []
-        if track_a:
-            for img in track_a:
-                content = await img.read()
-                if content:
-                    track_a_bytes.append(content)
-
-        track_b_bytes = []
-        if track_b:
-            for img in track_b:
-                content = await img.read()
-                if content:
-                    track_b_bytes.append(content)
+        # Spooled uploads: bytes when small, read-only mmaps of the temp files otherwise
+        image_bytes_list = await read_uploads(image)
+        track_a_bytes = await read_uploads(track_a)
+        track_b_bytes = await read_uploads(track_b)
+        budget_lease = await admit(chat_cost(image_bytes_list + track_a_bytes + track_b_bytes, reference_images), "chat")
 
         # Use chat_service.chat but ensure we're using the new DIRECTOR_AGENT_PROMPT internally
         # Note: chat_service needs to be aware of the 'mode' or we can inject the system prompt here
@@ -147,26 +397,27 @@ async def chat(
         
         print(f"DEBUG: Calling chat_service.chat with {len(messages_list)} messages...")
         
-        # Use run_in_threadpool to avoid blocking the async event loop with synchronous requests
-        from fastapi.concurrency import run_in_threadpool
-        
-        chat_result = await run_in_threadpool(
-            chat_service.chat,
-            messages=messages_list, 
-            visual_dna=visual_dna, 
-            product_identity=product_identity, 
-            reference_images=reference_images, 
-            api_key=api_key, 
-            api_url=api_url, 
-            model=model, 
-            images=image_bytes_list, 
-            image_model=image_model,
-            thought_signature=thought_signature,
-            thinking_level=thinking_level,
-            grounding=is_grounding,
-            track_a_images=track_a_bytes,
-            track_b_images=track_b_bytes
-        )
+        # The chat stage's own threads: slow chats cannot starve other work
+        try:
+            chat_result = await chat_bulkhead.run(
+                chat_service.chat,
+                messages=messages_list, 
+                visual_dna=visual_dna, 
+                product_identity=product_identity, 
+                reference_images=reference_images, 
+                api_key=api_key, 
+                api_url=api_url, 
+                model=model, 
+                images=image_bytes_list, 
+                image_model=image_model,
+                thought_signature=thought_signature,
+                thinking_level=thinking_level,
+                grounding=is_grounding,
+                track_a_images=track_a_bytes,
+                track_b_images=track_b_bytes
+            )
+        except BulkheadFull:
+            raise HTTPException(status_code=503, detail="服务器繁忙，请稍后重试。", headers={"Retry-After": "5"})
         print("DEBUG: chat_service.chat returned successfully")
         
         response_text = chat_result.get("content", "")
@@ -176,11 +427,60 @@ async def chat(
         if response_text.startswith("抱歉，聊天服务出现错误：401"):
             raise HTTPException(status_code=401, detail="API Key 无效或未配置，请在设置中检查。")
             
+        # Remember the Visual DNA against the images it was derived from,
+        # so /api/generate can skip fingerprint extraction for the same product
+        fingerprint_id = None
+        chat_image_hashes = await hash_images_async(image_bytes_list + track_a_bytes + track_b_bytes)
+        if chat_image_hashes:
+            dna_fingerprint = extract_dna_from_chat_response(response_text)
+            fingerprint_id = fingerprint_cache.put(dna_fingerprint, chat_image_hashes, source="chat")
+
+        # Opt-in: start generating the top proposal(s) before the user confirms.
+        # Only for an explicit client_id: clients behind one NAT or proxy share an address
+        speculative_tasks = []
+        speculative_runs = []
+        if speculate and speculate.lower() == "true" and client_id:
+            client_key = client_id
+            # A new chat turn supersedes this client's unconfirmed speculations
+            speculation_service.cancel_client(client_key)
+            spec_model = image_model if image_model in MODEL_REGISTRY else "nano_banana_2"
+            top_k = max(1, min(speculate_top_k or 1, config.SPECULATION_TOP_K_MAX))
+            # Generate exactly what the confirm will send: the card prompt with its copy and brand spec blocks
+            analysis = reply_analysis(response_text)
+            spec_dna = reply_visual_dna(response_text, analysis, visual_dna)
+            for idx, proposal in enumerate(extract_proposals(response_text)[:top_k]):
+                spec_images, spec_identity_ref, spec_logic_ref = proposal_generation_inputs(proposal, image_bytes_list, track_a_bytes, track_b_bytes)
+                spec_prompt = build_final_prompt(proposal, spec_dna)
+                spec_thinking_level = proposal.get("thinking_level") or analysis.get("thinking_level") or "medium"
+                key = speculation_service.make_key(spec_prompt, proposal["ratio"], spec_model, await hash_images_async(spec_images))
+                # Speculation is optional: only when the byte budget has room right now
+                spec_lease = byte_budget.try_acquire(generation_cost(spec_images, spec_model, proposal["ratio"]), "speculation")
+                if not spec_lease:
+                    break
+                spec_task_id = speculation_service.reserve(client_key, key)
+                if not spec_task_id:
+                    spec_lease.release()
+                    break
+                # Proposal prompts are complete, so the speculative run skips optimization like a confirm does
+                speculative_runs.append((
+                    (spec_task_id, spec_prompt, proposal["ratio"], "free_mode", spec_model, api_key, api_url, spec_images, None,
+                     new_thought_signature, spec_thinking_level, spec_identity_ref, spec_logic_ref),
+                    {"session": client_key, "budget_lease": spec_lease}
+                ))
+                speculative_tasks.append({"task_id": spec_task_id, "proposal_index": idx})
+            if speculative_runs:
+                # One background task so the top-K proposals generate side by side, not one after another
+                background_tasks.add_task(run_speculations, speculative_runs)
+                print(f"DEBUG: Started {len(speculative_tasks)} speculative generation(s) for client {client_key}")
+
         print(f"DEBUG: Returning response (len={len(response_text)})")
         # Return response text and thought signature
         return {
             "response": response_text,
-            "thought_signature": new_thought_signature
+            "thought_signature": new_thought_signature,
+            "fingerprint_id": fingerprint_id,
+            "image_hashes": chat_image_hashes if fingerprint_id else [],
+            "speculative_tasks": speculative_tasks
         }
     except HTTPException as he:
         print(f"ERROR: HTTPException in /api/chat: {he.detail}")
@@ -191,9 +491,13 @@ async def chat(
         traceback.print_exc()
         debug_log(f"Unhandled error in /api/chat: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if budget_lease:
+            budget_lease.release()
 
 @app.post("/api/generate")
 async def generate(
+    request: Request,
     background_tasks: BackgroundTasks,
     prompt: str = Form(...),
     ratio: str = Form(...),
@@ -205,30 +509,87 @@ async def generate(
     thinking_level: Optional[str] = Form(None),
     identity_ref: Optional[int] = Form(None),
     logic_ref: Optional[int] = Form(None),
+    fingerprint_id: Optional[str] = Form(None),
+    fingerprint: Optional[str] = Form(None),
+    visual_dna: Optional[str] = Form(None),
+    product_identity: Optional[str] = Form(None),
+    fingerprint_image_hashes: Optional[str] = Form(None),
+    prompt_variants: str = Form("auto"),
+    client_id: Optional[str] = Form(None),
     image: Optional[list[UploadFile]] = File(None),
     mask: Optional[UploadFile] = File(None)
 ):
-    task_id = task_service.create_task("image_generation")
-    
     # Read files immediately before background task
-    image_bytes_list = []
-    if image:
-        for img in image:
-            content = await img.read()
-            if content:
-                image_bytes_list.append(content)
-    
-    mask_bytes = await mask.read() if mask else None
+    # Spooled uploads: bytes when small, read-only mmaps of the temp files otherwise
+    image_bytes_list = await read_uploads(image)
+    mask_buffers = await read_uploads([mask] if mask else None)
+    mask_bytes = mask_buffers[0] if mask_buffers else None
+
+    image_hashes = await hash_images_async(image_bytes_list)
+
+    # Reuse a previously computed fingerprint (by reference or inline) when it
+    # was derived from the same images; otherwise stage 1 runs as usual
+    precomputed_fingerprint = None
+    if image_bytes_list and (fingerprint_id or fingerprint or visual_dna or product_identity):
+        inline_fingerprint = None
+        inline_hashes = None
+        try:
+            if fingerprint:
+                inline_fingerprint = json.loads(fingerprint)
+            elif visual_dna or product_identity:
+                inline_fingerprint = fingerprint_from_dna(visual_dna, product_identity)
+            if fingerprint_image_hashes:
+                inline_hashes = json.loads(fingerprint_image_hashes)
+        except json.JSONDecodeError as je:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON in fingerprint fields: {str(je)}")
+        if inline_fingerprint is not None and not isinstance(inline_fingerprint, dict):
+            raise HTTPException(status_code=400, detail="fingerprint must be a JSON object")
+        if inline_hashes is not None and not isinstance(inline_hashes, list):
+            raise HTTPException(status_code=400, detail="fingerprint_image_hashes must be a JSON list")
+
+        precomputed_fingerprint = fingerprint_cache.resolve(
+            image_hashes,
+            fingerprint_id=fingerprint_id,
+            inline_fingerprint=inline_fingerprint,
+            inline_hashes=inline_hashes
+        )
+        if not precomputed_fingerprint:
+            debug_log("Supplied fingerprint does not match uploaded images, extracting again")
+
+    # "auto" asks the prompt engine only for the variant this model consumes; "dual" keeps both
+    if prompt_variants not in ("auto", "dual"):
+        raise HTTPException(status_code=400, detail="prompt_variants must be 'auto' or 'dual'")
+
+    # Confirming a proposal that is already generating speculatively: attach to that task
+    if not mask_bytes and client_id:
+        speculation_key = speculation_service.make_key(prompt, ratio, model, image_hashes)
+        speculative_task_id = speculation_service.attach(client_id, speculation_key)
+        if speculative_task_id:
+            task = task_service.get_task(speculative_task_id)
+            debug_log(f"Task {speculative_task_id}: Attached confirm to speculative generation")
+            return {"task_id": speculative_task_id, "status": task["status"] if task else "pending", "speculative": True}
+
+    # Held by the background task until the result is handed to the history writer
+    budget_lease = await admit(generation_cost(image_bytes_list + [mask_bytes], model, ratio), "generate")
+    task_id = task_service.create_task("image_generation")
     
     background_tasks.add_task(
         run_generation_task,
-        task_id, prompt, ratio, scenario, model, api_key, api_url, image_bytes_list, mask_bytes, thought_signature, thinking_level, identity_ref, logic_ref
+        task_id, prompt, ratio, scenario, model, api_key, api_url, image_bytes_list, mask_bytes, thought_signature, thinking_level, identity_ref, logic_ref,
+        fingerprint=precomputed_fingerprint,
+        prompt_variants=prompt_variants,
+        session=client_id or (request.client.host if request.client else None),
+        budget_lease=budget_lease
     )
     
     return {"task_id": task_id, "status": "pending"}
 
 
 
+async def run_speculations(runs: list):
+    """Run speculative generations ([(args, kwargs)] of run_generation_task) concurrently."""
+    await asyncio.gather(*(run_generation_task(*args, **kwargs) for args, kwargs in runs))
+
 async def run_generation_task(
     task_id: str,
     prompt: str,
@@ -242,9 +603,33 @@ async def run_generation_task(
     thought_signature: Optional[str] = None,
     thinking_level: Optional[str] = None,
     identity_ref: Optional[int] = None,
-    logic_ref: Optional[int] = None
+    logic_ref: Optional[int] = None,
+    fingerprint: Optional[dict] = None,
+    prompt_variants: str = "auto",
+    session: Optional[str] = None,
+    budget_lease: Optional[Lease] = None
 ):
+    # Fired by DELETE /api/tasks/{id} (or the abandon watch): in-flight upstream calls of the task abort
+    cancel_token = task_service.cancel_token(task_id)
     try:
+        cancel_token.check()
+        if budget_lease is None:
+            # Callers other than the endpoints (batch runs) wait for their share here
+            budget_lease = await byte_budget.acquire_async(generation_cost(image_bytes_list + [mask_bytes], model, ratio), config.BYTE_BUDGET_WAIT_SECONDS, "generation")
+            if budget_lease is None:
+                raise Exception("服务器繁忙，请稍后重试。")
+        # Nothing the task still holds is needed once it is cancelled
+        cancel_token.on_cancel(budget_lease.release)
+
+        from models import get_prompt_family
+        prompt_family = get_prompt_family(model)
+
+        # Counted from submission; upstream calls in every stage size their attempts by what is left
+        task = task_service.get_task(task_id)
+        deadline = Deadline.after(config.TASK_DEADLINE_SECONDS, task["created_at"] if task else None)
+        # Prompt optimization must leave enough time for the image itself
+        prompt_deadline = deadline.shortened(config.DEADLINE_IMAGE_RESERVE_SECONDS)
+
         task_service.update_task(task_id, status="processing", progress=5, progress_message="🎬 初始化生成任务...")
         print(f"\n>>> [ASYNC TASK {task_id}] Prompt: {prompt[:50]}... | Model: {model}")
         
@@ -253,59 +638,42 @@ async def run_generation_task(
         if scenario == 'free_mode' or thought_signature:
             task_service.update_task(task_id, progress=30, progress_message="✅ 使用精确指令：跳过提示词优化")
             optimized_result = prompt
+        elif prompt_deadline.remaining() < config.DEADLINE_MIN_PROMPT_SECONDS:
+            # Optional stage: with this little time left it would only delay the image
+            task_service.update_task(task_id, progress=30, progress_message="⏱️ 剩余时间不足：跳过提示词优化")
+            optimized_result = prompt
         else:
             if image_bytes_list:
                 task_service.update_task(task_id, progress=10, progress_message=f"📸 分析上传的 {len(image_bytes_list)} 张产品图...")
             
             task_service.update_task(task_id, progress=15, progress_message="🤖 准备提示词优化引擎...")
-            try:
-                optimized_result = prompt_service.optimize_prompt(prompt, scenario, image_bytes_list, api_key, api_url, task_id, task_service)
-                task_service.update_task(task_id, progress=30, progress_message="✨ 提示词优化完成")
-            except Exception as e:
-                print(f"Prompt optimization failed: {e}")
-                task_service.update_task(task_id, progress=30, progress_message="⚠️ 提示词优化失败,使用原始提示词")
-                optimized_result = prompt # Fallback to original prompt
-        
-        final_prompt = optimized_result
-        layout_logic = ""
+            with deadline_scope(prompt_deadline), cancel_scope(cancel_token):
+                # Pick up a speculative fingerprint started when the images were attached
+                if not fingerprint and image_bytes_list:
+                    fingerprint = await prompt_bulkhead.run(fingerprint_prefetcher.claim, await hash_images_async(image_bytes_list), prefetch_owner(api_key, session))
+                    if fingerprint:
+                        debug_log(f"Task {task_id}: Using prefetched fingerprint")
+                try:
+                    optimized_result = await prompt_bulkhead.run(prompt_service.optimize_prompt, prompt, scenario, image_bytes_list, api_key, api_url, task_id, task_service, fingerprint=fingerprint, target_family=None if prompt_variants == "dual" else prompt_family)
+                    task_service.update_task(task_id, progress=30, progress_message="✨ 提示词优化完成")
+                except Exception as e:
+                    print(f"Prompt optimization failed: {e}")
+                    task_service.update_task(task_id, progress=30, progress_message="⚠️ 提示词优化失败,使用原始提示词")
+                    optimized_result = prompt # Fallback to original prompt
         
-        try:
-            prompt_data = json.loads(optimized_result)
-            
-            # Extract thinking_level from optimized prompt if present
-            if "thinking_level" in prompt_data and not thinking_level:
-                thinking_level = prompt_data["thinking_level"]
-                
-            # Handle Dual-Track indexing from optimized result if present
-            if "proposal" in prompt_data:
-                p = prompt_data["proposal"]
-                if "identity_ref" in p and identity_ref is None:
-                    identity_ref = p["identity_ref"]
-                if "logic_ref" in p and logic_ref is None:
-                    logic_ref = p["logic_ref"]
-
-            # Handle Luxury Visual Strategy format
-            if "luxury_visual_strategy" in prompt_data:
-                strategy = prompt_data["luxury_visual_strategy"]
-                screens = strategy.get("screens", [])
-                if screens:
-                    # Default to the first screen (Brand Impact)
-                    first_screen = screens[0]
-                    final_prompt = first_screen.get("positive_prompt", optimized_result)
-                    layout_logic = f"Screen: {first_screen.get('screen_name_zh', '1')}\n{strategy.get('visual_grammar_handbook', {}).get('composition_rules', {})}"
-                else:
-                    final_prompt = optimized_result
-            else:
-                # Standard Dual-Core format
-                is_seadream = "doubao" in model.lower() or "seadream" in model.lower()
-                if is_seadream:
-                    final_prompt = prompt_data.get("seadream_cn", prompt_data.get("nano_banana_en", optimized_result))
-                else:
-                    final_prompt = prompt_data.get("nano_banana_en", prompt_data.get("seadream_cn", optimized_result))
-                layout_logic = prompt_data.get("layout_logic", "")
-        except Exception as e:
-            print(f"DEBUG_LOG: JSON parsing failed or format mismatch: {e}")
-            final_prompt = optimized_result
+        parsed = parse_optimized_prompt(optimized_result, prompt_family, prompt_variants)
+        final_prompt = parsed["final_prompt"]
+        layout_logic = parsed["layout_logic"]
+        prompt_variant_map = parsed["prompt_variant_map"]
+        # Explicit request values win over what the optimizer suggested
+        if parsed["thinking_level"] and not thinking_level:
+            thinking_level = parsed["thinking_level"]
+        if identity_ref is None:
+            identity_ref = parsed["identity_ref"]
+        if logic_ref is None:
+            logic_ref = parsed["logic_ref"]
+
+        cancel_token.check()
 
         task_service.update_task(task_id, progress=35, progress_message="🔧 准备图像生成参数...")
         # 2. Generate Image
@@ -324,6 +692,7 @@ async def run_generation_task(
         
         try:
             try:
+                debug_hashes = await hash_images_async(image_bytes_list + ([mask_bytes] if mask_bytes else []))
                 with open("prompt_debug.log", "a", encoding="utf-8") as f:
                     f.write("\n--- FINAL_IMAGE_REQUEST ---\n")
                     f.write(f"task_id: {task_id}\n")
@@ -337,24 +706,26 @@ async def run_generation_task(
                     f.write(f"logic_ref: {logic_ref}\n")
                     f.write(f"images_count: {len(image_bytes_list)}\n")
                     for idx, img_bytes in enumerate(image_bytes_list):
-                        sha1 = hashlib.sha1(img_bytes).hexdigest()
-                        f.write(f"image_{idx}: bytes={len(img_bytes)} sha1={sha1}\n")
+                        f.write(f"image_{idx}: bytes={len(img_bytes)} sha1={debug_hashes[idx]}\n")
                     if mask_bytes:
-                        f.write(f"mask: bytes={len(mask_bytes)} sha1={hashlib.sha1(mask_bytes).hexdigest()}\n")
+                        f.write(f"mask: bytes={len(mask_bytes)} sha1={debug_hashes[-1]}\n")
                     f.write("prompt:\n")
                     f.write(final_prompt)
                     f.write("\n")
             except Exception as e:
                 debug_log(f"Failed to write prompt_debug.log FINAL_IMAGE_REQUEST: {e}")
 
-            result_data = banana_service.generate_image(final_prompt, ratio, image_bytes_list, mask_bytes, model, api_key, api_url, thought_signature, thinking_level, identity_ref, logic_ref)
+            with deadline_scope(deadline), cancel_scope(cancel_token):
+                result_data = await image_bulkhead.run(banana_service.generate_image, final_prompt, ratio, image_bytes_list, mask_bytes, model, api_key, api_url, thought_signature, thinking_level, identity_ref, logic_ref)
             result = result_data.get("url", "")
             new_thought_signature = result_data.get("thought_signature")
             
             task_service.update_task(task_id, progress=70, progress_message="🖼️ 图像生成完成,正在处理...")
         except Exception as e:
             error_msg = str(e)
-            if "Remote end closed connection" in error_msg or "Connection aborted" in error_msg:
+            if isinstance(e, DeadlineExceeded):
+                error_msg = f"生成超时：已超过任务时限（{int(config.TASK_DEADLINE_SECONDS)} 秒），请稍后再试。"
+            elif "Remote end closed connection" in error_msg or "Connection aborted" in error_msg:
                 error_msg = "与生成服务器连接中断，请稍后重试。"
             elif "timeout" in error_msg.lower():
                 error_msg = "生成超时，请尝试缩短提示词或稍后再试。"
@@ -367,7 +738,7 @@ async def run_generation_task(
         if isinstance(result, str):
             debug_log(f"Task {task_id}: Result prefix: {result[:50]}...")
         
-        # 3. Proxy image (Download and convert to Base64)
+        # 3. Proxy image (Download and convert to Base64); optional, the history writer fetches a plain URL itself
         if result and isinstance(result, str) and result.startswith("http"):
             task_service.update_task(task_id, progress=80, progress_message="📥 正在下载生成的图像...")
             try:
@@ -375,14 +746,18 @@ async def run_generation_task(
                 for attempt in range(2):
                     try:
                         # Bypass proxies to avoid connection issues
-                        img_response = requests.get(result, timeout=30, proxies={"http": None, "https": None})
+                        with cancel_scope(cancel_token):
+                            img_response = await download_bulkhead.run(abortable_request, "GET", result, timeout=deadline.timeout(30), proxies={"http": None, "https": None})
                         img_response.raise_for_status()
-                        b64_data = base64.b64encode(img_response.content).decode('utf-8')
+                        b64_data = (await cpu_pool.run_async(b64encode, img_response.content)).decode('utf-8')
                         result = f"data:image/png;base64,{b64_data}"
                         break
+                    except DeadlineExceeded:
+                        print(f"Proxy download skipped: task {task_id} is out of time")
+                        break
                     except Exception as download_err:
                         print(f"Proxy download attempt {attempt+1} failed: {download_err}")
-                        if attempt == 0: time.sleep(2)
+                        if attempt == 0: await asyncio.sleep(2)
             except Exception as e:
                 print(f"Proxy failed completely: {e}")
                 # Keep original URL if proxy fails
@@ -392,58 +767,31 @@ async def run_generation_task(
             if not result.startswith("http") and not result.startswith("data:"):
                 result = f"data:image/png;base64,{result}"
             
-        # 4. Save History
+        cancel_token.check()
+
+        # 4. Save History (write-behind: files are served from memory until the writer lands them)
         task_service.update_task(task_id, progress=85, progress_message="💾 正在保存到历史记录...")
+        # Tasks finishing in the same millisecond (here or in a batch run) must not share an id
+        timestamp = await disk_bulkhead.run(history_writer.next_timestamp)
+        saved_image = False
+        saved_image_url = None
+        original_images_urls = []
         try:
-            timestamp = int(time.time() * 1000)
-            history_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static", "history")
-            os.makedirs(history_dir, exist_ok=True)
-
-            # Save generated image
-            saved_image = False
+            image_bytes = None
+            image_source_url = None
             if result:
                 if result.startswith("data:image"):
                     try:
                         header, encoded = result.split(",", 1)
-                        img_data = base64.b64decode(encoded)
-                        save_path = os.path.join(history_dir, f"{timestamp}.png")
-                        with open(save_path, "wb") as f:
-                            f.write(img_data)
-                        saved_image = True
-                        debug_log(f"Task {task_id}: Saved base64 image to {save_path}")
+                        image_bytes = await cpu_pool.run_async(b64decode, encoded.encode("ascii"))
                     except Exception as e:
-                        debug_log(f"Task {task_id}: Error saving base64 image: {e}")
+                        debug_log(f"Task {task_id}: Error decoding base64 image: {e}")
                 elif result.startswith("http"):
-                    try:
-                        # Download the image if it's a URL
-                        debug_log(f"Task {task_id}: Downloading image from {result}")
-                        # Use system proxies (do not disable them) to support VPNs
-                        img_response = requests.get(result, timeout=30)
-                        img_response.raise_for_status()
-                        save_path = os.path.join(history_dir, f"{timestamp}.png")
-                        with open(save_path, "wb") as f:
-                            f.write(img_response.content)
-                        saved_image = True
-                        debug_log(f"Task {task_id}: Downloaded and saved image to {save_path}")
-                    except Exception as e:
-                        debug_log(f"Task {task_id}: Error downloading image for history: {e}")
+                    # Proxy download failed above; the writer retries it off the critical path
+                    image_source_url = result
                 else:
                     debug_log(f"Task {task_id}: Result format not recognized for saving: {result[:50]}...")
 
-            if not saved_image:
-                debug_log(f"Task {task_id}: Warning: Generated image was not saved to history")
-
-            # Save original images and collect their relative URLs
-            original_images_urls = []
-            for idx, img_bytes in enumerate(image_bytes_list):
-                orig_filename = f"{timestamp}_orig_{idx}.jpg"
-                with open(os.path.join(history_dir, orig_filename), "wb") as f:
-                    f.write(img_bytes)
-                original_images_urls.append(f"/static/history/{orig_filename}")
-            
-            print(f"DEBUG_LOG: Saved {len(image_bytes_list)} original images")
-
-            # Save metadata
             metadata = {
                 "timestamp": timestamp,
                 "original_prompt": prompt,
@@ -452,32 +800,46 @@ async def run_generation_task(
                 "model": model,
                 "ratio": ratio,
                 "layout_logic": layout_logic,
-                "original_images_count": len(image_bytes_list)
+                "original_images_count": len(image_bytes_list),
+                # Retention keeps the newest entries of each session
+                "session": session
             }
-            with open(os.path.join(history_dir, f"{timestamp}.json"), "w", encoding="utf-8") as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
-            
-            print(f"History saved successfully for timestamp: {timestamp}")
+            saved = await disk_bulkhead.run(history_writer.submit, timestamp, metadata, image_bytes=image_bytes, image_source_url=image_source_url, originals=image_bytes_list)
+            saved_image = saved["image_url"] is not None
+            saved_image_url = saved["image_url"]
+            original_images_urls = saved["original_images"]
+
+            if not saved_image:
+                debug_log(f"Task {task_id}: Warning: Generated image is not served from history")
+            print(f"History queued for timestamp: {timestamp}")
         except Exception as e:
             print(f"History save error: {e}")
 
         task_service.update_task(task_id, status="succeed", progress=100, progress_message="✅ 完成!", result={
             "id": str(timestamp),
-            "url": f"/static/history/{timestamp}.png" if saved_image else result,
+            "url": saved_image_url if saved_image else result,
+            "thumbnail_url": f"{saved_image_url}?size=thumb" if saved_image else None,
             "optimized_prompt": final_prompt,
             "original_prompt": prompt,
             "original_images": original_images_urls,
             "timestamp": timestamp,
-            "thought_signature": new_thought_signature # Pass back to frontend
+            "thought_signature": new_thought_signature, # Pass back to frontend
+            "prompt_variants": prompt_variant_map
         })
-        debug_log(f"Task {task_id}: Success. Result URL: {f'/static/history/{timestamp}.png' if saved_image else result}")
-        print(f"<<< [ASYNC TASK {task_id} SUCCESS] Result URL: {f'/static/history/{timestamp}.png' if saved_image else result}")
+        debug_log(f"Task {task_id}: Success. Result URL: {saved_image_url if saved_image else result}")
+        print(f"<<< [ASYNC TASK {task_id} SUCCESS] Result URL: {saved_image_url if saved_image else result}")
 
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
         print(f"ASYNC TASK ERROR: {str(e)}\n{error_trace}")
         task_service.update_task(task_id, status="failed", error=str(e))
+    except TaskCancelled:
+        print(f"<<< [ASYNC TASK {task_id} CANCELLED]")
+    finally:
+        if budget_lease is not None:
+            budget_lease.release()
+        task_service.release_cancel_token(task_id)
 
 if __name__ == "__main__":
     import uvicorn
@@ -7,7 +7,9 @@ from config import config
 #     "name": "Display Name",
 #     "url": "API Endpoint URL",
 #     "model_key": "Model Key (if needed by API)",
-#     "description": "Short description"
+#     "description": "Short description",
+#     "provider": "Request format used by BananaService",
+#     "prompt_family": "Which optimized prompt variant the model consumes (nano_banana / seadream)"
 # }
 
 MODEL_REGISTRY = {
@@ -16,14 +18,16 @@ MODEL_REGISTRY = {
         "url": config.BANANA_API_URL, # Default from config
         "model_key": config.BANANA_MODEL_KEY,
         "description": "速度快，通用性强",
-        "provider": "default"
+        "provider": "default",
+        "prompt_family": "nano_banana"
     },
     "comfly_nano_banana": {
         "name": "Comfly Nano Banana 2 (官方源)",
         "url": config.BANANA_API_URL,
         "model_key": "nano-banana-2",
         "description": "Comfly 官方渠道，支持文生图与图生图",
-        "provider": "comfly"
+        "provider": "comfly",
+        "prompt_family": "nano_banana"
     },
 
     "nano_banana_official": {
@@ -31,21 +35,24 @@ MODEL_REGISTRY = {
         "url": config.BANANA_API_URL,
         "model_key": "nano-banana",
         "description": "Google 最先进的图像生成和编辑模型，支持文生图、图生图、多图生图",
-        "provider": "comfly"
+        "provider": "comfly",
+        "prompt_family": "nano_banana"
     },
     "nano_banana_2_2k": {
         "name": "Nano Banana 2-2k (高清版)",
         "url": config.BANANA_API_URL,
         "model_key": "nano-banana-2-2k",
         "description": "Nano-banana 2 高清版，支持 1K/2K/4K 分辨率控制",
-        "provider": "comfly"
+        "provider": "comfly",
+        "prompt_family": "nano_banana"
     },
     "nano_banana_2_4k": {
         "name": "Nano Banana 2-4k (超高清版)",
         "url": config.BANANA_API_URL,
         "model_key": "nano-banana-2-4k",
         "description": "Nano-banana 2 超高清版，默认支持 4K 分辨率输出",
-        "provider": "comfly"
+        "provider": "comfly",
+        "prompt_family": "nano_banana"
     },
 
     "doubao_seedream_4_0": {
@@ -53,24 +60,39 @@ MODEL_REGISTRY = {
         "url": config.BANANA_API_URL,
         "model_key": "doubao-seedream-4-0-250828",
         "description": "字节跳动最新即梦4.0模型，画质细腻",
-        "provider": "comfly"
+        "provider": "comfly",
+        "prompt_family": "seadream"
     },
     "doubao_seedream_4_5": {
         "name": "Doubao Seedream 4.5 (即梦4.5)",
         "url": config.BANANA_API_URL,
         "model_key": "doubao-seedream-4-5-251128",
         "description": "字节跳动最新即梦4.5模型，支持多模态生成",
-        "provider": "comfly_json"
+        "provider": "comfly_json",
+        "prompt_family": "seadream"
     },
     "gpt_image_1_5": {
         "name": "GPT-Image-1.5 (OpenAI)",
         "url": config.BANANA_API_URL,
         "model_key": "gpt-image-1.5",
         "description": "OpenAI 图像生成模型，支持文生图与图生图",
-        "provider": "openai"
+        "provider": "openai",
+        "prompt_family": "nano_banana"
     }
 }
 
+PROMPT_FAMILIES = ("nano_banana", "seadream")
+
 def get_model_info(model_id: str):
     """Get model information from the registry."""
     return MODEL_REGISTRY.get(model_id)
+
+def get_prompt_family(model_id: str) -> str:
+    """Get the optimized prompt variant a model consumes, defaulting to nano_banana."""
+    model_info = MODEL_REGISTRY.get(model_id)
+    if model_info and model_info.get("prompt_family") in PROMPT_FAMILIES:
+        return model_info["prompt_family"]
+    model_id_lower = (model_id or "").lower()
+    if "doubao" in model_id_lower or "seadream" in model_id_lower:
+        return "seadream"
+    return "nano_banana"
@@ -390,6 +390,31 @@ Senior Visual Engineer. 你需要根据用户需求生成双语提示词。
 }
 """
 
+# ==============================================================================
+# 单目标输出覆盖 (Single-Target Output Override)
+# 作用：已知目标模型时只生成一种提示词，省去另一语种的输出 token
+# ==============================================================================
+SINGLE_TARGET_OUTPUT_INSTRUCTIONS = {
+    "nano_banana": """
+# Output Override (CRITICAL, 覆盖上方双核结构)
+本次目标模型为 **Nano-Banana 2 (English)**，只需生成 nano_banana_en，**不要**输出 seadream_cn。
+最终输出必须封装在以下精简 JSON 结构中：
+{
+  "nano_banana_en": "包含所有模块的完整英文提示词集合，严格遵循模板中的 [Visual Description] 和 [Text & UI Layout] 逻辑",
+  "layout_logic": "对整体长图布局、模块间距和视觉流向的建议"
+}
+""",
+    "seadream": """
+# Output Override (CRITICAL, 覆盖上方双核结构)
+本次目标模型为 **SeaDream-4.5 (Chinese)**，只需生成 seadream_cn，**不要**输出 nano_banana_en。
+最终输出必须封装在以下精简 JSON 结构中：
+{
+  "seadream_cn": "包含所有模块的完整中文提示词集合，同样遵循结构化逻辑",
+  "layout_logic": "对整体长图布局、模块间距和视觉流向的建议"
+}
+"""
+}
+
 # ==============================================================================
 # 提示词路由表 (Prompt Registry)
 # ==============================================================================
@@ -1,8 +1,9 @@
 import requests
-import base64
-import json
 from config import config
 from models import MODEL_REGISTRY
+from services.upstream_body import Base64Image, data_url, json_body, multipart_body, loggable_json
+from services.deadline import DeadlineExceeded, attempt_timeout, backoff
+from services.cancellation import abortable_request
 
 # 1. 【多级尺寸映射系统】
 # 1K 标准版 (约 1MP)
@@ -40,9 +41,70 @@ OPENAI_SIZE_MAP = {
     "9:16": "720x1280"
 }
 
+def resolution_tier(model_id: str, ratio: str):
+    """(size config, "1K"/"2K"/"4K") for a model id and aspect ratio."""
+    model_id_lower = model_id.lower()
+    ratio = (ratio or "").strip()
+    if "4k" in model_id_lower:
+        return SIZE_MAP_4K.get(ratio, SIZE_MAP_4K["1:1"]), "4K"
+    if "2k" in model_id_lower or "doubao" in model_id_lower:
+        return SIZE_MAP_2K.get(ratio, SIZE_MAP_2K["1:1"]), "2K"
+    return SIZE_MAP_1K.get(ratio, SIZE_MAP_1K["1:1"]), "1K"
+
+def extract_image_result(result):
+    """(image url or b64 data, thought_signature) from any of the upstream response shapes."""
+    image_url = ""
+    new_thought_signature = None
+
+    # Safely extract thought_signature
+    if isinstance(result, dict):
+        new_thought_signature = result.get("thought_signature")
+
+    if not isinstance(result, dict):
+        print(f"DEBUG_LOG: API Response Content: {result}")
+        if isinstance(result, list) and len(result) > 0:
+            item = result[0]
+            if isinstance(item, str): image_url = item
+            if isinstance(item, dict):
+                result = item
+                if not new_thought_signature:
+                    new_thought_signature = result.get("thought_signature")
+        else:
+            image_url = str(result)
+
+    if not image_url:
+        # Try to find image in various common locations
+        if "output" in result and result["output"]:
+            if isinstance(result["output"], list) and len(result["output"]) > 0:
+                image_url = result["output"][0]
+            else:
+                image_url = result["output"]
+
+        elif "data" in result and isinstance(result["data"], list) and len(result["data"]) > 0:
+            item = result["data"][0]
+            if isinstance(item, dict):
+                if "url" in item:
+                    image_url = item["url"]
+                elif "b64_json" in item:
+                    image_url = item["b64_json"]
+            elif isinstance(item, str):
+                image_url = item
+
+        # Doubao 4.5 specific response handling if needed
+        elif "image_url" in result:
+            image_url = result["image_url"]
+
+        # Fallback to root url or other common fields
+        else:
+            for key in ["url", "image", "img_url"]:
+                if key in result and result[key]:
+                    image_url = result[key]
+                    break
+
+    return image_url, new_thought_signature
+
 class BananaService:
     def _make_request(self, method, url, headers, json_data=None, files=None, data=None, timeout=120):
-        import time
         import urllib3
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         
@@ -51,15 +113,18 @@ class BananaService:
         last_error = None
         verify_ssl = True # Default to secure
 
+        # Built once and streamed on every attempt: images are base64-encoded while sending
+        body = None
+        if method == "POST":
+            body = multipart_body(data, files) if files else json_body(json_data)
+            headers = {**headers, "Content-Type": body.content_type}
+
         while retry_count <= max_retries:
             try:
                 if method == "POST":
-                    if files:
-                        response = requests.post(url, headers=headers, files=files, data=data, timeout=timeout, verify=verify_ssl)
-                    else:
-                        response = requests.post(url, json=json_data, headers=headers, timeout=timeout, verify=verify_ssl)
+                    response = abortable_request("POST", url, headers=headers, data=body.reader(), timeout=attempt_timeout(timeout), verify=verify_ssl)
                 else:
-                    response = requests.get(url, headers=headers, timeout=timeout, verify=verify_ssl)
+                    response = abortable_request("GET", url, headers=headers, timeout=attempt_timeout(timeout), verify=verify_ssl)
                 
                 if response.status_code in [502, 503, 504]:
                     raise requests.exceptions.HTTPError(f"Server Error {response.status_code}", response=response)
@@ -83,7 +148,7 @@ class BananaService:
                 if retry_count <= max_retries:
                     wait_time = 2 * retry_count
                     print(f"DEBUG_LOG: Retrying in {wait_time}s...")
-                    time.sleep(wait_time)
+                    backoff(wait_time)
                 else:
                     break
             except Exception as e:
@@ -111,20 +176,8 @@ class BananaService:
         print(f"DEBUG_LOG: Using Model: {model_config['name']} ({model_id})")
             
         # 智能尺寸选择
-        model_id_lower = model_id.lower()
-        image_size_param = "1K"
-        if "4k" in model_id_lower:
-            size_config = SIZE_MAP_4K.get(ratio, SIZE_MAP_4K["1:1"])
-            image_size_param = "4K"
-            print(f"DEBUG_LOG: Resolution Tier: 4K")
-        elif "2k" in model_id_lower or "doubao" in model_id_lower:
-            size_config = SIZE_MAP_2K.get(ratio, SIZE_MAP_2K["1:1"])
-            image_size_param = "2K"
-            print(f"DEBUG_LOG: Resolution Tier: 2K")
-        else:
-            size_config = SIZE_MAP_1K.get(ratio, SIZE_MAP_1K["1:1"])
-            image_size_param = "1K"
-            print(f"DEBUG_LOG: Resolution Tier: 1K")
+        size_config, image_size_param = resolution_tier(model_id, ratio)
+        print(f"DEBUG_LOG: Resolution Tier: {image_size_param}")
             
         width = size_config["width"]
         height = size_config["height"]
@@ -216,8 +269,7 @@ class BananaService:
                     "response_format": "url"
                 })
                 if images and len(images) > 0:
-                    base64_data = base64.b64encode(images[0]).decode('utf-8')
-                    current_payload["image"] = f"data:image/png;base64,{base64_data}"
+                    current_payload["image"] = data_url(images[0])
                     current_payload["strength"] = 0.7
             else:
                 # Use aspect_ratio for standard ratios, width/height for others
@@ -229,11 +281,11 @@ class BananaService:
                     current_payload["height"] = height
                     
                 if images and len(images) > 0:
-                    current_payload["image"] = base64.b64encode(images[0]).decode('utf-8')
+                    current_payload["image"] = Base64Image(images[0])
                     current_payload["strength"] = 0.7
 
             print(f"DEBUG_LOG: Sending JSON Request. URL={url}")
-            print(f"DEBUG_LOG: Payload: {json.dumps(current_payload, indent=2)}")
+            print(f"DEBUG_LOG: Payload: {loggable_json(current_payload, indent=2)}")
             response = self._make_request("POST", url, headers=headers, json_data=current_payload)
 
         try:
@@ -241,54 +293,7 @@ class BananaService:
             result = response.json()
             print(f"DEBUG_LOG: API Response Type: {type(result)}")
             
-            # Extract image and thought_signature
-            image_url = ""
-            new_thought_signature = None
-            
-            # Safely extract thought_signature
-            if isinstance(result, dict):
-                new_thought_signature = result.get("thought_signature")
-            
-            if not isinstance(result, dict):
-                print(f"DEBUG_LOG: API Response Content: {result}")
-                if isinstance(result, list) and len(result) > 0:
-                    item = result[0]
-                    if isinstance(item, str): image_url = item
-                    if isinstance(item, dict): 
-                        result = item
-                        if not new_thought_signature:
-                            new_thought_signature = result.get("thought_signature")
-                else:
-                    image_url = str(result)
-
-            if not image_url:
-                # Try to find image in various common locations
-                if "output" in result and result["output"]:
-                    if isinstance(result["output"], list) and len(result["output"]) > 0:
-                        image_url = result["output"][0]
-                    else:
-                        image_url = result["output"]
-                
-                elif "data" in result and isinstance(result["data"], list) and len(result["data"]) > 0:
-                    item = result["data"][0]
-                    if isinstance(item, dict):
-                        if "url" in item:
-                            image_url = item["url"]
-                        elif "b64_json" in item:
-                            image_url = item["b64_json"]
-                    elif isinstance(item, str):
-                        image_url = item
-                
-                # Doubao 4.5 specific response handling if needed
-                elif "image_url" in result:
-                    image_url = result["image_url"]
-
-                # Fallback to root url or other common fields
-                else:
-                    for key in ["url", "image", "img_url"]:
-                        if key in result and result[key]:
-                            image_url = result[key]
-                            break
+            image_url, new_thought_signature = extract_image_result(result)
 
             if not image_url:
                 print(f"DEBUG_LOG: Could not find image in response: {result}")
@@ -297,6 +302,9 @@ class BananaService:
                 "url": image_url,
                 "thought_signature": new_thought_signature
             }
+        except DeadlineExceeded:
+            # The caller reports running out of time itself
+            raise
         except Exception as e:
             error_msg = str(e)
             if hasattr(e, 'response') and e.response is not None:
@@ -0,0 +1,209 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, Any, List, Optional
+from config import config
+from services.cpu_pool import cpu_pool, sha256_hex
+
+BLOB_DIR = os.path.join(config.STATIC_DIR, "blobs")
+BLOB_URL_PREFIX = "/static/blobs"
+
+BLOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    ext TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    released_at REAL
+);
+CREATE TABLE IF NOT EXISTS blob_refs (
+    owner INTEGER NOT NULL,
+    slot INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (owner, slot)
+);
+"""
+
+
+def detect_image_ext(data: bytes) -> str:
+    """Real file extension from magic bytes; uploads are no longer all named .jpg."""
+    head = bytes(data[:16])
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "webp"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if head.startswith(b"BM"):
+        return "bmp"
+    if head[4:12] in (b"ftypavif", b"ftypavis"):
+        return "avif"
+    if head[4:8] == b"ftyp":
+        return "heic"
+    return "bin"
+
+
+class BlobStore:
+    """Content-addressed storage for uploaded originals: static/blobs/ab/cd/<sha256>.<ext>.
+
+    Each history entry that references a blob holds one reference. Blobs whose
+    refcount drops to zero are removed by gc() after a grace period. A put()
+    with an owner (history id) and slot counts once, so replaying a journal
+    entry that crashed after its puts does not reference the blobs twice.
+    """
+
+    def __init__(self, root: str = BLOB_DIR, db_path: Optional[str] = None):
+        self.root = root
+        self.db_path = db_path or config.HISTORY_DB_PATH
+        os.makedirs(self.root, exist_ok=True)
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(BLOB_SCHEMA)
+            self._conn.commit()
+
+    def relative_path(self, blob_hash: str, ext: str) -> str:
+        return f"{blob_hash[:2]}/{blob_hash[2:4]}/{blob_hash}.{ext}"
+
+    def path_for(self, blob_hash: str, ext: str) -> str:
+        return os.path.join(self.root, self.relative_path(blob_hash, ext))
+
+    def url_for(self, blob_hash: str, ext: str) -> str:
+        return f"{BLOB_URL_PREFIX}/{self.relative_path(blob_hash, ext)}"
+
+    def put(self, data: bytes, owner: Optional[int] = None, slot: int = 0) -> Dict[str, Any]:
+        """Store data once and take a reference to it (once per owner and slot). Returns hash, ext, size and url."""
+        blob_hash = cpu_pool.run(sha256_hex, data)
+        ext = detect_image_ext(data)
+        path = self.path_for(blob_hash, ext)
+
+        # Identical content is written only the first time it is seen
+        tmp_path = None
+        if not os.path.exists(path):
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            except FileNotFoundError:
+                # gc() pruned the shard directory in between; written under the lock below
+                pass
+        if tmp_path:
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+
+        try:
+            with self._lock:
+                # The owner's ref row and the refcount land in one transaction
+                taken = owner is None or self._conn.execute(
+                    "INSERT OR IGNORE INTO blob_refs (owner, slot, hash) VALUES (?, ?, ?)", (owner, slot, blob_hash)
+                ).rowcount
+                if taken:
+                    self._conn.execute(
+                        "INSERT INTO blobs (hash, ext, size, refcount, created_at) VALUES (?, ?, ?, 1, ?) "
+                        "ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1, released_at = NULL",
+                        (blob_hash, ext, len(data), time.time())
+                    )
+                self._conn.commit()
+                # Under the lock gc() removes files with, so a blob it collects is written again here
+                if not os.path.exists(path):
+                    if tmp_path is None:
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+                        with os.fdopen(fd, "wb") as f:
+                            f.write(data)
+                    os.replace(tmp_path, path)
+                    tmp_path = None
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return {"hash": blob_hash, "ext": ext, "size": len(data), "url": self.url_for(blob_hash, ext)}
+
+    def release(self, blob_hashes: List[str], owner: Optional[int] = None):
+        """Drop one reference per hash (e.g. when a history entry is deleted), and the owner's ref rows."""
+        with self._lock:
+            if owner is not None:
+                self._conn.execute("DELETE FROM blob_refs WHERE owner = ?", (owner,))
+            for blob_hash in blob_hashes:
+                self._conn.execute(
+                    "UPDATE blobs SET refcount = MAX(refcount - 1, 0), "
+                    "released_at = CASE WHEN refcount <= 1 THEN ? ELSE released_at END WHERE hash = ?",
+                    (time.time(), blob_hash)
+                )
+            self._conn.commit()
+
+    def set_refcounts(self, counts: Dict[str, int]):
+        """Overwrite refcounts from an authoritative recount (see history_admin.py gc-blobs)."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("UPDATE blobs SET refcount = 0, released_at = COALESCE(released_at, ?)", (now,))
+            for blob_hash, count in counts.items():
+                self._conn.execute("UPDATE blobs SET refcount = ?, released_at = NULL WHERE hash = ?", (count, blob_hash))
+            self._conn.commit()
+
+    def gc(self, grace_seconds: int = 3600, dry_run: bool = False, referenced: Optional[set] = None, hashes: Optional[set] = None) -> Dict[str, Any]:
+        """Delete unreferenced blobs released more than grace_seconds ago (only those in hashes, if given).
+
+        With referenced (a recount of live hashes) a dry run can report without
+        touching the stored refcounts.
+        """
+        cutoff = time.time() - grace_seconds
+        with self._lock:
+            if referenced is not None:
+                rows = [
+                    row for row in self._conn.execute("SELECT hash, ext, size FROM blobs WHERE created_at <= ?", (cutoff,)).fetchall()
+                    if row["hash"] not in referenced
+                ]
+            else:
+                rows = self._conn.execute(
+                    "SELECT hash, ext, size FROM blobs WHERE refcount <= 0 AND (released_at IS NULL OR released_at <= ?)",
+                    (cutoff,)
+                ).fetchall()
+        if hashes is not None:
+            rows = [row for row in rows if row["hash"] in hashes]
+        freed = 0
+        for row in rows:
+            freed += row["size"]
+            if dry_run:
+                continue
+            with self._lock:
+                deleted = self._conn.execute("DELETE FROM blobs WHERE hash = ? AND refcount <= 0", (row["hash"],)).rowcount
+                self._conn.commit()
+                # A blob re-referenced since the query keeps its file
+                path = self.path_for(row["hash"], row["ext"])
+                if deleted and os.path.exists(path):
+                    os.remove(path)
+                    # Prune the ab/cd shard directories once empty
+                    directory = os.path.dirname(path)
+                    while os.path.normpath(directory) != os.path.normpath(self.root):
+                        try:
+                            os.rmdir(directory)
+                        except OSError:
+                            break
+                        directory = os.path.dirname(directory)
+        return {"removed": len(rows), "bytes_freed": freed, "dry_run": dry_run}
+
+    def sizes(self, blob_hashes: List[str]) -> Dict[str, int]:
+        """Stored size of each known hash."""
+        wanted = set(blob_hashes)
+        with self._lock:
+            rows = self._conn.execute("SELECT hash, size FROM blobs").fetchall()
+        return {row["hash"]: row["size"] for row in rows if row["hash"] in wanted}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS bytes, COALESCE(SUM(refcount), 0) AS refs FROM blobs").fetchone()
+        return {"blobs": row["blobs"], "bytes": row["bytes"], "references": row["refs"]}
+
+blob_store = BlobStore()
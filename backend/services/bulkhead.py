@@ -0,0 +1,140 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Optional
+from config import config
+
+
+_EXHAUSTED = object()
+
+
+class BulkheadFull(Exception):
+    def __init__(self, stage: str):
+        super().__init__(f"Stage '{stage}' is saturated")
+        self.stage = stage
+
+
+class Bulkhead:
+    """A sized thread pool for one pipeline stage.
+
+    Blocking work of a stage (upstream calls, downloads, disk I/O) runs only
+    on its own threads, so a slow upstream model saturates its stage and
+    nothing else. max_queue bounds the jobs waiting for a thread; beyond it
+    submit() raises BulkheadFull (0 = unbounded).
+    """
+
+    def __init__(self, name: str, workers: int, max_queue: int = 0):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"stage-{name}")
+        self._lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.peak_active = 0
+        self.peak_queued = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self.saturated_seconds = 0.0
+        self._saturated_since: Optional[float] = None
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise BulkheadFull(self.name)
+            self.queued += 1
+            self.submitted += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+        # Like run_in_threadpool, the job sees the caller's context variables (e.g. its deadline)
+        context = contextvars.copy_context()
+        return self.executor.submit(context.run, self._run, time.monotonic(), fn, args, kwargs)
+
+    def call(self, fn: Callable, *args, **kwargs) -> Any:
+        """Blocking submit(); for callers already on a thread of their own."""
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """submit() awaited without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    async def iterate(self, iterable: Iterable) -> AsyncIterator:
+        """A blocking iterator as an async one, each next() on this stage's threads.
+
+        For StreamingResponse, which would otherwise step a sync iterator on
+        AnyIO's default thread pool.
+        """
+        iterator = iter(iterable)
+        while True:
+            item = await self.run(next, iterator, _EXHAUSTED)
+            if item is _EXHAUSTED:
+                return
+            yield item
+
+    def _run(self, enqueued_at: float, fn: Callable, args: tuple, kwargs: dict) -> Any:
+        started = time.monotonic()
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            self.wait_seconds += started - enqueued_at
+            if self.active == self.workers:
+                self._saturated_since = started
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                if self._saturated_since is not None:
+                    self.saturated_seconds += finished - self._saturated_since
+                    self._saturated_since = None
+                self.active -= 1
+                self.completed += 1
+                if not ok:
+                    self.failed += 1
+                self.run_seconds += finished - started
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            saturated = self.saturated_seconds
+            if self._saturated_since is not None:
+                saturated += now - self._saturated_since
+            finished = self.completed or 1
+            return {
+                "workers": self.workers,
+                "active": self.active,
+                "queued": self.queued,
+                "max_queue": self.max_queue,
+                "utilization": round(self.active / self.workers, 2),
+                "peak_active": self.peak_active,
+                "peak_queued": self.peak_queued,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "avg_wait_ms": round(self.wait_seconds / finished * 1000, 2),
+                "avg_run_ms": round(self.run_seconds / finished * 1000, 2),
+                "saturated_seconds": round(saturated, 2)
+            }
+
+
+chat_bulkhead = Bulkhead("chat", config.BULKHEAD_CHAT_WORKERS, config.BULKHEAD_CHAT_MAX_QUEUE)
+prompt_bulkhead = Bulkhead("prompt", config.BULKHEAD_PROMPT_WORKERS)
+image_bulkhead = Bulkhead("image", config.BULKHEAD_IMAGE_WORKERS)
+download_bulkhead = Bulkhead("download", config.BULKHEAD_DOWNLOAD_WORKERS)
+disk_bulkhead = Bulkhead("disk", config.BULKHEAD_DISK_WORKERS)
+variant_bulkhead = Bulkhead("variant", config.BULKHEAD_VARIANT_WORKERS)
+
+
+def bulkhead_stats() -> Dict[str, Dict[str, Any]]:
+    return {b.name: b.stats() for b in (chat_bulkhead, prompt_bulkhead, image_bulkhead, download_bulkhead, disk_bulkhead, variant_bulkhead)}
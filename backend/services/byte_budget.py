@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, Optional
+from config import config
+from services.banana_service import resolution_tier
+
+MB = 1024 * 1024
+
+# Generated images arrive as PNG/JPEG at roughly this many bytes per pixel
+RESULT_BYTES_PER_PIXEL = 1.5
+# Copies of a result held at once: downloaded body, data URL (4/3), decoded bytes for history
+RESULT_COPIES = 1 + 4 / 3 + 1
+# Responses, prompts and the streaming chunks of upstream bodies
+REQUEST_OVERHEAD_BYTES = 1 * MB
+
+
+class Lease:
+    """Bytes held against a ByteBudget until release(); releasing twice is a no-op."""
+
+    def __init__(self, budget: "ByteBudget", nbytes: int, label: str):
+        self.budget = budget
+        self.nbytes = nbytes
+        self.label = label
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.budget._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _AsyncWaiter:
+    """Queue ticket of an acquire_async() caller, woken on its own event loop."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def wake(self):
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            # Loop already closed; its waiter is gone with it
+            pass
+
+
+class ByteBudget:
+    """Process-wide cap on the bytes that requests hold in memory at once.
+
+    Work estimates its footprint up front and acquires it; acquirers are served
+    in arrival order, so a large request is not starved by a stream of small ones.
+    A request larger than the whole budget is admitted alone. With a capacity of
+    0 nothing waits, but usage is still tracked for the gauge. Threads wait with
+    acquire(), coroutines with acquire_async(), in the same queue.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self.peak = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.by_label: Dict[str, int] = {}
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes: int, timeout: Optional[float] = None, label: str = "") -> Optional[Lease]:
+        """Lease for nbytes, waiting up to timeout seconds (None = forever); None if it never fit."""
+        nbytes = max(0, int(nbytes))
+        if self.capacity > 0:
+            nbytes = min(nbytes, self.capacity)
+        ticket = object()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                while not (self._queue[0] is ticket and self._fits_locked(nbytes)):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.rejected += 1
+                        return None
+                    self._cond.wait(remaining)
+            finally:
+                self._queue.remove(ticket)
+                # The next waiter may fit now that this one left the head of the queue
+                self._notify_locked()
+            return self._grant_locked(nbytes, label)
+
+    async def acquire_async(self, nbytes: int, timeout: Optional[float] = None, label: str = "") -> Optional[Lease]:
+        """acquire() for the event loop: waits without holding a thread."""
+        nbytes = max(0, int(nbytes))
+        if self.capacity > 0:
+            nbytes = min(nbytes, self.capacity)
+        waiter = _AsyncWaiter()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._queue.append(waiter)
+        try:
+            while True:
+                with self._cond:
+                    if self._queue[0] is waiter and self._fits_locked(nbytes):
+                        return self._grant_locked(nbytes, label)
+                    # Cleared under the lock every wake-up is sent with, so none is lost
+                    waiter.event.clear()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    with self._cond:
+                        self.rejected += 1
+                    return None
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._queue.remove(waiter)
+                self._notify_locked()
+
+    def hold(self, nbytes: int, label: str = "") -> Lease:
+        """Lease for memory that is already allocated: granted at once, even over capacity.
+
+        Later acquirers wait for it, e.g. the bytes the history writer keeps
+        until they are on disk.
+        """
+        with self._cond:
+            return self._grant_locked(max(0, int(nbytes)), label)
+
+    def try_acquire(self, nbytes: int, label: str = "") -> Optional[Lease]:
+        """Lease only if it fits right now and nobody is waiting; never blocks."""
+        nbytes = max(0, int(nbytes))
+        if self.capacity > 0:
+            nbytes = min(nbytes, self.capacity)
+        with self._cond:
+            if self._queue or not self._fits_locked(nbytes):
+                self.rejected += 1
+                return None
+            return self._grant_locked(nbytes, label)
+
+    def _notify_locked(self):
+        self._cond.notify_all()
+        for ticket in self._queue:
+            if isinstance(ticket, _AsyncWaiter):
+                ticket.wake()
+
+    def _fits_locked(self, nbytes: int) -> bool:
+        return self.capacity <= 0 or self.in_use == 0 or self.in_use + nbytes <= self.capacity
+
+    def _grant_locked(self, nbytes: int, label: str) -> Lease:
+        self.in_use += nbytes
+        self.peak = max(self.peak, self.in_use)
+        self.admitted += 1
+        self.by_label[label] = self.by_label.get(label, 0) + nbytes
+        return Lease(self, nbytes, label)
+
+    def _release(self, lease: Lease):
+        with self._cond:
+            self.in_use -= lease.nbytes
+            self.by_label[lease.label] -= lease.nbytes
+            if not self.by_label[lease.label]:
+                del self.by_label[lease.label]
+            self._notify_locked()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "capacity_bytes": self.capacity,
+                "in_use_bytes": self.in_use,
+                "peak_bytes": self.peak,
+                "waiting": len(self._queue),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "in_use_by_label": dict(self.by_label)
+            }
+
+
+def _buffers_size(buffers: Iterable) -> int:
+    return sum(len(b) for b in buffers if b is not None)
+
+
+def chat_cost(buffers: Iterable, reference_images: Optional[str] = None) -> int:
+    """Uploads, plus the history images the chat payload reads back from disk."""
+    total = _buffers_size(buffers) + REQUEST_OVERHEAD_BYTES
+    if reference_images:
+        total += len(reference_images)
+        try:
+            ref_urls = json.loads(reference_images)
+        except (json.JSONDecodeError, ValueError):
+            ref_urls = []
+        for ref_url in ref_urls if isinstance(ref_urls, list) else []:
+            if isinstance(ref_url, str) and ref_url.startswith("/static/"):
+                path = os.path.join(config.STATIC_DIR, ref_url[len("/static/"):])
+                if os.path.isfile(path):
+                    total += os.path.getsize(path)
+    return total
+
+
+def generation_cost(buffers: Iterable, model: str, ratio: str) -> int:
+    """Uploads (and mask), plus the copies of a result at the model's resolution tier."""
+    size_config, _ = resolution_tier(model or "", ratio or "")
+    result_bytes = size_config["width"] * size_config["height"] * RESULT_BYTES_PER_PIXEL
+    return int(_buffers_size(buffers) + result_bytes * RESULT_COPIES) + REQUEST_OVERHEAD_BYTES
+
+
+byte_budget = ByteBudget(int(config.BYTE_BUDGET_MB * MB))
@@ -0,0 +1,149 @@
+import contextvars
+import socket
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class TaskCancelled(BaseException):
+    """Raised inside a cancelled task's stages.
+
+    A BaseException, like asyncio.CancelledError, so the services' broad
+    `except Exception` fallbacks do not turn a cancel into a degraded result.
+    """
+
+
+class CancelToken:
+    """Cancellation of one task: stops new upstream attempts and shuts down the ones in flight."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self._sockets = weakref.WeakSet()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+            sockets = list(self._sockets)
+        for sock in sockets:
+            _shutdown(sock)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancel callback failed: {e}")
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """Run callback when cancelled (at once if already cancelled)."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def check(self):
+        if self.cancelled:
+            raise TaskCancelled()
+
+    def track(self, sock):
+        with self._lock:
+            if not self.cancelled:
+                self._sockets.add(sock)
+                return
+        _shutdown(sock)
+
+
+def _shutdown(sock):
+    # Unblocks a thread waiting in send/recv on it; the socket is closed by its owner
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("cancel_token", default=None)
+
+
+def current_cancel_token() -> Optional[CancelToken]:
+    return _current.get()
+
+
+@contextmanager
+def cancel_scope(token: Optional[CancelToken]) -> Iterator[Optional[CancelToken]]:
+    ctx_token = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(ctx_token)
+
+
+def check_cancelled():
+    token = current_cancel_token()
+    if token is not None:
+        token.check()
+
+
+class _AbortableHTTPConnection(HTTPConnection):
+    def connect(self):
+        super().connect()
+        token = current_cancel_token()
+        if token is not None:
+            token.track(self.sock)
+
+
+class _AbortableHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        super().connect()
+        token = current_cancel_token()
+        if token is not None:
+            token.track(self.sock)
+
+
+class _AbortableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _AbortableHTTPConnection
+
+
+class _AbortableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _AbortableHTTPSConnection
+
+
+POOL_CLASSES = {"http": _AbortableHTTPConnectionPool, "https": _AbortableHTTPSConnectionPool}
+
+
+class AbortableAdapter(HTTPAdapter):
+    """Registers every connection it opens with the current task's CancelToken."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        # SOCKS managers bring their own connection classes
+        if not proxy.lower().startswith("socks"):
+            manager.pool_classes_by_scheme = POOL_CLASSES
+        return manager
+
+
+def abortable_request(method: str, url: str, **kwargs) -> requests.Response:
+    """requests.request(), except that cancelling the current task aborts it mid-flight with TaskCancelled."""
+    check_cancelled()
+    with requests.Session() as session:
+        adapter = AbortableAdapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        try:
+            return session.request(method=method, url=url, **kwargs)
+        except Exception:
+            # The connection error a cancel causes is not worth a retry
+            check_cancelled()
+            raise
@@ -2,32 +2,20 @@
 
 import requests
 import json
-import base64
 from typing import List, Optional
 from config import config
 from prompts_v3 import UNIFIED_CONTROLLER_PROMPT, DNA_ANALYZER_PROMPT, IMAGE_COMPILER_PROMPT
+from services.upstream_body import data_url, json_body
 
 import os
 import time
 
 class ChatService:
-    def chat(self, messages: List[dict], visual_dna: Optional[str] = None, product_identity: Optional[str] = None, reference_images: Optional[str] = None, api_key: Optional[str] = None, api_url: Optional[str] = None, model: Optional[str] = None, images: Optional[List[bytes]] = None, image_model: Optional[str] = None, thought_signature: Optional[str] = None, thinking_level: Optional[str] = None, grounding: bool = False, track_a_images: Optional[List[bytes]] = None, track_b_images: Optional[List[bytes]] = None) -> dict:
-        # Robust API Key & URL selection: Prefer .env if provided value is placeholder or empty
-        is_placeholder_key = api_key and ("REPLACE" in api_key or "sk-test" in api_key)
-        use_backend_key = not api_key or not api_key.strip() or is_placeholder_key
-        
-        final_api_key = config.BANANA_API_KEY if use_backend_key else api_key.strip()
-        
-        is_placeholder_url = api_url and "comfly.chat" in api_url and "bltcy" in config.BANANA_API_URL
-        use_backend_url = not api_url or not api_url.strip() or is_placeholder_url
-        
-        url = f"{config.BANANA_API_URL.rstrip('/')}/chat/completions" if use_backend_url else f"{api_url.rstrip('/')}/chat/completions"
-
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {final_api_key}"
-        }
+    def build_payload(self, messages: List[dict], visual_dna: Optional[str] = None, product_identity: Optional[str] = None, reference_images: Optional[str] = None, model: Optional[str] = None, images: Optional[List[bytes]] = None, image_model: Optional[str] = None, thought_signature: Optional[str] = None, thinking_level: Optional[str] = None, grounding: bool = False, track_a_images: Optional[List[bytes]] = None, track_b_images: Optional[List[bytes]] = None) -> dict:
+        """The /chat/completions request body: system prompt, history and the last turn's images.
 
+        Images stay raw bytes (Base64Image) until json_body() streams them out.
+        """
         # Construct system prompt
         if visual_dna:
             # Step 2: Generation Mode - Provide Controller with DNA Context and Compiler Instructions
@@ -61,23 +49,13 @@ class ChatService:
                         ref_image_payloads.append({"type": "image_url", "image_url": {"url": ref_url}})
                     elif ref_url.startswith("/static/"):
                         # Local file, read and convert to base64
-                        # Assuming running from backend directory or root
-                        # Need to find the absolute path. 
-                        # backend/services/chat_service.py -> backend/services -> backend -> root -> static
-                        
-                        # Get project root
-                        current_file = os.path.abspath(__file__)
-                        backend_dir = os.path.dirname(os.path.dirname(current_file))
-                        project_root = os.path.dirname(backend_dir)
-                        
-                        # Remove leading slash from url
-                        rel_path = ref_url.lstrip('/')
-                        file_path = os.path.join(project_root, rel_path)
+                        # /static/ is served from config.STATIC_DIR
+                        rel_path = ref_url[len('/static/'):]
+                        file_path = os.path.join(config.STATIC_DIR, rel_path)
                         
                         if os.path.exists(file_path):
                             with open(file_path, "rb") as img_file:
-                                b64_data = base64.b64encode(img_file.read()).decode('utf-8')
-                                ref_image_payloads.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_data}"}})
+                                ref_image_payloads.append({"type": "image_url", "image_url": {"url": data_url(img_file.read())}})
             except Exception as e:
                 print(f"Error processing reference images: {e}")
 
@@ -92,30 +70,27 @@ class ChatService:
                 # Add uploaded images
                 if images:
                     for img_bytes in images:
-                        b64_img = base64.b64encode(img_bytes).decode('utf-8')
                         content.append({
                             "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{b64_img}"}
+                            "image_url": {"url": data_url(img_bytes)}
                         })
                 
                 # Add Track A images (Appearance)
                 if track_a_images:
                     content.append({"type": "text", "text": "\n[ASSET TRACK A: Product Appearance/Angles]"})
                     for img_bytes in track_a_images:
-                        b64_img = base64.b64encode(img_bytes).decode('utf-8')
                         content.append({
                             "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{b64_img}"}
+                            "image_url": {"url": data_url(img_bytes)}
                         })
 
                 # Add Track B images (Functional/Internal)
                 if track_b_images:
                     content.append({"type": "text", "text": "\n[ASSET TRACK B: Functional/Internal/Usage]"})
                     for img_bytes in track_b_images:
-                        b64_img = base64.b64encode(img_bytes).decode('utf-8')
                         content.append({
                             "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{b64_img}"}
+                            "image_url": {"url": data_url(img_bytes)}
                         })
 
                 # Add reference images
@@ -151,6 +126,31 @@ class ChatService:
                 }
             ]
 
+        return payload
+
+    def chat(self, messages: List[dict], visual_dna: Optional[str] = None, product_identity: Optional[str] = None, reference_images: Optional[str] = None, api_key: Optional[str] = None, api_url: Optional[str] = None, model: Optional[str] = None, images: Optional[List[bytes]] = None, image_model: Optional[str] = None, thought_signature: Optional[str] = None, thinking_level: Optional[str] = None, grounding: bool = False, track_a_images: Optional[List[bytes]] = None, track_b_images: Optional[List[bytes]] = None) -> dict:
+        # Robust API Key & URL selection: Prefer .env if provided value is placeholder or empty
+        is_placeholder_key = api_key and ("REPLACE" in api_key or "sk-test" in api_key)
+        use_backend_key = not api_key or not api_key.strip() or is_placeholder_key
+        
+        final_api_key = config.BANANA_API_KEY if use_backend_key else api_key.strip()
+        
+        is_placeholder_url = api_url and "comfly.chat" in api_url and "bltcy" in config.BANANA_API_URL
+        use_backend_url = not api_url or not api_url.strip() or is_placeholder_url
+        
+        url = f"{config.BANANA_API_URL.rstrip('/')}/chat/completions" if use_backend_url else f"{api_url.rstrip('/')}/chat/completions"
+
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {final_api_key}"
+        }
+
+        payload = self.build_payload(
+            messages, visual_dna, product_identity, reference_images, model, images, image_model,
+            thought_signature, thinking_level, grounding, track_a_images, track_b_images
+        )
+
+        body = json_body(payload)
         last_error = None
         for attempt in range(1, 4):
             try:
@@ -158,7 +158,7 @@ class ChatService:
                 response = requests.post(
                     url,
                     headers=headers,
-                    json=payload,
+                    data=body.reader(),
                     timeout=60
                 )
                 response.raise_for_status()
@@ -0,0 +1,264 @@
+import asyncio
+import base64
+import hashlib
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, Optional
+from config import config
+
+# Buffers at least this large cross the process boundary through shared memory instead of a pipe
+SHM_MIN_BYTES = 64 * 1024
+
+
+def sha1_hex(data) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def sha256_hex(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def b64encode(data) -> bytes:
+    return base64.b64encode(data)
+
+
+def b64decode(data) -> bytes:
+    return base64.b64decode(data)
+
+
+class SharedBuffer:
+    """Picklable reference to size bytes at the start of a shared memory block."""
+
+    __slots__ = ("name", "size")
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+    def __getstate__(self):
+        return self.name, self.size
+
+    def __setstate__(self, state):
+        self.name, self.size = state
+
+
+def _share(data) -> shared_memory.SharedMemory:
+    view = memoryview(data).cast("B")
+    block = shared_memory.SharedMemory(create=True, size=max(1, view.nbytes))
+    block.buf[:view.nbytes] = view
+    return block
+
+
+def _init_worker():
+    # Ctrl+C reaches the whole process group; the parent shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_in_worker(fn: Callable, args: tuple):
+    """Worker side: map shared buffers in, run fn, hand a large bytes result back the same way."""
+    started = time.time()
+    blocks = []
+    views = []
+    try:
+        call_args = []
+        for arg in args:
+            if isinstance(arg, SharedBuffer):
+                block = shared_memory.SharedMemory(name=arg.name)
+                blocks.append(block)
+                views.append(block.buf[:arg.size])
+                call_args.append(views[-1])
+            else:
+                call_args.append(arg)
+        result = fn(*call_args)
+    finally:
+        for view in views:
+            view.release()
+        for block in blocks:
+            block.close()
+    if isinstance(result, (bytes, bytearray)) and len(result) >= SHM_MIN_BYTES:
+        block = _share(result)
+        # The parent unlinks it after copying the result out
+        shared = SharedBuffer(block.name, len(result))
+        block.close()
+        result = shared
+    return result, started, time.time() - started
+
+
+class CpuPool:
+    """Process pool for CPU-bound image work: base64, hashing, resizing and re-encoding.
+
+    Keeps that work off the event loop and out of the GIL the request threads
+    share. Jobs whose buffers total less than CPU_POOL_MIN_KB run inline in the
+    caller, where the hand-off would cost more than the work. With
+    CPU_POOL_WORKERS=0 every job runs inline. Workers start on first use (or at
+    app startup) from a clean forkserver process, never forked from the
+    threaded server.
+    """
+
+    def __init__(self, workers: int, min_bytes: int):
+        self.workers = workers
+        self.min_bytes = min_bytes
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.inline = 0
+        self.completed = 0
+        self.failed = 0
+        self.queue_seconds = 0.0
+        self.run_seconds = 0.0
+        self.shared_bytes = 0
+
+    def start(self):
+        with self._lock:
+            self._executor_locked()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _executor_locked(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers > 0 and self._executor is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            if context.get_start_method() == "forkserver":
+                # Workers need this module, not the app that is __main__
+                context.set_forkserver_preload([__name__])
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker)
+        return self._executor
+
+    def submit(self, fn: Callable, *args, min_bytes: Optional[int] = None) -> Future:
+        """Run fn(*args) (fn importable at module level); bytes-like args are handed over zero-pickle."""
+        size = sum(_buffer_size(arg) or 0 for arg in args)
+        threshold = self.min_bytes if min_bytes is None else min_bytes
+        with self._lock:
+            executor = self._executor_locked() if size >= threshold else None
+            if executor is None:
+                self.inline += 1
+        if executor is None:
+            return _run_inline(fn, args)
+
+        blocks: List[shared_memory.SharedMemory] = []
+        sent_args = []
+        for arg in args:
+            arg_size = _buffer_size(arg)
+            # mmaps and memoryviews cannot be pickled at all
+            if arg_size is not None and (arg_size >= SHM_MIN_BYTES or not isinstance(arg, (bytes, bytearray))):
+                block = _share(arg)
+                blocks.append(block)
+                sent_args.append(SharedBuffer(block.name, arg_size))
+            else:
+                sent_args.append(arg)
+
+        outer: Future = Future()
+        submitted_at = time.time()
+        with self._lock:
+            self.submitted += 1
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+            self.shared_bytes += sum(block.size for block in blocks)
+        try:
+            inner = executor.submit(_run_in_worker, fn, tuple(sent_args))
+        except (BrokenProcessPool, RuntimeError):
+            self._finish_failed(blocks, executor)
+            return _run_inline(fn, args)
+        inner.add_done_callback(lambda f: self._finish(f, outer, blocks, submitted_at, executor))
+        return outer
+
+    def run(self, fn: Callable, *args, min_bytes: Optional[int] = None) -> Any:
+        """Blocking submit(); for worker threads."""
+        return self.submit(fn, *args, min_bytes=min_bytes).result()
+
+    async def run_async(self, fn: Callable, *args, min_bytes: Optional[int] = None) -> Any:
+        """submit() awaited without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(fn, *args, min_bytes=min_bytes))
+
+    def _finish(self, inner: Future, outer: Future, blocks, submitted_at: float, executor):
+        _release(blocks)
+        try:
+            result, started, run_seconds = inner.result()
+            if isinstance(result, SharedBuffer):
+                block = shared_memory.SharedMemory(name=result.name)
+                try:
+                    with block.buf[:result.size] as view:
+                        result = bytes(view)
+                finally:
+                    block.close()
+                    block.unlink()
+        except BaseException as e:
+            with self._lock:
+                self.pending -= 1
+                self.failed += 1
+                if isinstance(e, BrokenProcessPool) and self._executor is executor:
+                    # A worker died; the next job starts a fresh pool
+                    self._executor = None
+            outer.set_exception(e)
+            return
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+            self.queue_seconds += max(0.0, started - submitted_at)
+            self.run_seconds += run_seconds
+        outer.set_result(result)
+
+    def _finish_failed(self, blocks, executor):
+        _release(blocks)
+        with self._lock:
+            self.pending -= 1
+            self.failed += 1
+            if self._executor is executor:
+                self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            finished = self.completed or 1
+            return {
+                "workers": self.workers,
+                "running": self._executor is not None,
+                "queue_depth": self.pending,
+                "max_queue_depth": self.max_pending,
+                "submitted": self.submitted,
+                "inline": self.inline,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_queue_ms": round(self.queue_seconds / finished * 1000, 2),
+                "avg_run_ms": round(self.run_seconds / finished * 1000, 2),
+                "shared_bytes": self.shared_bytes
+            }
+
+
+def _buffer_size(arg) -> Optional[int]:
+    """Size in bytes of a bytes-like arg (bytes, bytearray, memoryview, mmap); None otherwise."""
+    if isinstance(arg, (bytes, bytearray)):
+        return len(arg)
+    try:
+        with memoryview(arg) as view:
+            return view.nbytes
+    except TypeError:
+        return None
+
+
+def _release(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def _run_inline(fn: Callable, args: tuple) -> Future:
+    future: Future = Future()
+    try:
+        future.set_result(fn(*args))
+    except BaseException as e:
+        future.set_exception(e)
+    return future
+
+
+cpu_pool = CpuPool(config.CPU_POOL_WORKERS, int(config.CPU_POOL_MIN_KB * 1024))
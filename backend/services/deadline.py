@@ -0,0 +1,78 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# An upstream attempt with less time than this left is not worth starting
+MIN_ATTEMPT_SECONDS = 5.0
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """The point after which nobody is waiting for a task's result any more.
+
+    Set for the current context with deadline_scope(); the bulkhead threads
+    inherit it, so upstream calls deep in the services size each attempt by
+    what is left (attempt_timeout) and stop retrying once it runs out
+    (backoff).
+    """
+
+    def __init__(self, expires_at: float):
+        # time.monotonic() based
+        self.expires_at = expires_at
+
+    @classmethod
+    def after(cls, seconds: float, started_at: Optional[float] = None) -> "Deadline":
+        """Deadline `seconds` after started_at (a time.time() timestamp, default now)."""
+        elapsed = max(0.0, time.time() - started_at) if started_at else 0.0
+        return cls(time.monotonic() + seconds - elapsed)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def shortened(self, reserve_seconds: float) -> "Deadline":
+        """An earlier deadline for one stage, keeping reserve_seconds for the stages after it."""
+        return Deadline(self.expires_at - reserve_seconds)
+
+    def timeout(self, cap: float) -> float:
+        """Timeout for one attempt: cap, or what is left when less; DeadlineExceeded when too little is."""
+        remaining = self.remaining()
+        if remaining < MIN_ATTEMPT_SECONDS:
+            raise DeadlineExceeded(f"Deadline exceeded ({remaining:.1f}s left)")
+        return min(cap, remaining)
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current.get()
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]) -> Iterator[Optional[Deadline]]:
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def attempt_timeout(cap: float) -> float:
+    """Per-attempt timeout for an upstream call under the current deadline (cap when there is none)."""
+    deadline = current_deadline()
+    return cap if deadline is None else deadline.timeout(cap)
+
+
+def backoff(seconds: float):
+    """Sleep before a retry, unless no attempt could start after it before the deadline."""
+    deadline = current_deadline()
+    if deadline is not None and deadline.remaining() < seconds + MIN_ATTEMPT_SECONDS:
+        raise DeadlineExceeded(f"Deadline exceeded, not retrying ({deadline.remaining():.1f}s left)")
+    time.sleep(seconds)
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+from config import config
+from services.history_service import history_service
+
+# Stored (uncompressed) entries: PNG/JPEG/WebP gain nothing from deflate, and
+# stored sizes make the archive length known before a single byte is read.
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+DATA_DESCRIPTOR = struct.Struct("<4s3L")
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+ZIP64_OFFSET_EXTRA = struct.Struct("<2HQ")
+ZIP64_END = struct.Struct("<4sQ2H2L4Q")
+ZIP64_LOCATOR = struct.Struct("<4sLQL")
+END_RECORD = struct.Struct("<4s4H2LH")
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+ZIP32_LIMIT = 0xFFFFFFFF
+READ_CHUNK = 256 * 1024
+
+
+def _dos_datetime(timestamp_ms: int) -> Tuple[int, int]:
+    t = time.gmtime(max(timestamp_ms / 1000, 315532800))  # ZIP dates start in 1980
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipExport:
+    """A deterministic ZIP of history entries, streamed with constant memory.
+
+    Every member is stored with a data descriptor, so the layout (and total
+    size) is fixed by the member list alone. CRCs are computed while the data
+    streams; a byte range that starts past a member reads it once just for its
+    CRC. The same member list always yields the same bytes, which is what makes
+    range requests resumable.
+    """
+
+    def __init__(self, members: List[Dict[str, Any]]):
+        # member: {"name", "size", "timestamp", and "path" or "data"}
+        self.members = members
+        self._crcs: Dict[int, int] = {}
+        self._layout()
+
+    def _layout(self):
+        offset = 0
+        self.segments: List[Tuple[int, int, str, int]] = []  # (start, length, kind, member index)
+        for idx, member in enumerate(self.members):
+            member["name_bytes"] = member["name"].encode("utf-8")
+            member["offset"] = offset
+            for kind, length in (
+                ("local", LOCAL_HEADER.size + len(member["name_bytes"])),
+                ("data", member["size"]),
+                ("descriptor", DATA_DESCRIPTOR.size)
+            ):
+                self.segments.append((offset, length, kind, idx))
+                offset += length
+
+        self.central_offset = offset
+        central_size = 0
+        for member in self.members:
+            extra = ZIP64_OFFSET_EXTRA.size if member["offset"] >= ZIP32_LIMIT else 0
+            central_size += CENTRAL_HEADER.size + len(member["name_bytes"]) + extra
+        self.central_size = central_size
+        self.zip64 = len(self.members) >= 0xFFFF or self.central_offset >= ZIP32_LIMIT or central_size >= ZIP32_LIMIT
+        self.segments.append((offset, central_size, "central", -1))
+        offset += central_size
+        end_size = END_RECORD.size + ((ZIP64_END.size + ZIP64_LOCATOR.size) if self.zip64 else 0)
+        self.segments.append((offset, end_size, "end", -1))
+        self.total_size = offset + end_size
+
+    @property
+    def etag(self) -> str:
+        digest = hashlib.sha1()
+        for member in self.members:
+            version = member["mtime_ns"] if "path" in member else zlib.crc32(member["data"])
+            digest.update(f"{member['name']}\0{member['size']}\0{version}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def iter_bytes(self, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Yield bytes [start, end] (inclusive, like an HTTP range) of the archive."""
+        end = self.total_size - 1 if end is None else min(end, self.total_size - 1)
+        for seg_start, length, kind, idx in self.segments:
+            seg_end = seg_start + length - 1
+            if length == 0 or seg_end < start:
+                continue
+            if seg_start > end:
+                break
+            lo = max(start, seg_start) - seg_start
+            hi = min(end, seg_end) - seg_start + 1
+            if kind == "data":
+                yield from self._data(idx, lo, hi)
+            else:
+                yield self._render(kind, idx)[lo:hi]
+
+    def _render(self, kind: str, idx: int) -> bytes:
+        if kind == "local":
+            member = self.members[idx]
+            mod_time, mod_date = _dos_datetime(member["timestamp"])
+            return LOCAL_HEADER.pack(
+                b"PK\x03\x04", 20, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, 0, mod_time, mod_date,
+                0, 0, 0, len(member["name_bytes"]), 0
+            ) + member["name_bytes"]
+        if kind == "descriptor":
+            member = self.members[idx]
+            return DATA_DESCRIPTOR.pack(b"PK\x07\x08", self._crc(idx), member["size"], member["size"])
+        if kind == "central":
+            return b"".join(self._central_header(i) for i in range(len(self.members)))
+        return self._end_records()
+
+    def _central_header(self, idx: int) -> bytes:
+        member = self.members[idx]
+        mod_time, mod_date = _dos_datetime(member["timestamp"])
+        extra = b""
+        offset = member["offset"]
+        if offset >= ZIP32_LIMIT:
+            extra = ZIP64_OFFSET_EXTRA.pack(0x0001, 8, offset)
+            offset = ZIP32_LIMIT
+        version = 45 if extra else 20
+        return CENTRAL_HEADER.pack(
+            b"PK\x01\x02", (3 << 8) | version, version, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, 0, mod_time, mod_date,
+            self._crc(idx), member["size"], member["size"],
+            len(member["name_bytes"]), len(extra), 0, 0, 0, 0o100644 << 16, offset
+        ) + member["name_bytes"] + extra
+
+    def _end_records(self) -> bytes:
+        count = len(self.members)
+        records = b""
+        if self.zip64:
+            zip64_end_offset = self.central_offset + self.central_size
+            records += ZIP64_END.pack(b"PK\x06\x06", ZIP64_END.size - 12, 45, 45, 0, 0, count, count, self.central_size, self.central_offset)
+            records += ZIP64_LOCATOR.pack(b"PK\x06\x07", 0, zip64_end_offset, 1)
+        return records + END_RECORD.pack(
+            b"PK\x05\x06", 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(self.central_size, ZIP32_LIMIT), min(self.central_offset, ZIP32_LIMIT), 0
+        )
+
+    def _data(self, idx: int, lo: int, hi: int) -> Iterator[bytes]:
+        member = self.members[idx]
+        if "data" in member:
+            if lo == 0 and hi == member["size"]:
+                self._crcs[idx] = zlib.crc32(member["data"])
+            yield member["data"][lo:hi]
+            return
+        crc = 0
+        position = 0
+        with open(member["path"], "rb") as f:
+            # Bytes before the range still pass through the CRC, but are not sent
+            while position < hi:
+                chunk = f.read(min(READ_CHUNK, member["size"] - position))
+                if not chunk:
+                    raise IOError(f"{member['path']} shrank while exporting")
+                crc = zlib.crc32(chunk, crc)
+                chunk_end = position + len(chunk)
+                if chunk_end > lo:
+                    yield chunk[max(lo - position, 0):min(hi, chunk_end) - position]
+                position = chunk_end
+        if hi == member["size"]:
+            self._crcs[idx] = crc
+
+    def _crc(self, idx: int) -> int:
+        if idx not in self._crcs:
+            # Member lies before the requested range: read it once for its CRC
+            member = self.members[idx]
+            if "data" in member:
+                self._crcs[idx] = zlib.crc32(member["data"])
+            else:
+                crc = 0
+                with open(member["path"], "rb") as f:
+                    for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+                        crc = zlib.crc32(chunk, crc)
+                self._crcs[idx] = crc
+        return self._crcs[idx]
+
+
+def _static_path(url: str) -> Optional[str]:
+    """Filesystem path of a /static/... URL, or None if it would leave static/."""
+    if not url or not url.startswith("/static/"):
+        return None
+    parts = url.split("?", 1)[0].lstrip("/").split("/")
+    if ".." in parts:
+        return None
+    return os.path.join(config.STATIC_DIR, *parts[1:])
+
+
+class ExportTooLarge(ValueError):
+    """More entries match than one export may hold."""
+
+
+def build_history_export(ids: Optional[List[int]] = None, max_entries: Optional[int] = None, **filters) -> ZipExport:
+    """One folder per entry: <date>/<id>/image.png, original_<n>.<ext> and metadata.json.
+
+    The member list (with every entry's metadata) stays in memory while the
+    archive streams, so a selection of more than max_entries is refused.
+    """
+    rows = history_service.select(ids=ids, limit=None if max_entries is None else max_entries + 1, **filters)
+    if max_entries is not None and len(rows) > max_entries:
+        raise ExportTooLarge(f"More than {max_entries} entries match; narrow the filters or the date range")
+    members = []
+    for row in rows:
+        day = time.strftime("%Y-%m-%d", time.gmtime(row["timestamp"] / 1000))
+        folder = f"{day}/{row['id']}"
+        files = history_service.files_for(row["id"], row["path"])
+
+        sources = [("image.png", files["image"])]
+        for n, url in enumerate(json.loads(row["original_images"] or "[]")):
+            ext = os.path.splitext(url.split("?", 1)[0])[1] or ".bin"
+            sources.append((f"original_{n}{ext}", _static_path(url)))
+        for name, path in sources:
+            try:
+                stat_result = os.stat(path) if path else None
+            except FileNotFoundError:
+                stat_result = None
+            if stat_result:
+                members.append({
+                    "name": f"{folder}/{name}",
+                    "path": path,
+                    "size": stat_result.st_size,
+                    "mtime_ns": stat_result.st_mtime_ns,
+                    "timestamp": row["timestamp"]
+                })
+
+        # From the index, so entries still carry metadata even if the JSON file is gone.
+        # The session (a client id or IP) is internal and stays out of customer downloads.
+        metadata = json.loads(row["metadata"] or "{}")
+        metadata.pop("session", None)
+        metadata = json.dumps(metadata, ensure_ascii=False, indent=2).encode("utf-8")
+        members.append({
+            "name": f"{folder}/metadata.json",
+            "data": metadata,
+            "size": len(metadata),
+            "timestamp": row["timestamp"]
+        })
+    return ZipExport(members)
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+from services.cpu_pool import cpu_pool, sha1_hex
+
+
+def hash_image(img_bytes: bytes) -> str:
+    """SHA1 of the raw upload, same digest the prompt_debug.log already records."""
+    return cpu_pool.run(sha1_hex, img_bytes)
+
+
+def hash_images(image_bytes_list: Optional[List[bytes]]) -> List[str]:
+    futures = [cpu_pool.submit(sha1_hex, img) for img in (image_bytes_list or [])]
+    return [future.result() for future in futures]
+
+
+async def hash_images_async(image_bytes_list: Optional[List[bytes]]) -> List[str]:
+    """hash_images for the event loop: waits on the CPU pool without blocking it."""
+    return list(await asyncio.gather(*(cpu_pool.run_async(sha1_hex, img) for img in (image_bytes_list or []))))
+
+
+def fingerprint_from_dna(visual_dna: Optional[str], product_identity: Optional[str]) -> dict:
+    """Map the chat-stage Visual DNA onto the PRODUCT_LOCK_PROMPT fingerprint keys."""
+    fingerprint = {}
+    if product_identity and product_identity.strip():
+        fingerprint["unified_desc"] = product_identity.strip()
+    if visual_dna and visual_dna.strip():
+        fingerprint["dna_summary"] = visual_dna.strip()
+    return fingerprint
+
+
+def extract_dna_from_chat_response(content: str) -> dict:
+    """Pull visual_dna_v2 / product_identity_en out of a Director Agent reply.
+
+    Mirrors the frontend parser: find the JSON block containing "proposal" and
+    read its "analysis" section. Returns {} when nothing usable is found.
+    """
+    if not content:
+        return {}
+    match = re.search(r'\{[\s\S]*"proposal"[\s\S]*\}', content)
+    if not match:
+        return {}
+    try:
+        data = json.loads(match.group(0))
+    except (json.JSONDecodeError, ValueError):
+        return {}
+    analysis = data.get("analysis") if isinstance(data, dict) else None
+    if not isinstance(analysis, dict):
+        return {}
+    return fingerprint_from_dna(
+        str(analysis.get("visual_dna_v2") or ""),
+        str(analysis.get("product_identity_en") or "")
+    )
+
+
+def merge_fingerprints(fingerprints: List[dict]) -> dict:
+    """Merge per-image fingerprints into the unified PRODUCT_LOCK_PROMPT shape without an LLM call."""
+    fingerprints = [fp for fp in fingerprints if fp]
+    if not fingerprints:
+        return {}
+    if len(fingerprints) == 1:
+        return dict(fingerprints[0])
+
+    def unique_values(key: str) -> List[str]:
+        values = []
+        for fp in fingerprints:
+            value = str(fp.get(key) or "").strip()
+            if value and value not in values:
+                values.append(value)
+        return values
+
+    descs = unique_values("unified_desc")
+    if len(descs) > 1:
+        unified_desc = " ".join(f"[View {i + 1}] {d}" for i, d in enumerate(descs))
+    else:
+        unified_desc = descs[0] if descs else ""
+
+    # Material keywords are comma/、 separated lists, so merge them term by term
+    material_terms = []
+    for value in unique_values("materials"):
+        for term in re.split(r"[,，、;；]", value):
+            term = term.strip()
+            if term and term not in material_terms:
+                material_terms.append(term)
+
+    summaries = unique_values("dna_summary")
+    return {
+        "unified_desc": unified_desc,
+        "materials": ", ".join(material_terms),
+        "branding": "; ".join(unique_values("branding")),
+        "dna_summary": summaries[0] if summaries else ""
+    }
+
+
+class FingerprintCache:
+    def __init__(self, max_entries: int = 256, ttl_seconds: int = 6 * 3600, max_image_entries: int = 1024):
+        # In-memory storage, keyed by fingerprint_id
+        # Each entry remembers the image hashes it was derived from
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # Per-image fingerprints keyed by image hash (LRU), used by parallel extraction
+        self.image_entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.max_image_entries = max_image_entries
+        self._lock = threading.Lock()
+
+    def get_image(self, image_hash: str) -> Optional[dict]:
+        with self._lock:
+            fingerprint = self.image_entries.get(image_hash)
+            if fingerprint is not None:
+                self.image_entries.move_to_end(image_hash)
+            return fingerprint
+
+    def put_image(self, image_hash: str, fingerprint: dict):
+        if not fingerprint:
+            return
+        with self._lock:
+            self.image_entries[image_hash] = fingerprint
+            self.image_entries.move_to_end(image_hash)
+            while len(self.image_entries) > self.max_image_entries:
+                self.image_entries.popitem(last=False)
+
+    def put(self, fingerprint: dict, image_hashes: List[str], source: str = "chat") -> Optional[str]:
+        if not fingerprint or not image_hashes:
+            return None
+        fingerprint_id = uuid.uuid4().hex
+        with self._lock:
+            self._evict_locked()
+            self.entries[fingerprint_id] = {
+                "id": fingerprint_id,
+                "fingerprint": fingerprint,
+                "image_hashes": list(image_hashes),
+                "source": source,
+                "created_at": time.time()
+            }
+        return fingerprint_id
+
+    def get(self, fingerprint_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self.entries.get(fingerprint_id)
+            if entry and time.time() - entry["created_at"] > self.ttl_seconds:
+                del self.entries[fingerprint_id]
+                return None
+            return entry
+
+    def resolve(self, image_hashes: List[str], fingerprint_id: Optional[str] = None, inline_fingerprint: Optional[dict] = None, inline_hashes: Optional[List[str]] = None) -> Optional[dict]:
+        """Return a reusable fingerprint for these images, or None if it cannot be trusted.
+
+        A fingerprint is only reused when every image sent to /api/generate is one
+        of the images it was derived from.
+        """
+        if not image_hashes:
+            return None
+
+        if fingerprint_id:
+            entry = self.get(fingerprint_id)
+            if entry and self._covers(entry["image_hashes"], image_hashes):
+                return entry["fingerprint"]
+
+        if inline_fingerprint and inline_hashes and self._covers(inline_hashes, image_hashes):
+            return inline_fingerprint
+
+        return None
+
+    @staticmethod
+    def _covers(source_hashes: List[str], image_hashes: List[str]) -> bool:
+        return set(image_hashes).issubset(set(source_hashes))
+
+    def _evict_locked(self):
+        now = time.time()
+        expired = [fid for fid, e in self.entries.items() if now - e["created_at"] > self.ttl_seconds]
+        for fid in expired:
+            del self.entries[fid]
+        while len(self.entries) >= self.max_entries:
+            oldest = min(self.entries, key=lambda fid: self.entries[fid]["created_at"])
+            del self.entries[oldest]
+
+fingerprint_cache = FingerprintCache()
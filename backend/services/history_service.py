@@ -0,0 +1,444 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+from config import config
+
+HISTORY_DIR = os.path.join(config.STATIC_DIR, "history")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    timestamp INTEGER NOT NULL,
+    model TEXT,
+    scenario TEXT,
+    ratio TEXT,
+    original_prompt TEXT,
+    optimized_prompt TEXT,
+    layout_logic TEXT,
+    image_url TEXT,
+    original_images TEXT,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS history_clock (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    last_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_history_model ON history (model, timestamp);
+CREATE INDEX IF NOT EXISTS idx_history_scenario ON history (scenario, timestamp);
+CREATE INDEX IF NOT EXISTS idx_history_ratio ON history (ratio, timestamp);
+"""
+
+# Columns added after the first release of the index; created on startup if missing
+LATER_COLUMNS = {
+    "path": "TEXT",
+    "size_bytes": "INTEGER",
+    "session": "TEXT",
+    "last_accessed": "INTEGER"
+}
+
+# Full-text index over the prompt fields; rowid = history.id
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+    original_prompt, optimized_prompt, layout_logic,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+SEARCH_FIELDS = ("original_prompt", "optimized_prompt", "layout_logic")
+
+# unicode61 does not split CJK runs, so each CJK character is indexed as its own
+# token and queries become phrases of adjacent characters
+CJK_PATTERN = re.compile(r"([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af])")
+
+
+def segment_cjk(text: Optional[str]) -> str:
+    return CJK_PATTERN.sub(r" \1 ", text or "")
+
+
+def build_match_query(query: str) -> str:
+    """Turn a user query into an FTS5 MATCH expression: every term must appear, CJK as phrases."""
+    phrases = []
+    for term in query.split():
+        tokens = segment_cjk(term).split()
+        if tokens:
+            phrase = " ".join(tokens).replace('"', '""')
+            phrases.append(f'"{phrase}"')
+    return " AND ".join(phrases)
+
+
+def entry_stem(timestamp: int, layout: Optional[str] = None) -> str:
+    """Path of an entry relative to static/history, without extension.
+
+    "sharded": YYYY/MM/DD/<2 hex of sha1(ts)>/<ts> (UTC) keeps every directory small.
+    "flat": <ts>, the original layout.
+    """
+    if (layout or config.HISTORY_LAYOUT) == "flat":
+        return str(timestamp)
+    day = time.strftime("%Y/%m/%d", time.gmtime(timestamp / 1000))
+    bucket = hashlib.sha1(str(timestamp).encode("utf-8")).hexdigest()[:2]
+    return f"{day}/{bucket}/{timestamp}"
+
+
+def _date_to_ms(value: str, end_of_day: bool = False) -> int:
+    """Accept YYYY-MM-DD (local time) or a millisecond timestamp."""
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    day = datetime.strptime(value, "%Y-%m-%d")
+    if end_of_day:
+        day = day + timedelta(days=1)
+        return int(day.timestamp() * 1000) - 1
+    return int(day.timestamp() * 1000)
+
+
+class HistoryService:
+    """SQLite index over static/history so listing never scans the directory."""
+
+    def __init__(self, db_path: Optional[str] = None, history_dir: str = HISTORY_DIR):
+        self.history_dir = history_dir
+        self.db_path = db_path or config.HISTORY_DB_PATH
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(history)").fetchall()}
+            for column, column_type in LATER_COLUMNS.items():
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE history ADD COLUMN {column} {column_type}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_session ON history (session, timestamp)")
+            try:
+                self._conn.executescript(FTS_SCHEMA)
+                self.fts_enabled = True
+            except sqlite3.OperationalError as e:
+                # SQLite built without FTS5: search falls back to LIKE scans
+                print(f"History search: FTS5 unavailable ({e}), using LIKE fallback")
+                self.fts_enabled = False
+            self._conn.commit()
+        # id -> last access (ms), flushed to the index in batches; its own lock, never held across a query
+        self._access: Dict[int, int] = {}
+        self._access_lock = threading.Lock()
+        # Ids are allocated on their own connection: the writer keeps batch transactions open on _conn
+        self._clock_lock = threading.Lock()
+        self._clock_conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+
+    def allocate_id(self) -> int:
+        """Next history id: the current millisecond timestamp, or one past the last id any process sharing this index took."""
+        now = int(time.time() * 1000)
+        with self._clock_lock:
+            self._clock_conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._clock_conn.execute("SELECT last_id FROM history_clock WHERE id = 0").fetchone()
+                history_id = max(now, row[0] + 1) if row else now
+                self._clock_conn.execute("INSERT OR REPLACE INTO history_clock (id, last_id) VALUES (0, ?)", (history_id,))
+                self._clock_conn.execute("COMMIT")
+            except Exception:
+                self._clock_conn.execute("ROLLBACK")
+                raise
+        return history_id
+
+    def files_for(self, history_id: int, path: Optional[str] = None) -> Dict[str, str]:
+        """Absolute image / metadata paths of an entry (flat layout when path is unknown)."""
+        stem = os.path.join(self.history_dir, *(path or str(history_id)).split("/"))
+        return {"image": f"{stem}.png", "metadata": f"{stem}.json"}
+
+    def record(self, metadata: Dict[str, Any], image_url: str, original_images: List[str], commit: bool = True, size_bytes: Optional[int] = None):
+        """Index one saved generation (called right after its metadata JSON is written)."""
+        timestamp = int(metadata["timestamp"])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO history (id, timestamp, model, scenario, ratio, original_prompt, optimized_prompt, layout_logic, image_url, original_images, metadata, path, size_bytes, session) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    timestamp,
+                    timestamp,
+                    metadata.get("model"),
+                    metadata.get("scenario"),
+                    metadata.get("ratio"),
+                    metadata.get("original_prompt"),
+                    metadata.get("optimized_prompt"),
+                    metadata.get("layout_logic"),
+                    image_url,
+                    json.dumps(original_images, ensure_ascii=False),
+                    json.dumps(metadata, ensure_ascii=False),
+                    metadata.get("path") or str(timestamp),
+                    size_bytes,
+                    metadata.get("session")
+                )
+            )
+            if self.fts_enabled:
+                self._index_text_locked(timestamp, metadata)
+            if commit:
+                self._conn.commit()
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def touch(self, url_path: str) -> bool:
+        """Note that a history image was served; feeds LRU retention.
+
+        Only buffers in memory, so it is safe on the event loop. Returns True
+        once enough accesses are buffered that the caller should run
+        flush_access() (off the loop).
+        """
+        stem = os.path.splitext(os.path.basename(url_path))[0]
+        if not stem.isdigit():
+            return False
+        with self._access_lock:
+            self._access[int(stem)] = int(time.time() * 1000)
+            return len(self._access) >= 500
+
+    def flush_access(self):
+        with self._access_lock:
+            pending, self._access = self._access, {}
+        if pending:
+            with self._lock:
+                self._conn.executemany("UPDATE history SET last_accessed = ? WHERE id = ?", [(ts, hid) for hid, ts in pending.items()])
+                self._conn.commit()
+
+    def retention_rows(self) -> List[sqlite3.Row]:
+        """Every entry with what retention needs, coldest (least recently used) first."""
+        self.flush_access()
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, timestamp, session, size_bytes, path, metadata, COALESCE(last_accessed, timestamp) AS last_used "
+                "FROM history ORDER BY last_used ASC, id ASC"
+            ).fetchall()
+
+    def delete(self, history_ids: List[int]):
+        with self._lock:
+            for history_id in history_ids:
+                self._conn.execute("DELETE FROM history WHERE id = ?", (history_id,))
+                if self.fts_enabled:
+                    self._conn.execute("DELETE FROM history_fts WHERE rowid = ?", (history_id,))
+            self._conn.commit()
+
+    def update_path(self, history_id: int, path: str, image_url: str, metadata: Dict[str, Any], original_images: Optional[List[str]] = None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE history SET path = ?, image_url = ?, metadata = ? WHERE id = ?",
+                (path, image_url, json.dumps(metadata, ensure_ascii=False), history_id)
+            )
+            if original_images is not None:
+                self._conn.execute(
+                    "UPDATE history SET original_images = ? WHERE id = ?",
+                    (json.dumps(original_images, ensure_ascii=False), history_id)
+                )
+            self._conn.commit()
+
+    def _index_text_locked(self, history_id: int, fields: Dict[str, Any]):
+        self._conn.execute("DELETE FROM history_fts WHERE rowid = ?", (history_id,))
+        self._conn.execute(
+            "INSERT INTO history_fts (rowid, original_prompt, optimized_prompt, layout_logic) VALUES (?, ?, ?, ?)",
+            (history_id,) + tuple(segment_cjk(str(fields.get(f) or "")) for f in SEARCH_FIELDS)
+        )
+
+    def search(self, query: str, cursor: Optional[str] = None, limit: int = 20, model: Optional[str] = None, scenario: Optional[str] = None, ratio: Optional[str] = None) -> Dict[str, Any]:
+        """Ranked full-text search over prompts, keyset-paginated on (score, id).
+
+        next_cursor is "<score>:<id>" of the last item returned, so a deep page
+        costs the same as the first one.
+        """
+        limit = max(1, min(int(limit), 100))
+        after = None
+        if cursor:
+            score, _, last_id = cursor.rpartition(":")
+            after = (float(score), int(last_id))
+        clauses = []
+        params: List[Any] = []
+        for column, value in (("h.model", model), ("h.scenario", scenario), ("h.ratio", ratio)):
+            if value:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+
+        if self.fts_enabled:
+            match = build_match_query(query)
+            if not match:
+                return {"items": [], "next_cursor": None}
+            where = " AND ".join(["history_fts MATCH ?"] + clauses)
+            # Hits in the user's own wording rank above hits in optimized prompts / layout notes
+            ranked = (
+                "SELECT h.*, bm25(history_fts, 3.0, 1.0, 0.5) AS score FROM history_fts "
+                f"JOIN history h ON h.id = history_fts.rowid WHERE {where}"
+            )
+            params = [match] + params
+        else:
+            terms = query.split()
+            if not terms:
+                return {"items": [], "next_cursor": None}
+            for term in terms:
+                clauses.append("(" + " OR ".join(f"h.{f} LIKE ?" for f in SEARCH_FIELDS) + ")")
+                params.extend([f"%{term}%"] * len(SEARCH_FIELDS))
+            ranked = f"SELECT h.*, 0.0 AS score FROM history h WHERE {' AND '.join(clauses)}"
+
+        # Lower bm25 ranks first; ties newest first
+        sql = f"SELECT * FROM ({ranked})"
+        if after:
+            sql += " WHERE score > ? OR (score = ? AND id < ?)"
+            params += [after[0], after[0], after[1]]
+        sql += " ORDER BY score, id DESC LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(sql, params + [limit + 1]).fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        items = []
+        for row in rows:
+            item = self._row_to_item(row)
+            item["score"] = -row["score"] if row["score"] else 0.0
+            items.append(item)
+        return {
+            "items": items,
+            "next_cursor": f"{float(rows[-1]['score'])!r}:{rows[-1]['id']}" if has_more and rows else None
+        }
+
+    def rebuild_search_index(self) -> int:
+        """Re-populate the full-text index from the history table."""
+        if not self.fts_enabled:
+            return 0
+        with self._lock:
+            self._conn.execute("DELETE FROM history_fts")
+            rows = self._conn.execute("SELECT id, original_prompt, optimized_prompt, layout_logic FROM history").fetchall()
+            for row in rows:
+                self._index_text_locked(row["id"], dict(row))
+            self._conn.commit()
+        return len(rows)
+
+    @staticmethod
+    def _filter_clauses(model: Optional[str] = None, scenario: Optional[str] = None, ratio: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None):
+        clauses = []
+        params: List[Any] = []
+        if model:
+            clauses.append("model = ?")
+            params.append(model)
+        if scenario:
+            clauses.append("scenario = ?")
+            params.append(scenario)
+        if ratio:
+            clauses.append("ratio = ?")
+            params.append(ratio)
+        if date_from:
+            clauses.append("timestamp >= ?")
+            params.append(_date_to_ms(date_from))
+        if date_to:
+            clauses.append("timestamp <= ?")
+            params.append(_date_to_ms(date_to, end_of_day=True))
+        return clauses, params
+
+    def list(self, cursor: Optional[str] = None, limit: int = 50, model: Optional[str] = None, scenario: Optional[str] = None, ratio: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None) -> Dict[str, Any]:
+        """Newest first, keyset-paginated: next_cursor is the id of the last item returned."""
+        clauses, params = self._filter_clauses(model, scenario, ratio, date_from, date_to)
+        if cursor:
+            clauses.insert(0, "id < ?")
+            params.insert(0, int(cursor))
+
+        limit = max(1, min(int(limit), 200))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT * FROM history {where} ORDER BY id DESC LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(sql, params + [limit + 1]).fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "items": [self._row_to_item(row) for row in rows],
+            "next_cursor": str(rows[-1]["id"]) if has_more and rows else None
+        }
+
+    def select(self, ids: Optional[List[int]] = None, model: Optional[str] = None, scenario: Optional[str] = None, ratio: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None, limit: Optional[int] = None) -> List[sqlite3.Row]:
+        """Every matching entry (or the oldest limit of them), oldest first (exports)."""
+        clauses, params = self._filter_clauses(model, scenario, ratio, date_from, date_to)
+        if ids:
+            clauses.append(f"id IN ({','.join('?' * len(ids))})")
+            params.extend(ids)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        limit_clause = ""
+        if limit is not None:
+            limit_clause = " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT id, timestamp, path, image_url, original_images, metadata FROM history {where} ORDER BY id ASC{limit_clause}", params
+            ).fetchall()
+
+    def iter_blob_references(self):
+        """Yield every blob hash referenced by an indexed entry (one per reference)."""
+        with self._lock:
+            rows = self._conn.execute("SELECT metadata FROM history").fetchall()
+        for row in rows:
+            try:
+                metadata = json.loads(row["metadata"] or "{}")
+            except ValueError:
+                continue
+            for blob_hash in metadata.get("original_blobs") or []:
+                yield blob_hash
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def backfill(self) -> int:
+        """Index every {timestamp}.json already on disk (flat or sharded). One-time, for pre-index history."""
+        if not os.path.isdir(self.history_dir):
+            return 0
+        indexed = 0
+        for dirpath, dirnames, filenames in os.walk(self.history_dir):
+            dirnames.sort()
+            for name in sorted(filenames):
+                stem, ext = os.path.splitext(name)
+                if ext != ".json" or not stem.isdigit():
+                    continue
+                meta_path = os.path.join(dirpath, name)
+                try:
+                    with open(meta_path, "r", encoding="utf-8") as f:
+                        metadata = json.load(f)
+                except Exception as e:
+                    print(f"History backfill: skipping {name}: {e}")
+                    continue
+                metadata.setdefault("timestamp", int(stem))
+                rel_stem = os.path.relpath(os.path.join(dirpath, stem), self.history_dir).replace(os.sep, "/")
+                metadata.setdefault("path", rel_stem)
+                image_path = os.path.join(dirpath, f"{stem}.png")
+                image_url = f"/static/history/{rel_stem}.png" if os.path.exists(image_path) else ""
+                originals = metadata.get("original_images")
+                if not isinstance(originals, list):
+                    # Pre blob-store layout: {timestamp}_orig_{idx}.jpg next to the metadata
+                    rel_dir = os.path.dirname(rel_stem)
+                    originals = [
+                        f"/static/history/{rel_dir + '/' if rel_dir else ''}{stem}_orig_{idx}.jpg"
+                        for idx in range(int(metadata.get("original_images_count") or 0))
+                    ]
+                size_bytes = os.path.getsize(meta_path) + (os.path.getsize(image_path) if image_url else 0)
+                self.record(metadata, image_url, originals, commit=False, size_bytes=size_bytes)
+                indexed += 1
+        with self._lock:
+            self._conn.commit()
+        return indexed
+
+    @staticmethod
+    def _row_to_item(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "id": str(row["id"]),
+            "timestamp": row["timestamp"],
+            "url": row["image_url"],
+            "thumbnail_url": f"{row['image_url']}?size=thumb" if row["image_url"] else None,
+            "original_prompt": row["original_prompt"],
+            "optimized_prompt": row["optimized_prompt"],
+            "layout_logic": row["layout_logic"],
+            "model": row["model"],
+            "scenario": row["scenario"],
+            "ratio": row["ratio"],
+            "original_images": json.loads(row["original_images"] or "[]")
+        }
+
+history_service = HistoryService()
@@ -0,0 +1,348 @@
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Any, List, Optional
+import requests
+from config import config
+from services.blob_store import blob_store, detect_image_ext
+from services.byte_budget import byte_budget
+from services.cpu_pool import cpu_pool, sha256_hex
+from services.history_service import history_service, entry_stem
+from services.variant_service import variant_service
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+
+def write_file_atomic(path: str, data, fsync: bool = False):
+    """Write bytes (or a list of byte chunks) to a temp file, then rename over the target."""
+    chunks = data if isinstance(data, list) else [data]
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class HistoryWriter:
+    """Write-behind persistence for generation history.
+
+    submit() only computes URLs and keeps the bytes in memory, so the task can be
+    reported done immediately; pending files are served from memory until they
+    land on disk, and stay counted in the byte budget until then. A background thread journals each batch (fsync'd), writes the
+    PNG, blobs, metadata JSON and index row, then drops the journal entry.
+    Journal entries left by a crash are replayed on start. The journal directory
+    is locked for the writer's lifetime, so a second process (e.g. the batch CLI
+    next to the server) cannot replay jobs the owner is still writing.
+    """
+
+    def __init__(self, history_dir: Optional[str] = None, journal_dir: Optional[str] = None):
+        self.history_dir = history_dir or history_service.history_dir
+        self.journal_dir = journal_dir or config.HISTORY_JOURNAL_DIR
+        self.queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        # URL path -> (bytes, media type), for files not yet on disk
+        self.pending: Dict[str, Any] = {}
+        self._pending_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._journal_lock_file = None
+        # Failed jobs waiting on a timer to be queued again
+        self._retrying = 0
+        self._retry_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            os.makedirs(self.history_dir, exist_ok=True)
+            os.makedirs(self.journal_dir, exist_ok=True)
+            self._lock_journal()
+            self._replay_journal()
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+
+    def next_timestamp(self) -> int:
+        """Millisecond timestamp for a new entry (it is the history id), unique across every process sharing the index."""
+        return history_service.allocate_id()
+
+    def _lock_journal(self):
+        if self._journal_lock_file:
+            return
+        lock_file = open(os.path.join(self.journal_dir, ".lock"), "a+b")
+        try:
+            if sys.platform == "win32":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(f"History journal {self.journal_dir} is in use by another process")
+        # Released by the OS when the process exits
+        self._journal_lock_file = lock_file
+
+    def submit(self, timestamp: int, metadata: Dict[str, Any], image_bytes: Optional[bytes] = None, image_source_url: Optional[str] = None, originals: Optional[List[bytes]] = None) -> Dict[str, Any]:
+        """Queue one generation for persistence and return the URLs it will be served at."""
+        self.start()
+        originals = originals or []
+        original_blobs = []
+        original_images = []
+        for img_bytes in originals:
+            blob_hash = cpu_pool.run(sha256_hex, img_bytes)
+            ext = detect_image_ext(img_bytes)
+            url = blob_store.url_for(blob_hash, ext)
+            original_blobs.append(blob_hash)
+            original_images.append(url)
+            self._add_pending(url, img_bytes, f"image/{'jpeg' if ext == 'jpg' else ext}")
+
+        metadata = dict(metadata)
+        metadata.setdefault("path", entry_stem(timestamp))
+
+        image_url = None
+        if image_bytes:
+            image_url = f"/static/history/{metadata['path']}.png"
+            self._add_pending(image_url, image_bytes, "image/png")
+
+        metadata["original_blobs"] = original_blobs
+        metadata["original_images"] = original_images
+
+        # Taken before the caller's own lease is released, so the bytes are never uncounted
+        held = (len(image_bytes) if image_bytes else 0) + sum(len(b) for b in originals)
+        with self._retry_lock:
+            self._idle.clear()
+            self.queue.put({
+                "timestamp": timestamp,
+                "metadata": metadata,
+                "image_bytes": image_bytes,
+                "image_source_url": image_source_url if not image_bytes else None,
+                "originals": list(originals),
+                "lease": byte_budget.hold(held, "history_pending")
+            })
+        return {"image_url": image_url, "original_images": original_images, "original_blobs": original_blobs}
+
+    def get_pending(self, url_path: str):
+        with self._pending_lock:
+            return self.pending.get(url_path)
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        """Block until every queued write has landed (used on shutdown and by batch jobs)."""
+        if not self._thread:
+            return True
+        return self._idle.wait(timeout)
+
+    def _add_pending(self, url_path: str, data: bytes, media_type: str):
+        with self._pending_lock:
+            self.pending[url_path] = (data, media_type)
+
+    def _drop_pending(self, job: Dict[str, Any]):
+        # Blob URLs shared with a later job are safe to drop: the content is on disk now
+        with self._pending_lock:
+            self.pending.pop(f"/static/history/{job['metadata'].get('path') or job['timestamp']}.png", None)
+            for url in job["metadata"].get("original_images") or []:
+                self.pending.pop(url, None)
+        if job.get("lease"):
+            job["lease"].release()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            batch = [job]
+            deadline = time.time() + config.HISTORY_WRITE_BATCH_MS / 1000.0
+            while len(batch) < config.HISTORY_WRITE_BATCH_SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                # Never let one batch take the writer thread (and every later write) down
+                print(f"History write-behind: batch of {len(batch)} failed: {e}")
+                for job in batch:
+                    self._retry(job)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+                self._update_idle()
+
+    def _write_batch(self, batch: List[Dict[str, Any]]):
+        for job in batch:
+            if job.get("journal_path"):
+                continue
+            try:
+                job["journal_path"] = self._journal(job)
+            except Exception as e:
+                print(f"History write-behind: journal failed for {job['timestamp']}: {e}")
+
+        # Files and blobs first, then the whole batch is indexed in one transaction.
+        # Blob refcounts use their own connection, which would block on an open index write.
+        written = []
+        for job in batch:
+            try:
+                written.append(self._materialize(job))
+            except Exception as e:
+                print(f"History write-behind: save failed for {job['timestamp']}: {e}")
+                self._retry(job)
+        indexed = []
+        for job, record_kwargs in written:
+            try:
+                history_service.record(**record_kwargs, commit=False)
+                indexed.append(job)
+            except Exception as e:
+                print(f"History write-behind: index failed for {job['timestamp']}: {e}")
+                self._retry(job)
+        try:
+            history_service.commit()
+        except Exception as e:
+            print(f"History write-behind: index commit failed: {e}")
+            for job in indexed:
+                self._retry(job)
+            return
+        for job in indexed:
+            self._drop_pending(job)
+            if job.get("journal_path"):
+                try:
+                    os.remove(job["journal_path"])
+                except FileNotFoundError:
+                    pass
+
+    def _retry(self, job: Dict[str, Any]):
+        """Write the job again later; its files stay served from memory meanwhile.
+
+        After HISTORY_WRITE_RETRIES attempts its bytes and byte budget lease are
+        let go: a lasting disk error must not pin the global budget. The journal
+        entry stays, so a restart replays it (an unjournaled job is lost).
+        """
+        job["attempts"] = job.get("attempts", 0) + 1
+        if job["attempts"] > config.HISTORY_WRITE_RETRIES:
+            if job.get("journal_path"):
+                print(f"History write-behind: giving up on {job['timestamp']} until the journal is replayed")
+            else:
+                print(f"History write-behind: giving up on {job['timestamp']}, which has no journal entry; it is lost")
+            self._drop_pending(job)
+            return
+        with self._retry_lock:
+            self._retrying += 1
+        timer = threading.Timer(min(60, 2 ** job["attempts"]), self._requeue, (job,))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, job: Dict[str, Any]):
+        # Queued before the retry count drops, so flush() never sees both at zero in between
+        self.queue.put(job)
+        with self._retry_lock:
+            self._retrying -= 1
+
+    def _update_idle(self):
+        with self._retry_lock:
+            if self.queue.unfinished_tasks == 0 and self._retrying == 0:
+                self._idle.set()
+
+    def _journal(self, job: Dict[str, Any]) -> str:
+        """One file per job: a JSON header line followed by the raw image and original bytes."""
+        header = {
+            "timestamp": job["timestamp"],
+            "metadata": job["metadata"],
+            "image_source_url": job["image_source_url"],
+            "image_size": len(job["image_bytes"]) if job["image_bytes"] else 0,
+            "original_sizes": [len(b) for b in job["originals"]]
+        }
+        payload = [json.dumps(header, ensure_ascii=False).encode("utf-8"), b"\n"]
+        if job["image_bytes"]:
+            payload.append(job["image_bytes"])
+        payload.extend(job["originals"])
+        path = os.path.join(self.journal_dir, f"{job['timestamp']}.job")
+        write_file_atomic(path, payload, fsync=True)
+        return path
+
+    def _read_journal(self, path: str) -> Dict[str, Any]:
+        with open(path, "rb") as f:
+            header = json.loads(f.readline().decode("utf-8"))
+            image_bytes = f.read(header["image_size"]) if header["image_size"] else None
+            originals = [f.read(size) for size in header["original_sizes"]]
+        return {
+            "timestamp": header["timestamp"],
+            "metadata": header["metadata"],
+            "image_bytes": image_bytes,
+            "image_source_url": header.get("image_source_url"),
+            "originals": originals
+        }
+
+    def _replay_journal(self):
+        for name in sorted(os.listdir(self.journal_dir)):
+            if not name.endswith(".job"):
+                continue
+            path = os.path.join(self.journal_dir, name)
+            try:
+                job = self._read_journal(path)
+                _, record_kwargs = self._materialize(job)
+                history_service.record(**record_kwargs)
+                os.remove(path)
+                print(f"History write-behind: replayed {name}")
+            except Exception as e:
+                print(f"History write-behind: replay failed for {name}: {e}")
+
+    def _materialize(self, job: Dict[str, Any]):
+        """Write the job's files and blobs; returns (job, history_service.record kwargs)."""
+        timestamp = job["timestamp"]
+        metadata = job["metadata"]
+        # Journals written before sharding have no path and keep the flat layout
+        stem = metadata.get("path") or str(timestamp)
+        files = history_service.files_for(timestamp, stem)
+        meta_path, image_path = files["metadata"], files["image"]
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+
+        # Metadata JSON is written last, so its presence means the files are complete
+        if not os.path.exists(meta_path):
+            image_bytes = job["image_bytes"]
+            if not image_bytes and job["image_source_url"]:
+                try:
+                    # Use system proxies (do not disable them) to support VPNs
+                    img_response = requests.get(job["image_source_url"], timeout=30)
+                    img_response.raise_for_status()
+                    image_bytes = img_response.content
+                except Exception as e:
+                    print(f"History write-behind: could not download {job['image_source_url'][:80]}: {e}")
+            if image_bytes:
+                write_file_atomic(image_path, image_bytes)
+                if config.HISTORY_VARIANTS_EAGER:
+                    try:
+                        variant_service.generate_all(stem, image_bytes)
+                    except Exception as e:
+                        # Variants are regenerated lazily on first request
+                        print(f"History write-behind: variants failed for {timestamp}: {e}")
+
+            for slot, img_bytes in enumerate(job["originals"]):
+                blob_store.put(img_bytes, owner=timestamp, slot=slot)
+
+            write_file_atomic(meta_path, json.dumps(metadata, ensure_ascii=False, indent=2).encode("utf-8"))
+
+        image_url = f"/static/history/{stem}.png" if os.path.exists(image_path) else ""
+        size_bytes = os.path.getsize(meta_path) + (os.path.getsize(image_path) if image_url else 0)
+        return job, {
+            "metadata": metadata,
+            "image_url": image_url,
+            "original_images": metadata.get("original_images") or [],
+            "size_bytes": size_bytes
+        }
+
+history_writer = HistoryWriter()
@@ -0,0 +1,161 @@
+import hashlib
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, List, Optional
+from config import config
+from services.prompt_service import prompt_service
+from services.deadline import current_deadline
+from services.cancellation import check_cancelled, current_cancel_token
+
+
+def prefetch_owner(api_key: Optional[str], client_id: Optional[str]) -> str:
+    """Who may claim a prefetch: the client that started it, with the same upstream key."""
+    key = api_key or config.BANANA_API_KEY or ""
+    return hashlib.sha256(f"{key}\0{client_id or ''}".encode("utf-8")).hexdigest()
+
+
+class FingerprintPrefetcher:
+    """Runs PromptService stage 1 speculatively while the user is still composing.
+
+    Jobs are keyed by their owner (prefetch_owner) and the uploaded images'
+    hashes. A later generation of the same owner claims the result instead of
+    extracting again. Unclaimed jobs expire after
+    PREFETCH_TTL_SECONDS and at most PREFETCH_MAX_PENDING jobs are kept alive.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, config.PREFETCH_WORKERS), thread_name_prefix="prefetch")
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, image_bytes_list: List[bytes], image_hashes: List[str], owner: str, api_key: Optional[str] = None, api_url: Optional[str] = None) -> Dict[str, Any]:
+        """Start (or reuse) a job; image_hashes come from hash_images_async, off the event loop."""
+        if not image_hashes:
+            return {"prefetch_id": None, "status": "skipped", "image_hashes": []}
+
+        with self._lock:
+            self._expire_locked()
+
+            # Same image set already in flight or done: reuse it
+            for job in self.jobs.values():
+                if job["owner"] == owner and job["image_hashes"] == image_hashes and job["status"] != "cancelled":
+                    return self._describe(job)
+
+            if self._active_count_locked() >= config.PREFETCH_MAX_PENDING:
+                print("DEBUG_LOG: Prefetch budget exhausted, skipping speculative fingerprint")
+                return {"prefetch_id": None, "status": "skipped", "image_hashes": image_hashes}
+
+            prefetch_id = uuid.uuid4().hex
+            job = {
+                "id": prefetch_id,
+                "owner": owner,
+                "image_hashes": image_hashes,
+                "status": "pending",
+                "fingerprint": None,
+                "created_at": time.time(),
+                "future": None
+            }
+            self.jobs[prefetch_id] = job
+            job["future"] = self.executor.submit(self._run, prefetch_id, list(image_bytes_list), api_key, api_url)
+            return self._describe(job)
+
+    def _run(self, prefetch_id: str, image_bytes_list: List[bytes], api_key: Optional[str], api_url: Optional[str]) -> dict:
+        with self._lock:
+            job = self.jobs.get(prefetch_id)
+            if not job or job["status"] == "cancelled":
+                return {}
+            job["status"] = "running"
+
+        print(f"DEBUG_LOG: Prefetch {prefetch_id[:8]} - extracting fingerprint from {len(image_bytes_list)} images")
+        try:
+            fingerprint = prompt_service.extract_fingerprint(image_bytes_list, api_key, api_url)
+        except Exception as e:
+            print(f"ERROR: Prefetch {prefetch_id[:8]} failed: {e}")
+            fingerprint = {}
+
+        with self._lock:
+            job = self.jobs.get(prefetch_id)
+            if job and job["status"] != "cancelled":
+                job["fingerprint"] = fingerprint
+                job["status"] = "done" if fingerprint else "failed"
+        return fingerprint
+
+    def claim(self, image_hashes: List[str], owner: str, wait_seconds: Optional[float] = None) -> Optional[dict]:
+        """Return the prefetched fingerprint covering these images, waiting for it if still running."""
+        if not image_hashes:
+            return None
+        wanted = set(image_hashes)
+        with self._lock:
+            self._expire_locked()
+            candidates = [
+                job for job in self.jobs.values()
+                if job["owner"] == owner and job["status"] in ("pending", "running", "done") and wanted.issubset(job["image_hashes"])
+            ]
+            if not candidates:
+                return None
+            # Prefer an exact match, then the most recent job
+            candidates.sort(key=lambda j: (j["image_hashes"] != image_hashes, -j["created_at"]))
+            job = candidates[0]
+            future: Future = job["future"]
+
+        wait = config.PREFETCH_CLAIM_WAIT_SECONDS if wait_seconds is None else wait_seconds
+        deadline = current_deadline()
+        if deadline is not None:
+            wait = min(wait, deadline.remaining())
+        cancel_token = current_cancel_token()
+        if cancel_token is not None:
+            # Stop waiting, not the prefetch (another task may claim it), when the claimer is cancelled
+            woken = threading.Event()
+            future.add_done_callback(lambda _: woken.set())
+            cancel_token.on_cancel(woken.set)
+            woken.wait(wait)
+            check_cancelled()
+        try:
+            fingerprint = future.result(timeout=0 if cancel_token is not None else wait)
+        except FutureTimeoutError:
+            print(f"DEBUG_LOG: Prefetch {job['id'][:8]} still running after {wait}s, not waiting any longer")
+            return None
+        except Exception:
+            return None
+
+        with self._lock:
+            job["claimed_at"] = time.time()
+        return fingerprint or None
+
+    def get(self, prefetch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self.jobs.get(prefetch_id)
+            return self._describe(job) if job else None
+
+    def cancel(self, prefetch_id: str) -> bool:
+        with self._lock:
+            job = self.jobs.pop(prefetch_id, None)
+        if not job:
+            return False
+        job["status"] = "cancelled"
+        # Only stops jobs that have not started; a running call finishes and is discarded
+        job["future"].cancel()
+        return True
+
+    def _active_count_locked(self) -> int:
+        return sum(1 for job in self.jobs.values() if job["status"] in ("pending", "running"))
+
+    def _expire_locked(self):
+        now = time.time()
+        expired = [pid for pid, job in self.jobs.items() if now - job["created_at"] > config.PREFETCH_TTL_SECONDS]
+        for pid in expired:
+            job = self.jobs.pop(pid)
+            job["status"] = "cancelled"
+            job["future"].cancel()
+
+    @staticmethod
+    def _describe(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "prefetch_id": job["id"],
+            "status": job["status"],
+            "image_hashes": job["image_hashes"]
+        }
+
+fingerprint_prefetcher = FingerprintPrefetcher()
@@ -1,17 +1,74 @@
 import requests
-import base64
 import json
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from config import config
-from prompts import PRODUCT_LOCK_PROMPT, MAIN_ENGINE_INSTRUCTION, PROMPT_REGISTRY, PROMPT_TEMPLATES
-import time
+from prompts import PRODUCT_LOCK_PROMPT, MAIN_ENGINE_INSTRUCTION, SINGLE_TARGET_OUTPUT_INSTRUCTIONS, PROMPT_REGISTRY, PROMPT_TEMPLATES
+from services.fingerprint_cache import fingerprint_cache, hash_image, merge_fingerprints
+from services.upstream_body import data_url, json_body
+from services.deadline import attempt_timeout, backoff, current_deadline, deadline_scope
+from services.cancellation import abortable_request, cancel_scope, current_cancel_token
+
+def parse_optimized_prompt(optimized_result: str, prompt_family: str, prompt_variants: str = "auto") -> dict:
+    """Image prompt and hints from optimize_prompt output; non-JSON output is used as the prompt itself.
+
+    Keys: final_prompt, layout_logic, prompt_variant_map, and thinking_level /
+    identity_ref / logic_ref (None unless the optimizer suggested them).
+    """
+    parsed = {
+        "final_prompt": optimized_result,
+        "layout_logic": "",
+        "prompt_variant_map": None,
+        "thinking_level": None,
+        "identity_ref": None,
+        "logic_ref": None
+    }
+    try:
+        prompt_data = json.loads(optimized_result)
+
+        # Extract thinking_level from optimized prompt if present
+        if "thinking_level" in prompt_data:
+            parsed["thinking_level"] = prompt_data["thinking_level"]
+
+        # Handle Dual-Track indexing from optimized result if present
+        if "proposal" in prompt_data:
+            p = prompt_data["proposal"]
+            if "identity_ref" in p:
+                parsed["identity_ref"] = p["identity_ref"]
+            if "logic_ref" in p:
+                parsed["logic_ref"] = p["logic_ref"]
+
+        # Handle Luxury Visual Strategy format
+        if "luxury_visual_strategy" in prompt_data:
+            strategy = prompt_data["luxury_visual_strategy"]
+            screens = strategy.get("screens", [])
+            if screens:
+                # Default to the first screen (Brand Impact)
+                first_screen = screens[0]
+                parsed["final_prompt"] = first_screen.get("positive_prompt", optimized_result)
+                parsed["layout_logic"] = f"Screen: {first_screen.get('screen_name_zh', '1')}\n{strategy.get('visual_grammar_handbook', {}).get('composition_rules', {})}"
+        else:
+            # Standard Dual-Core (or single-target) format
+            if prompt_family == "seadream":
+                parsed["final_prompt"] = prompt_data.get("seadream_cn", prompt_data.get("nano_banana_en", optimized_result))
+            else:
+                parsed["final_prompt"] = prompt_data.get("nano_banana_en", prompt_data.get("seadream_cn", optimized_result))
+            parsed["layout_logic"] = prompt_data.get("layout_logic", "")
+            # Clients in dual mode get both variants back with the result
+            if prompt_variants == "dual":
+                parsed["prompt_variant_map"] = {k: prompt_data[k] for k in ("nano_banana_en", "seadream_cn") if k in prompt_data}
+    except Exception as e:
+        print(f"DEBUG_LOG: JSON parsing failed or format mismatch: {e}")
+        parsed["final_prompt"] = optimized_result
+    return parsed
 
 class PromptService:
     def _post_json_with_retry(self, url: str, headers: dict, payload: dict, timeout: int = 60):
+        body = json_body(payload)
         last_error = None
         for attempt in range(1, 4):
             try:
-                resp = requests.post(url, headers=headers, json=payload, timeout=timeout, proxies={"http": None, "https": None})
+                resp = abortable_request("POST", url, headers=headers, data=body.reader(), timeout=attempt_timeout(timeout), proxies={"http": None, "https": None})
                 resp.raise_for_status()
                 return resp
             except (
@@ -26,13 +83,15 @@ class PromptService:
                 wait_s = attempt * 1.5
                 print(f"ERROR: PromptService request failed (Attempt {attempt}/3): {type(e).__name__}: {e}")
                 if attempt < 3:
-                    time.sleep(wait_s)
+                    backoff(wait_s)
             except Exception as e:
                 raise e
         raise last_error
 
-    def optimize_prompt(self, prompt: str, scenario: str, image_bytes_list: List[bytes] = None, api_key: str = None, api_url: str = None, task_id: str = None, task_service = None) -> str:
-        print(f"DEBUG_LOG: optimize_prompt called. Scenario: {scenario}, Image Count: {len(image_bytes_list) if image_bytes_list else 0}")
+    def optimize_prompt(self, prompt: str, scenario: str, image_bytes_list: List[bytes] = None, api_key: str = None, api_url: str = None, task_id: str = None, task_service = None, fingerprint: dict = None, target_family: str = None, fingerprint_mode: str = None) -> str:
+        """target_family (nano_banana / seadream) asks stage 2 for that variant only; None keeps dual output.
+        fingerprint_mode overrides config.FINGERPRINT_MODE ("batch" or "parallel")."""
+        print(f"DEBUG_LOG: optimize_prompt called. Scenario: {scenario}, Image Count: {len(image_bytes_list) if image_bytes_list else 0}, Target: {target_family or 'dual'}")
         
         final_api_key = api_key if api_key else config.BANANA_API_KEY
         if not final_api_key:
@@ -40,12 +99,17 @@ class PromptService:
             return prompt
 
         # 1. Stage 1: Multi-view Visual Fingerprint Extraction
-        fingerprint = {}
-        if image_bytes_list:
+        # A fingerprint validated by the caller (e.g. chat-stage Visual DNA) skips the vision call
+        fingerprint = fingerprint or {}
+        if fingerprint:
+            print("DEBUG_LOG: Stage 1 - Reusing precomputed fingerprint, skipping extraction")
+            if task_service and task_id:
+                task_service.update_task(task_id, progress=25, progress_message="♻️ 复用已有产品特征，跳过图片分析")
+        elif image_bytes_list:
             print(f"DEBUG_LOG: Stage 1 - Extracting Fingerprint from {len(image_bytes_list)} images...")
             if task_service and task_id:
                 task_service.update_task(task_id, progress=18, progress_message=f"🔍 正在使用 gemini-3-pro-preview 分析 {len(image_bytes_list)} 张图片...")
-            fingerprint = self._extract_fingerprint(image_bytes_list, final_api_key, api_url, task_id, task_service)
+            fingerprint = self.extract_fingerprint(image_bytes_list, final_api_key, api_url, task_id, task_service, fingerprint_mode)
             print(f"DEBUG_LOG: Fingerprint: {fingerprint}")
             if task_service and task_id:
                 task_service.update_task(task_id, progress=25, progress_message="✅ 产品特征提取完成")
@@ -54,30 +118,84 @@ class PromptService:
         print(f"DEBUG_LOG: Stage 2 - Generating Dual-Core Prompts for scenario: {scenario}")
         if task_service and task_id:
             task_service.update_task(task_id, progress=28, progress_message="📝 正在使用 gemini-3-pro-preview 生成优化提示词...")
-        optimized_json = self._generate_dual_core_prompts(prompt, scenario, fingerprint, image_bytes_list, final_api_key, api_url, task_id, task_service)
+        optimized_json = self._generate_dual_core_prompts(prompt, scenario, fingerprint, image_bytes_list, final_api_key, api_url, task_id, task_service, target_family)
         
         return optimized_json
 
+    def extract_fingerprint(self, image_bytes_list: List[bytes], api_key: str = None, api_url: str = None, task_id: str = None, task_service = None, fingerprint_mode: str = None) -> dict:
+        """Stage 1 on its own, used by optimize_prompt and by the speculative prefetcher."""
+        final_api_key = api_key if api_key else config.BANANA_API_KEY
+        if not final_api_key or not image_bytes_list:
+            return {}
+        if (fingerprint_mode or config.FINGERPRINT_MODE) == "parallel":
+            return self._extract_fingerprint_parallel(image_bytes_list, final_api_key, api_url, task_id, task_service)
+        return self._extract_fingerprint(image_bytes_list, final_api_key, api_url, task_id, task_service)
+
     def _extract_fingerprint(self, image_bytes_list: List[bytes], api_key: str, api_url: str = None, task_id: str = None, task_service = None) -> dict:
+        if task_service and task_id:
+            task_service.update_task(task_id, progress=20, progress_message="📷 正在编码图片数据...")
+        
+        try:
+            return self._request_fingerprint(image_bytes_list, api_key, api_url, task_id, task_service)
+        except Exception as e:
+            print(f"ERROR: Fingerprint extraction failed: {e}")
+            return {}
+
+    def _extract_fingerprint_parallel(self, image_bytes_list: List[bytes], api_key: str, api_url: str = None, task_id: str = None, task_service = None) -> dict:
+        """Analyze each image in its own call (bounded concurrency), then merge locally.
+
+        Per-image results are cached by image hash, so only new photos cost a call,
+        and one failing image no longer fails the whole extraction.
+        """
+        image_hashes = [hash_image(img) for img in image_bytes_list]
+        per_image = {h: fingerprint_cache.get_image(h) for h in image_hashes}
+        pending = {}
+        for img_hash, img_bytes in zip(image_hashes, image_bytes_list):
+            if per_image[img_hash] is None and img_hash not in pending:
+                pending[img_hash] = img_bytes
+
+        print(f"DEBUG_LOG: Parallel fingerprint - {len(image_hashes) - len(pending)} cached, {len(pending)} to analyze")
+        if task_service and task_id:
+            task_service.update_task(task_id, progress=22, progress_message=f"🚀 正在并行分析 {len(pending)} 张新图片（{len(image_hashes) - len(pending)} 张已缓存）...")
+
+        deadline = current_deadline()
+        cancel_token = current_cancel_token()
+
+        def analyze(item):
+            img_hash, img_bytes = item
+            try:
+                with deadline_scope(deadline), cancel_scope(cancel_token):
+                    fingerprint = self._request_fingerprint([img_bytes], api_key, api_url)
+                return img_hash, fingerprint if isinstance(fingerprint, dict) else {}
+            except Exception as e:
+                print(f"ERROR: Fingerprint extraction failed for image {img_hash[:8]}: {e}")
+                return img_hash, {}
+
+        if pending:
+            max_workers = max(1, min(config.FINGERPRINT_CONCURRENCY, len(pending)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for img_hash, fingerprint in executor.map(analyze, pending.items()):
+                    per_image[img_hash] = fingerprint
+                    fingerprint_cache.put_image(img_hash, fingerprint)
+
+        return merge_fingerprints([per_image[h] for h in image_hashes])
+
+    def _request_fingerprint(self, image_bytes_list: List[bytes], api_key: str, api_url: str = None, task_id: str = None, task_service = None) -> dict:
         url = f"{api_url.rstrip('/')}/chat/completions" if api_url else f"{config.BANANA_API_URL.rstrip('/')}/chat/completions"
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {api_key}"
         }
         
-        if task_service and task_id:
-            task_service.update_task(task_id, progress=20, progress_message="📷 正在编码图片数据...")
-        
         # Prepare content with multiple images
         content_list = [
             {"type": "text", "text": "Analyze these product images and extract the visual fingerprint."}
         ]
         
         for img_bytes in image_bytes_list:
-            base64_image = base64.b64encode(img_bytes).decode('utf-8')
             content_list.append({
                 "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+                "image_url": {"url": data_url(img_bytes, "image/jpeg")}
             })
         
         # Format the system prompt with image count
@@ -98,15 +216,11 @@ class PromptService:
         if task_service and task_id:
             task_service.update_task(task_id, progress=22, progress_message="🚀 正在调用 gemini-3-pro-preview 提取产品特征...")
         
-        try:
-            response = self._post_json_with_retry(url, headers, payload, timeout=60)
-            content = response.json()["choices"][0]["message"]["content"]
-            return json.loads(content)
-        except Exception as e:
-            print(f"ERROR: Fingerprint extraction failed: {e}")
-            return {}
+        response = self._post_json_with_retry(url, headers, payload, timeout=60)
+        content = response.json()["choices"][0]["message"]["content"]
+        return json.loads(content)
 
-    def _generate_dual_core_prompts(self, user_prompt: str, scenario: str, fingerprint: dict, image_bytes_list: List[bytes], api_key: str, api_url: str = None, task_id: str = None, task_service = None) -> str:
+    def _generate_dual_core_prompts(self, user_prompt: str, scenario: str, fingerprint: dict, image_bytes_list: List[bytes], api_key: str, api_url: str = None, task_id: str = None, task_service = None, target_family: str = None) -> str:
         url = f"{api_url.rstrip('/')}/chat/completions" if api_url else f"{config.BANANA_API_URL.rstrip('/')}/chat/completions"
         headers = {
             "Content-Type": "application/json",
@@ -117,6 +231,9 @@ class PromptService:
         mode_template = PROMPT_REGISTRY.get(scenario, PROMPT_TEMPLATES.get(scenario, "General Mode"))
         
         system_content = f"{MAIN_ENGINE_INSTRUCTION}\n\n# Current Mode Template\n{mode_template}"
+        # Single-target mode: only ask for the variant the image model will consume
+        if target_family in SINGLE_TARGET_OUTPUT_INSTRUCTIONS:
+            system_content += f"\n{SINGLE_TARGET_OUTPUT_INSTRUCTIONS[target_family]}"
         
         user_text = f"User Request: {user_prompt}"
         if fingerprint:
@@ -127,10 +244,9 @@ class PromptService:
         # Include all images in stage 2 as well for full context
         if image_bytes_list:
             for img_bytes in image_bytes_list:
-                base64_image = base64.b64encode(img_bytes).decode('utf-8')
                 user_content.append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+                    "image_url": {"url": data_url(img_bytes, "image/jpeg")}
                 })
 
         payload = {
@@ -143,7 +259,8 @@ class PromptService:
         }
 
         if task_service and task_id:
-            task_service.update_task(task_id, progress=29, progress_message="🚀 正在调用 gemini-3-pro-preview 生成双核提示词...")
+            stage_label = "单目标" if target_family in SINGLE_TARGET_OUTPUT_INSTRUCTIONS else "双核"
+            task_service.update_task(task_id, progress=29, progress_message=f"🚀 正在调用 gemini-3-pro-preview 生成{stage_label}提示词...")
 
         try:
             response = self._post_json_with_retry(url, headers, payload, timeout=60)
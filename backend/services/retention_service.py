@@ -0,0 +1,228 @@
+import json
+import os
+import tarfile
+import threading
+import time
+from typing import Dict, Any, List, Optional
+from config import config
+from services.blob_store import blob_store
+from services.history_service import history_service
+from services.variant_service import variant_service
+
+
+class RetentionService:
+    """Evicts history entries by policy: max age, max total bytes, keep-N-per-session.
+
+    The newest keep_per_session entries of every session are never evicted.
+    Age eviction removes everything older than max_age_days; the byte quota then
+    evicts the coldest entries (least recently served, see history_service.touch)
+    until the rest fits. Bytes count everything an entry keeps on disk: image,
+    metadata, variants, legacy originals, and each blob once, freed with the last
+    entry referencing it. Evicted entries can be archived to a .tar.gz first.
+    """
+
+    def __init__(self):
+        self._run_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def plan(self, max_age_days: Optional[int] = None, max_total_bytes: Optional[int] = None, keep_per_session: Optional[int] = None, now: Optional[float] = None) -> Dict[str, Any]:
+        """What a retention run would remove, without touching anything."""
+        max_age_days = config.HISTORY_RETENTION_MAX_AGE_DAYS if max_age_days is None else max_age_days
+        max_total_bytes = config.HISTORY_RETENTION_MAX_TOTAL_BYTES if max_total_bytes is None else max_total_bytes
+        keep_per_session = config.HISTORY_RETENTION_KEEP_PER_SESSION if keep_per_session is None else keep_per_session
+        now_ms = int((now or time.time()) * 1000)
+
+        rows = history_service.retention_rows()
+        entries = {row["id"]: self._entry(row) for row in rows}
+        blob_refs: Dict[str, int] = {}
+        for entry in entries.values():
+            for blob_hash in entry["original_blobs"]:
+                blob_refs[blob_hash] = blob_refs.get(blob_hash, 0) + 1
+        blob_sizes = blob_store.sizes(list(blob_refs))
+        total_bytes = sum(e["own_bytes"] for e in entries.values()) + sum(blob_sizes.get(h, 0) for h in blob_refs)
+
+        def evict(row, reason: str) -> Dict[str, Any]:
+            entry = entries[row["id"]]
+            freed = entry["own_bytes"]
+            for blob_hash in entry["original_blobs"]:
+                blob_refs[blob_hash] -= 1
+                if blob_refs[blob_hash] == 0:
+                    freed += blob_sizes.get(blob_hash, 0)
+            return self._candidate(row, entry, freed, reason)
+
+        protected = set()
+        if keep_per_session > 0:
+            by_session: Dict[str, List[Any]] = {}
+            for row in rows:
+                if row["session"]:
+                    by_session.setdefault(row["session"], []).append(row)
+            for session_rows in by_session.values():
+                session_rows.sort(key=lambda r: r["timestamp"], reverse=True)
+                protected.update(r["id"] for r in session_rows[:keep_per_session])
+
+        evicted: Dict[int, Dict[str, Any]] = {}
+        if max_age_days > 0:
+            cutoff = now_ms - max_age_days * 86400 * 1000
+            for row in rows:
+                if row["timestamp"] < cutoff and row["id"] not in protected:
+                    evicted[row["id"]] = evict(row, "max_age")
+
+        if max_total_bytes > 0:
+            remaining = total_bytes - sum(c["size_bytes"] for c in evicted.values())
+            # rows are ordered coldest first
+            for row in rows:
+                if remaining <= max_total_bytes:
+                    break
+                if row["id"] in protected or row["id"] in evicted:
+                    continue
+                evicted[row["id"]] = evict(row, "max_total_bytes")
+                remaining -= evicted[row["id"]]["size_bytes"]
+
+        candidates = list(evicted.values())
+        bytes_freed = sum(c["size_bytes"] for c in candidates)
+        return {
+            "policy": {"max_age_days": max_age_days, "max_total_bytes": max_total_bytes, "keep_per_session": keep_per_session},
+            "entries": len(rows),
+            "total_bytes": total_bytes,
+            "protected": len(protected),
+            "candidates": candidates,
+            "bytes_freed": bytes_freed,
+            "bytes_after": total_bytes - bytes_freed
+        }
+
+    def run(self, dry_run: bool = False, archive: Optional[bool] = None, **policy) -> Dict[str, Any]:
+        """Apply the retention policies. With dry_run, only report what would be removed."""
+        archive = config.HISTORY_RETENTION_ARCHIVE if archive is None else archive
+        with self._run_lock:
+            report = self.plan(**policy)
+            report["dry_run"] = dry_run
+            report["archive"] = None
+            candidates = report["candidates"]
+            if dry_run or not candidates:
+                return report
+
+            if archive:
+                report["archive"] = self._archive(candidates)
+
+            for candidate in candidates:
+                self._remove_files(candidate)
+            history_service.delete([c["id"] for c in candidates])
+            released = set()
+            for candidate in candidates:
+                blob_store.release(candidate["original_blobs"], owner=candidate["id"])
+                released.update(candidate["original_blobs"])
+            # Blobs no entry references any more go now, not at the next gc-blobs
+            blob_store.gc(grace_seconds=0, hashes=released)
+            print(f"History retention: removed {len(candidates)} entries, freed {report['bytes_freed']} bytes")
+            return report
+
+    def start(self):
+        """Run retention every HISTORY_RETENTION_INTERVAL_SECONDS in a daemon thread (0 disables)."""
+        if config.HISTORY_RETENTION_INTERVAL_SECONDS <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._loop, name="history-retention", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(config.HISTORY_RETENTION_INTERVAL_SECONDS)
+            try:
+                self.run()
+            except Exception as e:
+                print(f"History retention failed: {e}")
+
+    @staticmethod
+    def _entry(row) -> Dict[str, Any]:
+        """What an entry keeps on disk besides shared blobs (own_bytes), and the blobs it references."""
+        try:
+            metadata = json.loads(row["metadata"] or "{}")
+        except json.JSONDecodeError:
+            metadata = {}
+        path = row["path"] or str(row["id"])
+        files = history_service.files_for(row["id"], path)
+        if row["size_bytes"] is not None:
+            own_bytes = row["size_bytes"]
+        else:
+            # Indexed before sizes were recorded
+            own_bytes = sum(os.path.getsize(p) for p in files.values() if os.path.exists(p))
+        legacy_originals = []
+        if "original_blobs" not in metadata:
+            # Pre blob-store originals, {timestamp}_orig_{idx}.jpg next to the entry, go with it
+            directory = os.path.dirname(files["metadata"])
+            legacy_originals = [
+                os.path.join(directory, f"{row['id']}_orig_{idx}.jpg")
+                for idx in range(int(metadata.get("original_images_count") or 0))
+            ]
+            legacy_originals = [p for p in legacy_originals if os.path.exists(p)]
+        own_bytes += sum(os.path.getsize(p) for p in legacy_originals + variant_service.files_for(path))
+        return {
+            "path": path,
+            "own_bytes": own_bytes,
+            "original_blobs": metadata.get("original_blobs") or [],
+            "legacy_originals": legacy_originals
+        }
+
+    @staticmethod
+    def _candidate(row, entry: Dict[str, Any], size_bytes: int, reason: str) -> Dict[str, Any]:
+        return {
+            "id": row["id"],
+            "path": entry["path"],
+            "session": row["session"],
+            "timestamp": row["timestamp"],
+            "last_used": row["last_used"],
+            "size_bytes": size_bytes,
+            "reason": reason,
+            "original_blobs": entry["original_blobs"],
+            "legacy_originals": entry["legacy_originals"]
+        }
+
+    @staticmethod
+    def _entry_files(candidate: Dict[str, Any]) -> List[str]:
+        files = list(history_service.files_for(candidate["id"], candidate["path"]).values())
+        files += candidate["legacy_originals"]
+        files += variant_service.files_for(candidate["path"])
+        return [p for p in files if os.path.exists(p)]
+
+    def _archive(self, candidates: List[Dict[str, Any]]) -> str:
+        os.makedirs(config.HISTORY_ARCHIVE_DIR, exist_ok=True)
+        archive_path = os.path.join(config.HISTORY_ARCHIVE_DIR, f"history-{int(time.time() * 1000)}.tar.gz")
+        tmp_path = archive_path + ".part"
+        with tarfile.open(tmp_path, "w:gz") as tar:
+            for candidate in candidates:
+                for path in self._entry_files(candidate):
+                    if path.startswith(variant_service.root):
+                        # Derivatives are regenerated on demand
+                        continue
+                    tar.add(path, arcname=os.path.relpath(path, history_service.history_dir))
+                for blob_hash in candidate["original_blobs"]:
+                    for name in self._blob_files(blob_hash):
+                        tar.add(name, arcname=os.path.join("blobs", os.path.relpath(name, blob_store.root)))
+        os.replace(tmp_path, archive_path)
+        return archive_path
+
+    @staticmethod
+    def _blob_files(blob_hash: str) -> List[str]:
+        directory = os.path.dirname(blob_store.path_for(blob_hash, "bin"))
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, n) for n in os.listdir(directory) if n.startswith(blob_hash + ".")]
+
+    def _remove_files(self, candidate: Dict[str, Any]):
+        for path in self._entry_files(candidate):
+            os.remove(path)
+            # .gz/.br siblings older builds compressed next to history files would keep the shard alive
+            for encoding in ("gz", "br"):
+                if os.path.exists(f"{path}.{encoding}"):
+                    os.remove(f"{path}.{encoding}")
+        # Prune shard directories left empty
+        image_path = history_service.files_for(candidate["id"], candidate["path"])["image"]
+        for root in (history_service.history_dir, variant_service.root):
+            directory = os.path.dirname(os.path.join(root, os.path.relpath(image_path, history_service.history_dir)))
+            while os.path.normpath(directory) != os.path.normpath(root):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+retention_service = RetentionService()
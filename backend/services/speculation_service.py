@@ -0,0 +1,220 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple
+from config import config
+from services.task_service import task_service
+
+
+def extract_proposals(content: str) -> List[dict]:
+    """Return the proposal cards in a Director Agent reply ("proposal" or "proposals"), in order."""
+    if not content:
+        return []
+    match = re.search(r'\{[\s\S]*"proposals?"[\s\S]*\}', content)
+    if not match:
+        return []
+    try:
+        data = json.loads(match.group(0))
+    except (json.JSONDecodeError, ValueError):
+        return []
+    if not isinstance(data, dict):
+        return []
+    proposals = data.get("proposals")
+    if not isinstance(proposals, list):
+        proposals = [data.get("proposal")]
+    return [p for p in proposals if isinstance(p, dict) and p.get("prompt") and p.get("ratio")]
+
+
+def reply_analysis(content: str) -> dict:
+    """The "analysis" section of a Director Agent reply, {} when there is none."""
+    match = re.search(r'\{[\s\S]*"proposals?"[\s\S]*\}', content or "")
+    if not match:
+        return {}
+    try:
+        data = json.loads(match.group(0))
+    except (json.JSONDecodeError, ValueError):
+        return {}
+    analysis = data.get("analysis") if isinstance(data, dict) else None
+    return analysis if isinstance(analysis, dict) else {}
+
+
+def reply_visual_dna(content: str, analysis: dict, visual_dna: Optional[str]) -> Optional[str]:
+    """The Visual DNA the frontend holds once it has rendered this reply.
+
+    Mirrors processAIResponse and the proposal renderer: a [VISUAL_DNA_V2] block
+    replaces the DNA the client sent, analysis.visual_dna_v2 replaces both.
+    """
+    match = re.search(r'\[VISUAL_DNA_V2\]([\s\S]*?)\[/VISUAL_DNA_V2\]', content or "")
+    if match:
+        visual_dna = match.group(1).strip()
+    if analysis.get("visual_dna_v2"):
+        visual_dna = str(analysis["visual_dna_v2"]).strip() or None
+    return visual_dna
+
+
+def build_final_prompt(proposal: dict, visual_dna: Optional[str]) -> str:
+    """The prompt the frontend sends when this proposal is confirmed (buildFinalPrompt in script.js).
+
+    The proposal prompt, then the copywriting block, then the brand spec
+    extracted from the Visual DNA; both must stay in step with the frontend
+    or speculations never match a confirm.
+    """
+    base = proposal["prompt"].strip() if isinstance(proposal.get("prompt"), str) else ""
+    copy = proposal.get("copywriting") if isinstance(proposal.get("copywriting"), dict) else {}
+    l1 = copy["L1"].strip() if isinstance(copy.get("L1"), str) else ""
+    l2 = copy["L2"].strip() if isinstance(copy.get("L2"), str) else ""
+    l3_raw = copy.get("L3")
+    if isinstance(l3_raw, list):
+        l3 = [str(s).strip() for s in l3_raw if str(s).strip()]
+    elif isinstance(l3_raw, str):
+        l3 = [s.strip() for s in l3_raw.split("|") if s.strip()]
+    else:
+        l3 = []
+
+    parts = []
+    if base:
+        parts.append(base)
+    if l1 or l2 or l3:
+        parts.append("\n".join([
+            "[Text & Layout Content]",
+            f"L1(Main Title): {l1}",
+            f"L2(Sub Title): {l2}",
+            f"L3(Feature Tags): {' | '.join(l3)}"
+        ]))
+
+    if visual_dna:
+        def extract(key: str) -> str:
+            match = re.search(rf"^\s*-\s*{key}:\s*(.*)", visual_dna, re.M)
+            return match.group(1).strip() if match else ""
+
+        brand_specs = [
+            "[BRAND VISUAL SYSTEM V2]",
+            f"Visual Concept: {extract('visual_concept')}",
+            f"Palette: Main={extract('palette_main')}, Accent={extract('palette_accent')}, Background={extract('palette_background')}",
+            f"Typography System: {extract('typography')}",
+            f"Text Layout Logic: {extract('text_layout')}",
+            f"UI & Decorative Elements: {extract('ui_elements')}",
+            f"Lighting & Tone: {extract('lighting')} | {extract('tone')}"
+        ]
+        brand_specs = [spec for spec in brand_specs if not spec.endswith("=") and not spec.endswith(": ")]
+        if len(brand_specs) > 1:
+            parts.append("\n".join(brand_specs))
+
+    return "\n\n".join(parts).strip()
+
+
+def proposal_generation_inputs(proposal: dict, images: List[bytes], track_a: List[bytes], track_b: List[bytes]):
+    """Rebuild the image list and refs the frontend sends when a proposal is confirmed.
+
+    Mirrors handleProposalConfirm: all Track A images, then the proposal's Track B
+    logic image; identity_ref indexes Track A and logic_ref points past it.
+    Without tracks, the plain uploaded images are used as-is with both refs 0.
+    """
+    identity_ref = proposal.get("identity_ref")
+    if not isinstance(identity_ref, int):
+        identity_ref = proposal.get("selected_asset_index")
+    logic_ref = proposal.get("logic_ref")
+    if not isinstance(logic_ref, int):
+        logic_ref = 0
+    if not track_a and not track_b:
+        return list(images), 0, 0
+
+    final_images = []
+    seen = set()
+    logic_image = track_b[logic_ref] if isinstance(logic_ref, int) and 0 <= logic_ref < len(track_b) else None
+    for img in list(track_a) + ([logic_image] if logic_image else []):
+        digest = hashlib.sha1(img).hexdigest()
+        if digest not in seen:
+            seen.add(digest)
+            final_images.append(img)
+    if not (isinstance(identity_ref, int) and 0 <= identity_ref < len(track_a)):
+        identity_ref = 0
+    return final_images, identity_ref, len(track_a)
+
+
+class SpeculationService:
+    """Starts generations for proposal cards before the user confirms them.
+
+    Each speculation is keyed by what /api/generate will receive on confirm
+    (build_final_prompt, ratio, model, image hashes). The first matching
+    confirm from the same client attaches to the running task instead of
+    starting a new one; the entry is dropped then, so a repeated confirm
+    generates again.
+    """
+
+    def __init__(self):
+        # (client_id, key) -> {"task_id", "client_id", "created_at"}; unclaimed only
+        self.entries: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(prompt: str, ratio: str, model: str, image_hashes: List[str]) -> str:
+        raw = json.dumps([(prompt or "").strip(), (ratio or "").strip(), model, list(image_hashes)], ensure_ascii=False)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def reserve(self, client_id: str, key: str) -> Optional[str]:
+        """Create a speculative task if the client and global budgets allow it."""
+        with self._lock:
+            self._expire_locked()
+            if (client_id, key) in self.entries:
+                return None
+            in_flight = [e for e in self.entries.values() if self._is_active(e["task_id"])]
+            if len(in_flight) >= config.SPECULATION_MAX_GLOBAL:
+                return None
+            if sum(1 for e in in_flight if e["client_id"] == client_id) >= config.SPECULATION_PER_CLIENT:
+                return None
+            task_id = task_service.create_task("speculative_generation")
+            self.entries[(client_id, key)] = {
+                "task_id": task_id,
+                "client_id": client_id,
+                "created_at": time.time()
+            }
+            return task_id
+
+    def attach(self, client_id: str, key: str) -> Optional[str]:
+        """Hand an in-progress or finished speculative task to the client's confirming /api/generate call, once."""
+        with self._lock:
+            entry = self.entries.pop((client_id, key), None)
+            if not entry:
+                return None
+            task = task_service.get_task(entry["task_id"])
+            if not task or task["status"] in ("failed", "cancelled"):
+                return None
+            task["type"] = "image_generation"
+            return entry["task_id"]
+
+    def cancel(self, task_id: str) -> bool:
+        with self._lock:
+            for key, entry in list(self.entries.items()):
+                if entry["task_id"] == task_id:
+                    del self.entries[key]
+                    task_service.cancel_task(task_id)
+                    return True
+        return False
+
+    def cancel_client(self, client_id: str) -> int:
+        """Drop a client's unclaimed speculations, e.g. when a newer chat turn supersedes them."""
+        cancelled = 0
+        with self._lock:
+            for key, entry in list(self.entries.items()):
+                if entry["client_id"] == client_id:
+                    del self.entries[key]
+                    task_service.cancel_task(entry["task_id"])
+                    cancelled += 1
+        return cancelled
+
+    @staticmethod
+    def _is_active(task_id: str) -> bool:
+        task = task_service.get_task(task_id)
+        return bool(task) and task["status"] in ("pending", "processing")
+
+    def _expire_locked(self):
+        now = time.time()
+        for key, entry in list(self.entries.items()):
+            if now - entry["created_at"] > config.SPECULATION_TTL_SECONDS:
+                del self.entries[key]
+                task_service.cancel_task(entry["task_id"])
+
+speculation_service = SpeculationService()
@@ -1,12 +1,21 @@
 import uuid
 import time
+import threading
 from typing import Dict, Any, Optional
+from config import config
+from services.cancellation import CancelToken
 
 class TaskService:
     def __init__(self):
         # In-memory storage for tasks
         # In production, this should be Redis or a database
         self.tasks: Dict[str, Dict[str, Any]] = {}
+        # Per running task; cancel_task() fires it to abort the task's upstream calls
+        self._cancel_tokens: Dict[str, CancelToken] = {}
+        # Last status poll per task, for abandoned-task detection
+        self._last_polled: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._watch_thread: Optional[threading.Thread] = None
 
     def create_task(self, task_type: str = "image_generation") -> str:
         task_id = str(uuid.uuid4())
@@ -19,7 +28,9 @@ class TaskService:
             "result": None,
             "error": None,
             "created_at": time.time(),
-            "updated_at": time.time()
+            "updated_at": time.time(),
+            # [seconds since created_at, progress] per progress change, for stage timings
+            "timeline": [[0.0, 0]]
         }
         return task_id
 
@@ -28,9 +39,14 @@ class TaskService:
             return
         
         task = self.tasks[task_id]
+        # A cancelled task keeps its status; late updates from its worker are ignored
+        if task["status"] == "cancelled":
+            return
         if status:
             task["status"] = status
         if progress is not None:
+            if progress != task["progress"]:
+                task["timeline"].append([round(time.time() - task["created_at"], 3), progress])
             task["progress"] = progress
         if progress_message is not None:
             task["progress_message"] = progress_message
@@ -44,6 +60,70 @@ class TaskService:
     def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
         return self.tasks.get(task_id)
 
+    def cancel_task(self, task_id: str) -> bool:
+        task = self.tasks.get(task_id)
+        if not task or task["status"] in ("succeed", "failed", "cancelled"):
+            return False
+        task["status"] = "cancelled"
+        task["progress_message"] = "已取消"
+        task["updated_at"] = time.time()
+        with self._lock:
+            token = self._cancel_tokens.get(task_id)
+        if token:
+            token.cancel()
+        return True
+
+    def cancel_token(self, task_id: str) -> CancelToken:
+        """The task's CancelToken, already fired if the task was cancelled before it started."""
+        with self._lock:
+            token = self._cancel_tokens.setdefault(task_id, CancelToken())
+        if self.is_cancelled(task_id):
+            token.cancel()
+        return token
+
+    def release_cancel_token(self, task_id: str):
+        with self._lock:
+            self._cancel_tokens.pop(task_id, None)
+            self._last_polled.pop(task_id, None)
+
+    def touch(self, task_id: str):
+        """Record a status poll; a running task nobody polls any more is cancelled by the abandon watch."""
+        with self._lock:
+            if task_id in self._cancel_tokens:
+                self._last_polled[task_id] = time.time()
+
+    def start_abandon_watch(self):
+        """Cancel running tasks whose client stopped polling for TASK_ABANDON_SECONDS (0 disables)."""
+        if config.TASK_ABANDON_SECONDS <= 0 or (self._watch_thread and self._watch_thread.is_alive()):
+            return
+        self._watch_thread = threading.Thread(target=self._watch_loop, name="task-abandon-watch", daemon=True)
+        self._watch_thread.start()
+
+    def _watch_loop(self):
+        interval = max(1.0, config.TASK_ABANDON_SECONDS / 4)
+        while True:
+            time.sleep(interval)
+            try:
+                self.cancel_abandoned()
+            except Exception as e:
+                print(f"Abandoned task check failed: {e}")
+
+    def cancel_abandoned(self) -> int:
+        # Tasks never polled (batch runs, speculations) are not abandoned
+        cutoff = time.time() - config.TASK_ABANDON_SECONDS
+        with self._lock:
+            stale = [tid for tid, polled in self._last_polled.items() if polled < cutoff]
+        cancelled = 0
+        for tid in stale:
+            if self.cancel_task(tid):
+                print(f"Task {tid} cancelled: not polled for {config.TASK_ABANDON_SECONDS}s")
+                cancelled += 1
+        return cancelled
+
+    def is_cancelled(self, task_id: str) -> bool:
+        task = self.tasks.get(task_id)
+        return bool(task) and task["status"] == "cancelled"
+
     def cleanup_old_tasks(self, max_age_seconds: int = 3600):
         """Remove tasks older than max_age_seconds"""
         now = time.time()
@@ -0,0 +1,153 @@
+import base64
+import json
+import re
+import secrets
+import uuid
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+# Multiple of 3, so chunks base64-encode independently with no padding in between
+B64_CHUNK = 3 * 64 * 1024
+RAW_CHUNK = 256 * 1024
+
+Part = Union[bytes, bytearray, memoryview, "Base64Image"]
+
+
+class Base64Image:
+    """Image bytes that go upstream as a base64 string (or data URL), encoded only while sending.
+
+    Put it in a payload where the string would go; json_body() streams it
+    chunk by chunk, so the encoded copy never exists in full.
+    """
+
+    __slots__ = ("data", "mime", "prefix")
+
+    def __init__(self, data: bytes, mime: Optional[str] = None):
+        self.data = data
+        self.mime = mime
+        self.prefix = f"data:{mime};base64,".encode("ascii") if mime else b""
+
+    def __len__(self) -> int:
+        return len(self.prefix) + 4 * ((len(self.data) + 2) // 3)
+
+    def __repr__(self) -> str:
+        return f"<{self.mime or 'base64'} image, {len(self.data)} bytes>"
+
+    def chunks(self) -> Iterator[bytes]:
+        if self.prefix:
+            yield self.prefix
+        view = memoryview(self.data)
+        for start in range(0, len(view), B64_CHUNK):
+            yield base64.b64encode(view[start:start + B64_CHUNK])
+
+
+def data_url(data: bytes, mime: str = "image/png") -> Base64Image:
+    return Base64Image(data, mime)
+
+
+class StreamingBody:
+    """A request body of known length, produced part by part.
+
+    Pass reader() as requests' data=: requests sends it with a Content-Length
+    and urllib3 pulls it in small blocks. Each attempt of a retry loop needs a
+    fresh reader().
+    """
+
+    def __init__(self, parts: List[Part], content_type: str):
+        self.parts = parts
+        self.content_type = content_type
+        self.length = sum(len(part) for part in parts)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def iter_chunks(self) -> Iterator[Union[bytes, memoryview]]:
+        for part in self.parts:
+            if isinstance(part, Base64Image):
+                yield from part.chunks()
+            else:
+                view = memoryview(part)
+                for start in range(0, len(view), RAW_CHUNK):
+                    yield view[start:start + RAW_CHUNK]
+
+    def reader(self) -> "BodyReader":
+        return BodyReader(self)
+
+
+class BodyReader:
+    """Minimal read-only file object over a StreamingBody."""
+
+    def __init__(self, body: StreamingBody):
+        self.body = body
+        self._chunks = body.iter_chunks()
+        self._current = memoryview(b"")
+        self._position = 0
+
+    def __len__(self) -> int:
+        return self.body.length - self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            data = bytes(self._current) + b"".join(bytes(chunk) for chunk in self._chunks)
+            self._current = memoryview(b"")
+            self._position += len(data)
+            return data
+        while not self._current:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b""
+            self._current = memoryview(chunk)
+        data = bytes(self._current[:size])
+        self._current = self._current[size:]
+        self._position += len(data)
+        return data
+
+
+def json_body(payload: Any) -> StreamingBody:
+    """Serialize like requests' json= (ensure_ascii, allow_nan=False), streaming every Base64Image."""
+    token = secrets.token_hex(8)
+    images: List[Base64Image] = []
+
+    def placeholder(obj):
+        if isinstance(obj, Base64Image):
+            images.append(obj)
+            return f"{token}:{len(images) - 1}"
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    text = json.dumps(payload, default=placeholder, allow_nan=False)
+    parts: List[Part] = []
+    position = 0
+    for match in re.finditer(f'"{token}:(\\d+)"', text):
+        # Keep the quotes: base64 and the data URL prefix need no JSON escaping
+        parts.append(text[position:match.start() + 1].encode("utf-8"))
+        parts.append(images[int(match.group(1))])
+        position = match.end() - 1
+    parts.append(text[position:].encode("utf-8"))
+    return StreamingBody(parts, "application/json")
+
+
+def multipart_body(fields: dict, files: List[Tuple[str, Tuple[str, Part, str]]]) -> StreamingBody:
+    """multipart/form-data like requests' data= + files=: fields first, file bytes streamed as they are."""
+    boundary = uuid.uuid4().hex
+    parts: List[Part] = []
+    for name, value in (fields or {}).items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode("utf-8")
+            + str(value).encode("utf-8") + b"\r\n"
+        )
+    for name, (filename, content, content_type) in files:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode("utf-8")
+        )
+        parts.append(content)
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return StreamingBody(parts, f"multipart/form-data; boundary={boundary}")
+
+
+def loggable_json(payload: Any, **kwargs) -> str:
+    """json.dumps for debug logs: images show as a short description instead of megabytes of base64."""
+    return json.dumps(payload, default=repr, **kwargs)
@@ -0,0 +1,148 @@
+import io
+import os
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+from config import config
+from services.cpu_pool import cpu_pool
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow is optional: without it the original image is always served
+    Image = None
+    features = None
+
+VARIANT_DIR = os.path.join(config.STATIC_DIR, "variants")
+
+# Longest edge in pixels; "full" only re-encodes
+VARIANT_SIZES = {
+    "thumb": 320,
+    "preview": 1280,
+    "full": None
+}
+EAGER_SIZES = ("thumb", "preview")
+
+FORMAT_MEDIA_TYPES = {
+    "avif": "image/avif",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg"
+}
+
+FORMAT_OPTIONS = {
+    "avif": {"quality": 60},
+    "webp": {"quality": 80, "method": 4},
+    "jpeg": {"quality": 85, "optimize": True, "progressive": True}
+}
+
+
+def encode_variants(image_bytes: bytes, targets: List[Tuple[str, str, str]]):
+    """Decode once, then resize and write each (size, format, path); runs in the CPU pool."""
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        source.load()
+        for size in dict.fromkeys(s for s, _, _ in targets):
+            resized = source.copy()
+            if VARIANT_SIZES[size]:
+                resized.thumbnail((VARIANT_SIZES[size], VARIANT_SIZES[size]), Image.LANCZOS)
+            for fmt, path in [(f, p) for s, f, p in targets if s == size]:
+                frame = resized
+                if fmt == "jpeg" and frame.mode not in ("RGB", "L"):
+                    frame = frame.convert("RGB")
+                elif frame.mode not in ("RGB", "RGBA", "L"):
+                    frame = frame.convert("RGBA")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        frame.save(f, format=fmt.upper(), **FORMAT_OPTIONS[fmt])
+                    os.replace(tmp_path, path)
+                except Exception:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+
+
+class VariantService:
+    """Resized, re-encoded derivatives of history images.
+
+    static/variants/<history path>.<size>.<format>, e.g.
+    2026/10/19/ab/1792.thumb.webp. Variants are written by the history writer
+    when an entry is saved and generated on first request for older entries.
+    """
+
+    def __init__(self, root: str = VARIANT_DIR):
+        self.root = root
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    def formats(self) -> List[str]:
+        """Configured formats this Pillow build can encode, most compact first."""
+        if not self.enabled:
+            return []
+        available = []
+        for fmt in config.HISTORY_VARIANT_FORMATS:
+            if fmt == "jpeg" or (fmt in FORMAT_MEDIA_TYPES and features.check(fmt)):
+                available.append(fmt)
+        return available
+
+    def negotiate(self, accept: str, requested: Optional[str] = None) -> Optional[str]:
+        """Pick an output format from an explicit ?format= or the Accept header."""
+        available = self.formats()
+        if requested and requested != "auto":
+            return requested if requested in available else None
+        accept = (accept or "").lower()
+        for fmt in available:
+            if FORMAT_MEDIA_TYPES[fmt] in accept:
+                return fmt
+        # Every browser decodes JPEG
+        return "jpeg" if "jpeg" in available else None
+
+    def path_for(self, stem: str, size: str, fmt: str) -> str:
+        return os.path.join(self.root, *stem.split("/")) + f".{size}.{fmt}"
+
+    def url_for(self, stem: str, size: str, fmt: str) -> str:
+        return f"/static/variants/{stem}.{size}.{fmt}"
+
+    def files_for(self, stem: str) -> List[str]:
+        """Every variant written for a history entry (used by retention)."""
+        base = os.path.join(self.root, *stem.split("/"))
+        directory, prefix = os.path.dirname(base), os.path.basename(base) + "."
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, n) for n in os.listdir(directory) if n.startswith(prefix)]
+
+    def get_or_create(self, stem: str, source_path: str, size: str, fmt: str) -> Optional[str]:
+        """Path of the variant, encoding it from source_path on first use."""
+        path = self.path_for(stem, size, fmt)
+        if os.path.exists(path):
+            return path
+        if not self.enabled or size not in VARIANT_SIZES or not os.path.exists(source_path):
+            return None
+        # One encoder per variant; concurrent requests wait for it instead of encoding again
+        with self._lock_for(path):
+            if not os.path.exists(path):
+                with open(source_path, "rb") as f:
+                    self._write(stem, f.read(), [(size, fmt)])
+        return path if os.path.exists(path) else None
+
+    def generate_all(self, stem: str, image_bytes: bytes):
+        """Eagerly write every size in every available format (history writer thread)."""
+        if not self.enabled:
+            return
+        self._write(stem, image_bytes, [(size, fmt) for size in EAGER_SIZES for fmt in self.formats()])
+
+    def _write(self, stem: str, image_bytes: bytes, targets: List[Tuple[str, str]]):
+        # Decoding and resizing hold the GIL; always worth a trip to the pool
+        jobs = [(size, fmt, self.path_for(stem, size, fmt)) for size, fmt in targets]
+        cpu_pool.run(encode_variants, image_bytes, jobs, min_bytes=0)
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        with self._locks_lock:
+            if len(self._locks) > 1024:
+                self._locks = {k: v for k, v in self._locks.items() if v.locked()}
+            return self._locks.setdefault(key, threading.Lock())
+
+variant_service = VariantService()
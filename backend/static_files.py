@@ -0,0 +1,186 @@
+"""Static file serving with long-lived caching and precompressed variants.
+
+CachedStaticFiles is a drop-in StaticFiles that adds:
+- Cache-Control: immutable for content-hashed assets and write-once history files,
+  no-cache (always revalidate) for everything else
+- strong ETags: the content hash when the file name carries one (works across
+  restarts and replicas), otherwise size and mtime, so no request reads the file
+- .br / .gz siblings served by Accept-Encoding; on mounts created with
+  compress=True (the frontend bundles) .gz is created in the background the
+  first time a compressible file is requested, both can be built ahead with
+      python static_files.py precompress ../dist
+
+Range requests are handled by Starlette's FileResponse.
+"""
+import argparse
+import gzip
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+from typing import Callable, Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # .br files are still served when built elsewhere
+    brotli = None
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+COMPRESSIBLE_SUFFIXES = (".js", ".mjs", ".css", ".html", ".svg", ".json", ".map", ".txt", ".xml", ".wasm")
+MIN_COMPRESS_BYTES = 1024
+
+# Vite output names: index-DvHFSWF4.js
+HASHED_ASSET_RE = re.compile(r"-[A-Za-z0-9_-]{8,}\.[a-z0-9]+$")
+# Blob store names: <sha256>.<ext>
+CONTENT_HASH_RE = re.compile(r"^([0-9a-f]{64})\.[a-z0-9]+$")
+
+
+def is_hashed_asset(rel_path: str) -> bool:
+    return bool(HASHED_ASSET_RE.search(os.path.basename(rel_path)))
+
+
+def is_write_once_static(rel_path: str) -> bool:
+    """static/: blobs are content-addressed; history and variants are never rewritten in place."""
+    return rel_path.replace(os.sep, "/").split("/", 1)[0] in ("blobs", "history", "variants")
+
+
+def _compress_file(path: str, encoding: str):
+    target = f"{path}.{encoding}"
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+            if encoding == "br":
+                dst.write(brotli.compress(src.read(), quality=11))
+            else:
+                with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=9, mtime=0) as gz:
+                    shutil.copyfileobj(src, gz)
+        # mkstemp creates 0600; match the file being compressed
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        os.replace(tmp_path, target)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def precompress(directory: str) -> int:
+    """Write .gz (and .br when brotli is installed) next to every compressible file."""
+    encodings = ["gz"] + (["br"] if brotli else [])
+    written = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not name.endswith(COMPRESSIBLE_SUFFIXES) or os.path.getsize(path) < MIN_COMPRESS_BYTES:
+                continue
+            for encoding in encodings:
+                _compress_file(path, encoding)
+                written += 1
+    return written
+
+
+class CachedStaticFiles(StaticFiles):
+    def __init__(self, *args, immutable: Optional[Callable[[str], bool]] = None, compress: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.immutable = immutable or (lambda rel_path: False)
+        # Only for build output: generated files (history JSON) would collect siblings nobody removes
+        self.compress = compress
+        self._compress_lock = threading.Lock()
+        self._compressing = set()
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        rel_path = os.path.relpath(full_path, self.directory) if self.directory else full_path
+
+        immutable = self.immutable(rel_path)
+        headers = {
+            "cache-control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+        }
+        serve_path, serve_stat, encoding = full_path, stat_result, None
+        if full_path.endswith(COMPRESSIBLE_SUFFIXES):
+            headers["vary"] = "Accept-Encoding"
+        # Ranges are served from the identity body so resumed downloads line up byte for byte
+        if full_path.endswith(COMPRESSIBLE_SUFFIXES) and "range" not in request_headers:
+            serve_path, serve_stat, encoding = self._pick_encoding(full_path, stat_result, request_headers.get("accept-encoding", ""))
+
+        # Each encoding is its own representation with its own validator
+        etag = self._etag(full_path, stat_result)
+        headers["etag"] = f'"{etag}-{encoding}"' if encoding else f'"{etag}"'
+        if encoding:
+            headers["content-encoding"] = "br" if encoding == "br" else "gzip"
+
+        # media_type from the original name, not the .br/.gz sibling
+        response = FileResponse(serve_path, status_code=status_code, headers=headers, media_type=self._media_type(full_path), stat_result=serve_stat)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    @staticmethod
+    def _media_type(path: str) -> str:
+        return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    def _pick_encoding(self, path: str, stat_result: os.stat_result, accept_encoding: str):
+        accepted = {token.split(";")[0].strip().lower() for token in accept_encoding.split(",")}
+        for encoding, token in (("br", "br"), ("gz", "gzip")):
+            if token not in accepted:
+                continue
+            try:
+                variant_stat = os.stat(f"{path}.{encoding}")
+            except FileNotFoundError:
+                continue
+            # A sibling older than the file it was built from is stale
+            if variant_stat.st_mtime_ns >= stat_result.st_mtime_ns:
+                return f"{path}.{encoding}", variant_stat, encoding
+
+        if self.compress and stat_result.st_size >= MIN_COMPRESS_BYTES:
+            self._compress_in_background(path)
+        return path, stat_result, None
+
+    def _compress_in_background(self, path: str):
+        # This request gets the identity body; later ones get the compressed sibling
+        with self._compress_lock:
+            if path in self._compressing:
+                return
+            self._compressing.add(path)
+
+        def run():
+            try:
+                for encoding in ["gz"] + (["br"] if brotli else []):
+                    _compress_file(path, encoding)
+            except OSError as e:
+                print(f"Static precompression failed for {path}: {e}")
+            finally:
+                with self._compress_lock:
+                    self._compressing.discard(path)
+
+        threading.Thread(target=run, name="static-precompress", daemon=True).start()
+
+    @staticmethod
+    def _etag(path: str, stat_result: os.stat_result) -> str:
+        match = CONTENT_HASH_RE.match(os.path.basename(path))
+        if match:
+            return match.group(1)
+        # Hashed asset names change with their content, and writes bump size or mtime
+        return f"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Static asset maintenance.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("precompress", help="Write .gz/.br siblings for compressible files")
+    build.add_argument("directory")
+    args = parser.parse_args()
+    written = precompress(args.directory)
+    print(f"Wrote {written} precompressed files under {args.directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+# Services are module singletons configured at import time: point them at scratch storage first
+_SCRATCH = tempfile.mkdtemp(prefix="backend-tests-")
+os.environ.setdefault("STATIC_DIR", os.path.join(_SCRATCH, "static"))
+os.environ.setdefault("HISTORY_DB_PATH", os.path.join(_SCRATCH, "data", "history.db"))
+os.environ.setdefault("HISTORY_JOURNAL_DIR", os.path.join(_SCRATCH, "data", "history_journal"))
+# Hashing and encoding inline: no process pool to start or import into
+os.environ.setdefault("CPU_POOL_WORKERS", "0")
+os.environ.setdefault("TASK_ABANDON_SECONDS", "0")
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+import time
+
+from services.byte_budget import ByteBudget
+
+
+def _wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached in time"
+        time.sleep(0.005)
+
+
+def test_release_returns_budget_to_zero():
+    budget = ByteBudget(100)
+    first = budget.acquire(60, label="a")
+    second = budget.try_acquire(40, label="b")
+    assert budget.snapshot()["in_use_by_label"] == {"a": 60, "b": 40}
+
+    first.release()
+    first.release()
+    second.release()
+    snapshot = budget.snapshot()
+    assert snapshot["in_use_bytes"] == 0
+    assert snapshot["in_use_by_label"] == {}
+    assert snapshot["waiting"] == 0
+
+
+def test_waiters_are_served_in_arrival_order():
+    budget = ByteBudget(100)
+    blocker = budget.acquire(100)
+    order = []
+
+    def take(name, nbytes):
+        lease = budget.acquire(nbytes, timeout=2)
+        order.append(name)
+        lease.release()
+
+    large = threading.Thread(target=take, args=("large", 90))
+    large.start()
+    _wait_for(lambda: budget.snapshot()["waiting"] == 1)
+    small = threading.Thread(target=take, args=("small", 10))
+    small.start()
+    _wait_for(lambda: budget.snapshot()["waiting"] == 2)
+
+    # A small request does not jump the queue ahead of the large one
+    assert budget.try_acquire(1) is None
+    blocker.release()
+    large.join(2)
+    small.join(2)
+    assert order == ["large", "small"]
+    assert budget.snapshot()["in_use_bytes"] == 0
+
+
+def test_async_and_thread_waiters_share_the_queue():
+    budget = ByteBudget(100)
+    blocker = budget.acquire(100)
+    order = []
+
+    def take_sync():
+        lease = budget.acquire(60, timeout=2)
+        order.append("sync")
+        lease.release()
+
+    async def main():
+        async def take_async():
+            lease = await budget.acquire_async(60, timeout=2)
+            order.append("async")
+            lease.release()
+
+        waiter = asyncio.create_task(take_async())
+        while budget.snapshot()["waiting"] < 1:
+            await asyncio.sleep(0.005)
+        thread = threading.Thread(target=take_sync)
+        thread.start()
+        while budget.snapshot()["waiting"] < 2:
+            await asyncio.sleep(0.005)
+        blocker.release()
+        await waiter
+        await asyncio.get_running_loop().run_in_executor(None, thread.join, 2)
+
+    asyncio.run(main())
+    assert order == ["async", "sync"]
+    assert budget.snapshot()["in_use_bytes"] == 0
+
+
+def test_timed_out_and_cancelled_waiters_leave_the_queue():
+    budget = ByteBudget(100)
+    blocker = budget.acquire(100)
+
+    assert budget.acquire(10, timeout=0.05) is None
+
+    async def main():
+        assert await budget.acquire_async(10, timeout=0.05) is None
+        waiter = asyncio.create_task(budget.acquire_async(10))
+        while budget.snapshot()["waiting"] < 1:
+            await asyncio.sleep(0.005)
+        waiter.cancel()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    snapshot = budget.snapshot()
+    assert snapshot["waiting"] == 0
+    assert snapshot["rejected"] == 2
+
+    blocker.release()
+    # Nobody left queued ahead, so a new request is admitted at once
+    lease = budget.try_acquire(100)
+    assert lease is not None
+    lease.release()
+    assert budget.snapshot()["in_use_bytes"] == 0
+
+
+def test_hold_is_granted_over_capacity_and_blocks_later_acquirers():
+    budget = ByteBudget(100)
+    first = budget.acquire(80)
+    held = budget.hold(50, label="history_pending")
+    assert budget.snapshot()["in_use_bytes"] == 130
+
+    first.release()
+    assert budget.acquire(60, timeout=0.05) is None
+    held.release()
+    lease = budget.acquire(60, timeout=0.05)
+    assert lease is not None
+    lease.release()
+    assert budget.snapshot()["in_use_bytes"] == 0
@@ -0,0 +1,28 @@
+import pytest
+
+from services import export_service
+from services.export_service import ExportTooLarge, build_history_export
+from services.history_service import HistoryService
+
+
+@pytest.fixture
+def indexed(tmp_path, monkeypatch):
+    service = HistoryService(db_path=str(tmp_path / "history.db"), history_dir=str(tmp_path / "history"))
+    for i in range(1, 6):
+        service.record({"timestamp": i, "original_prompt": f"prompt {i}", "model": "m", "session": "client-1"}, "", [], commit=False)
+    service.commit()
+    monkeypatch.setattr(export_service, "history_service", service)
+    return service
+
+
+def test_filtered_export_over_the_cap_is_refused(indexed):
+    with pytest.raises(ExportTooLarge):
+        build_history_export(max_entries=4, model="m")
+
+
+def test_export_at_the_cap_keeps_every_entry(indexed):
+    export = build_history_export(max_entries=5, model="m")
+    names = [member["name"] for member in export.members]
+    assert len(names) == 5
+    assert all(name.endswith("/metadata.json") for name in names)
+    assert b"client-1" not in b"".join(export.iter_bytes())
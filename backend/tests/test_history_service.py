@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from services.history_service import HistoryService, history_service
+
+
+def test_touch_does_not_wait_for_the_index_lock():
+    # A write-behind commit holding the index lock must not stall requests that serve history files
+    with history_service._lock:
+        done = threading.Event()
+        worker = threading.Thread(target=lambda: (history_service.touch("/static/history/123.png"), done.set()))
+        worker.start()
+        assert done.wait(2)
+        worker.join()
+    history_service.flush_access()
+    assert not history_service._access
+
+
+def test_touch_asks_for_a_flush_when_the_buffer_is_full():
+    due = [history_service.touch(f"/static/history/{i}.png") for i in range(1, 501)]
+    assert not any(due[:-1]) and due[-1]
+    assert not history_service.touch("/static/history/not-an-id.png")
+    history_service.flush_access()
+
+
+def _indexed_service(tmp_path):
+    service = HistoryService(db_path=str(tmp_path / "history.db"), history_dir=str(tmp_path / "history"))
+    words = ["red", "blue", "green"]
+    for i in range(1, 61):
+        prompt = " ".join(["sneaker"] + [words[i % 3]] * (1 + i % 4))
+        service.record({"timestamp": i, "original_prompt": prompt, "optimized_prompt": "studio sneaker shot", "model": "m"}, "", [], commit=False)
+    service.commit()
+    return service
+
+
+def _all_pages(service, query, limit):
+    ids, cursor = [], None
+    while True:
+        page = service.search(query, cursor=cursor, limit=limit)
+        ids += [item["id"] for item in page["items"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            return ids
+
+
+@pytest.mark.parametrize("fts", [True, False])
+def test_search_pages_cover_the_ranking_once(tmp_path, fts):
+    service = _indexed_service(tmp_path)
+    service.fts_enabled = service.fts_enabled and fts
+    full = [item["id"] for item in service.search("sneaker", limit=100)["items"]]
+    assert len(full) == 60
+
+    paged = _all_pages(service, "sneaker", 7)
+    assert paged == full
+
+
+def test_search_rejects_malformed_cursor(tmp_path):
+    service = _indexed_service(tmp_path)
+    with pytest.raises(ValueError):
+        service.search("sneaker", cursor="not-a-cursor")
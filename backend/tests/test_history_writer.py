@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from services.byte_budget import byte_budget
+from services.history_service import history_service
+from services.history_writer import HistoryWriter
+
+
+@pytest.fixture
+def writer(tmp_path, monkeypatch):
+    monkeypatch.setattr("services.history_writer.config.HISTORY_WRITE_BATCH_MS", 1)
+    monkeypatch.setattr("services.history_writer.config.HISTORY_VARIANTS_EAGER", False)
+    return HistoryWriter(history_dir=str(tmp_path / "history"), journal_dir=str(tmp_path / "journal"))
+
+
+def _pending_bytes():
+    return byte_budget.snapshot()["in_use_by_label"].get("history_pending", 0)
+
+
+def _submit(writer, timestamp):
+    return writer.submit(timestamp, {"timestamp": timestamp, "path": str(timestamp)}, image_bytes=b"\x89PNG\r\n\x1a\n" + b"x" * 1000, originals=[b"\xff\xd8\xff" + b"y" * 500])
+
+
+def test_budget_returns_to_zero_after_permanent_write_failure(writer, monkeypatch):
+    monkeypatch.setattr("services.history_writer.config.HISTORY_WRITE_RETRIES", 1)
+    monkeypatch.setattr(writer, "_materialize", lambda job: (_ for _ in ()).throw(OSError("disk full")))
+
+    saved = _submit(writer, 1001)
+    assert _pending_bytes() == 1511
+    assert writer.get_pending(saved["image_url"])
+
+    # One retry after 2 s, then the writer gives up
+    assert writer.flush(timeout=10)
+    assert _pending_bytes() == 0
+    assert writer.get_pending(saved["image_url"]) is None
+    assert not writer.pending
+    # Left for the replay on restart
+    assert sorted(os.listdir(writer.journal_dir)) == [".lock", "1001.job"]
+
+
+def test_lease_released_once_a_retried_write_lands(writer, monkeypatch):
+    materialize = writer._materialize
+    failures = []
+
+    def flaky(job):
+        if not failures:
+            failures.append(job["timestamp"])
+            raise OSError("transient")
+        return materialize(job)
+
+    monkeypatch.setattr(writer, "_materialize", flaky)
+    saved = _submit(writer, 1002)
+
+    assert writer.flush(timeout=10)
+    assert failures == [1002]
+    assert _pending_bytes() == 0
+    assert not writer.pending
+    assert os.path.exists(history_service.files_for(1002, "1002")["image"])
+    assert sorted(os.listdir(writer.journal_dir)) == [".lock"]
+    assert saved["image_url"] == "/static/history/1002.png"
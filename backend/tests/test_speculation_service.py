@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+
+from services.speculation_service import SpeculationService
+from services.task_service import task_service
+
+
+@pytest.fixture
+def speculation():
+    return SpeculationService()
+
+
+def test_second_confirm_creates_fresh_task(speculation):
+    key = speculation.make_key("prompt", "1:1", "nano_banana_2", ["a"])
+    task_id = speculation.reserve("client-1", key)
+    assert task_id
+
+    assert speculation.attach("client-1", key) == task_id
+    # The speculation is used up: the next confirm falls through to a new generation
+    assert speculation.attach("client-1", key) is None
+    assert task_service.get_task(task_id)["type"] == "image_generation"
+
+
+def test_attach_is_scoped_to_the_client(speculation):
+    key = speculation.make_key("prompt", "1:1", "nano_banana_2", [])
+    task_id = speculation.reserve("client-1", key)
+
+    assert speculation.attach("client-2", key) is None
+    assert speculation.attach("client-1", key) == task_id
+
+
+def test_attach_skips_cancelled_speculation(speculation):
+    key = speculation.make_key("prompt", "1:1", "nano_banana_2", [])
+    task_id = speculation.reserve("client-1", key)
+    task_service.cancel_task(task_id)
+
+    assert speculation.attach("client-1", key) is None
+
+
+def test_claimed_task_survives_a_newer_chat_turn(speculation):
+    key = speculation.make_key("prompt", "1:1", "nano_banana_2", [])
+    task_id = speculation.reserve("client-1", key)
+    speculation.attach("client-1", key)
+
+    assert speculation.cancel_client("client-1") == 0
+    assert not speculation.cancel(task_id)
+    assert task_service.get_task(task_id)["status"] != "cancelled"
+
+
+def test_concurrent_confirms_claim_once(speculation):
+    key = speculation.make_key("prompt", "1:1", "nano_banana_2", [])
+    task_id = speculation.reserve("client-1", key)
+    results = []
+    barrier = threading.Barrier(8)
+
+    def confirm():
+        barrier.wait()
+        results.append(speculation.attach("client-1", key))
+
+    threads = [threading.Thread(target=confirm) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(task_id) == 1
+    assert results.count(None) == 7
+
+
+def test_claim_races_cancel_client(speculation):
+    # Either the confirm wins and the task keeps running, or the cancel wins and the confirm starts fresh
+    for _ in range(50):
+        key = speculation.make_key("prompt", "1:1", "nano_banana_2", [])
+        task_id = speculation.reserve("client-1", key)
+        claimed = []
+        barrier = threading.Barrier(2)
+
+        def confirm():
+            barrier.wait()
+            claimed.append(speculation.attach("client-1", key))
+
+        def supersede():
+            barrier.wait()
+            speculation.cancel_client("client-1")
+
+        threads = [threading.Thread(target=confirm), threading.Thread(target=supersede)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        status = task_service.get_task(task_id)["status"]
+        if claimed[0] == task_id:
+            assert status != "cancelled"
+        else:
+            assert claimed[0] is None and status == "cancelled"
+        assert not speculation.entries
+
+
+def test_per_client_cap(speculation, monkeypatch):
+    monkeypatch.setattr("services.speculation_service.config.SPECULATION_PER_CLIENT", 1)
+    first = speculation.reserve("client-1", "k1")
+    assert first
+    assert speculation.reserve("client-1", "k2") is None
+    assert speculation.reserve("client-2", "k2")
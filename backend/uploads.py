@@ -0,0 +1,199 @@
+"""Upload limits enforced while the request body streams, and spooled upload hand-off.
+
+UploadLimitMiddleware meters the raw body of selected POST routes as the
+server receives it, running a second, lightweight multipart parser to
+attribute bytes to files and form fields. The first limit crossed stops the
+read and answers 413 instead of whatever the route would have returned, so an
+oversized upload never finishes buffering. (Clients that keep sending after
+the 413 may see the connection closed instead.)
+
+Accepted files stay in Starlette's spooled temp files; read_uploads() hands
+them to the services as bytes when small or as read-only mmaps of the
+temp file otherwise. An mmap outlives the request's UploadFile, so background
+generation can keep using it.
+"""
+import mmap
+from typing import Dict, Iterable, List, Optional, Union
+
+from starlette.datastructures import Headers, UploadFile
+from starlette.formparsers import MultiPartParser
+from starlette.responses import JSONResponse
+from services.bulkhead import disk_bulkhead
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+MB = 1024 * 1024
+
+UploadBuffer = Union[bytes, mmap.mmap]
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class UploadMeter:
+    """Counts body bytes per request, per form field and per file as chunks arrive."""
+
+    def __init__(self, boundary: Optional[bytes], max_file: int, max_field: int, max_request: int, max_files: int):
+        self.max_file = max_file
+        self.max_field = max_field
+        self.max_request = max_request
+        self.max_files = max_files
+        self.total = 0
+        self.files = 0
+        self.field_bytes: Dict[str, int] = {}
+        self._part_bytes = 0
+        self._part_name = ""
+        self._part_is_file = False
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: Dict[bytes, bytes] = {}
+        self._parser = None
+        if boundary:
+            self._parser = MultipartParser(boundary, {
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+                "on_part_data": self._on_part_data
+            })
+
+    def feed(self, chunk: bytes):
+        self.total += len(chunk)
+        if self.max_request and self.total > self.max_request:
+            raise UploadTooLarge(f"Request body exceeds {_limit_mb(self.max_request)}")
+        if self._parser and chunk:
+            self._parser.write(chunk)
+
+    def _on_part_begin(self):
+        self._part_bytes = 0
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._part_name = options.get(b"name", b"").decode("latin-1")
+        self._part_is_file = b"filename" in options
+        if self._part_is_file:
+            self.files += 1
+            if self.max_files and self.files > self.max_files:
+                raise UploadTooLarge(f"More than {self.max_files} files in one request")
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        size = end - start
+        self._part_bytes += size
+        field_total = self.field_bytes.get(self._part_name, 0) + size
+        self.field_bytes[self._part_name] = field_total
+        if self._part_is_file and self.max_file and self._part_bytes > self.max_file:
+            raise UploadTooLarge(f"File in field '{self._part_name}' exceeds {_limit_mb(self.max_file)}")
+        if self.max_field and field_total > self.max_field:
+            raise UploadTooLarge(f"Field '{self._part_name}' exceeds {_limit_mb(self.max_field)}")
+
+
+def _limit_mb(limit: int) -> str:
+    return f"{limit / MB:g} MB"
+
+
+class UploadLimitMiddleware:
+    """Pure ASGI middleware: 413 as soon as an upload on one of `paths` crosses a limit (bytes; 0 = off)."""
+
+    def __init__(self, app, paths: Iterable[str], max_file: int = 0, max_field: int = 0, max_request: int = 0, max_files: int = 0):
+        self.app = app
+        self.paths = set(paths)
+        self.limits = dict(max_file=max_file, max_field=max_field, max_request=max_request, max_files=max_files)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        max_request = self.limits["max_request"]
+        content_length = headers.get("content-length")
+        if max_request and content_length and content_length.isdigit() and int(content_length) > max_request:
+            await _reject(scope, receive, send, f"Request body exceeds {_limit_mb(max_request)}")
+            return
+
+        boundary = None
+        content_type, options = parse_options_header(headers.get("content-type", ""))
+        if content_type == b"multipart/form-data":
+            boundary = options.get(b"boundary")
+        meter = UploadMeter(boundary, **self.limits)
+        state = {"error": None, "started": False}
+
+        async def metered_receive():
+            message = await receive()
+            if message["type"] == "http.request" and state["error"] is None:
+                try:
+                    meter.feed(message.get("body", b""))
+                except UploadTooLarge as e:
+                    state["error"] = e
+                    raise
+            return message
+
+        async def guarded_send(message):
+            # The route answers the aborted parse with an error of its own; the 413 replaces it
+            if state["error"] is not None and not state["started"]:
+                if message["type"] == "http.response.start":
+                    state["started"] = True
+                    await _reject(scope, receive, send, state["error"].detail)
+                return
+            if state["error"] is not None:
+                return
+            if message["type"] == "http.response.start":
+                state["started"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, metered_receive, guarded_send)
+        except UploadTooLarge as e:
+            if not state["started"]:
+                state["started"] = True
+                await _reject(scope, receive, send, e.detail)
+
+
+async def _reject(scope, receive, send, detail: str):
+    # Connection: close, since the rest of the body is never read
+    response = JSONResponse(status_code=413, content={"detail": detail}, headers={"Connection": "close"})
+    await response(scope, receive, send)
+
+
+def _buffer(upload: UploadFile) -> Optional[UploadBuffer]:
+    file = upload.file
+    file.seek(0, 2)
+    size = file.tell()
+    file.seek(0)
+    if size == 0:
+        return None
+    if size <= MultiPartParser.spool_max_size:
+        # Still in memory inside the spooled file: one small copy
+        return file.read()
+    if hasattr(file, "rollover"):
+        file.rollover()
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+async def read_uploads(uploads: Optional[List[UploadFile]]) -> List[UploadBuffer]:
+    """Non-empty uploads as bytes-like buffers (bytes or read-only mmap) for the services."""
+    buffers = []
+    for upload in uploads or []:
+        buffer = await disk_bulkhead.run(_buffer, upload)
+        if buffer is not None:
+            buffers.append(buffer)
+    return buffers
@@ -0,0 +1,399 @@
+"""End-to-end load benchmark for /api/generate (+ task polling) and /api/chat.
+
+Starts the mock upstream and the backend as subprocesses (unless --target /
+--upstream-url point at running ones), then runs a closed-loop sweep: at each
+concurrency level, N workers send requests back to back for --duration
+seconds. Reports throughput, p50/p95/p99 latency end to end and per stage,
+error rates and the backend's RSS, and writes everything to JSON.
+
+    python benchmarks/load_bench.py --scenario generate --concurrency 1,4,16 --duration 30
+    python benchmarks/load_bench.py --scenario chat --compare benchmarks/results/load-baseline.json --max-regression 15
+
+Generate stages: submit is the POST as the client sees it; queue, prompt,
+image and finalize come from the task's server-side progress timeline (until
+processing, progress 30, progress 70 and succeed). End-to-end latency also
+includes polling, so it is up to --poll-interval longer than the task itself.
+
+A backend started here keeps its history, blobs, index and journals in a
+temporary directory that is removed afterwards; data/ and static/ are never touched.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+BACKEND_DIR = os.path.join(PROJECT_ROOT, "backend")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# Progress values run_generation_task reports at the end of each stage
+STAGE_PROGRESS = (("queue", 5), ("prompt", 30), ("image", 70), ("finalize", 100))
+GENERATE_STAGES = ("submit",) + tuple(stage for stage, _ in STAGE_PROGRESS)
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """Milliseconds."""
+    return {
+        "count": len(values),
+        "p50": _ms(percentile(values, 50)),
+        "p95": _ms(percentile(values, 95)),
+        "p99": _ms(percentile(values, 99)),
+        "max": _ms(max(values) if values else None),
+        "mean": _ms(sum(values) / len(values) if values else None)
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler:
+    def __init__(self, pid: Optional[int], interval: float = 0.25):
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[int] = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.pid:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            value = rss_bytes(self.pid)
+            if value:
+                self.samples.append(value)
+            self._stop.wait(self.interval)
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        if not self.samples:
+            return {"max_mb": None, "mean_mb": None, "end_mb": None}
+        mb = 1024 * 1024
+        return {
+            "max_mb": round(max(self.samples) / mb, 1),
+            "mean_mb": round(sum(self.samples) / len(self.samples) / mb, 1),
+            "end_mb": round(self.samples[-1] / mb, 1)
+        }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def scratch_storage_env(root: str) -> Dict[str, str]:
+    """Environment that keeps a benchmarked backend's history files, index and journals under root."""
+    return {
+        "STATIC_DIR": os.path.join(root, "static"),
+        "HISTORY_DB_PATH": os.path.join(root, "data", "history.db"),
+        "HISTORY_JOURNAL_DIR": os.path.join(root, "data", "history_journal"),
+        "HISTORY_ARCHIVE_DIR": os.path.join(root, "data", "history_archive"),
+        "BATCH_JOURNAL_DIR": os.path.join(root, "data", "batch_journal")
+    }
+
+
+def wait_for(url: str, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"Timed out waiting for {url}")
+
+
+def fake_image(size_kb: int, rng: random.Random) -> bytes:
+    # JPEG magic so the backend's format sniffing treats it as an upload
+    return b"\xff\xd8\xff\xe0" + bytes(rng.getrandbits(8) for _ in range(64)) * (size_kb * 16)
+
+
+def timeline_stages(timeline: List[List[float]]) -> Dict[str, float]:
+    """Server-side stage durations from a task's [seconds, progress] timeline."""
+    def reached(progress: int) -> Optional[float]:
+        return next((t for t, p in timeline if p >= progress), None)
+
+    stages = {}
+    previous = 0.0
+    for stage, progress in STAGE_PROGRESS:
+        mark = reached(progress)
+        if mark is None:
+            break
+        stages[stage] = mark - previous
+        previous = mark
+    return stages
+
+
+class Worker:
+    def __init__(self, args, images: List[bytes]):
+        self.args = args
+        self.images = images
+        self.session = requests.Session()
+
+    def generate(self) -> Dict[str, Any]:
+        args = self.args
+        stages: Dict[str, float] = {}
+        started = time.perf_counter()
+        files = [("image", (f"img_{i}.jpg", img, "image/jpeg")) for i, img in enumerate(self.images)]
+        data = {"prompt": "benchmark product shot", "ratio": "1:1", "scenario": args.gen_scenario, "model": args.model}
+        response = self.session.post(f"{args.target}/api/generate", data=data, files=files or None, timeout=args.timeout)
+        submitted = time.perf_counter()
+        stages["submit"] = submitted - started
+        if response.status_code != 200:
+            return {"ok": False, "error": f"HTTP {response.status_code}", "latency": submitted - started, "stages": stages}
+        task_id = response.json()["task_id"]
+
+        deadline = started + args.timeout
+        while time.perf_counter() < deadline:
+            time.sleep(args.poll_interval)
+            poll = self.session.get(f"{args.target}/api/tasks/{task_id}", timeout=args.timeout)
+            now = time.perf_counter()
+            if poll.status_code != 200:
+                return {"ok": False, "error": f"poll HTTP {poll.status_code}", "latency": now - started, "stages": stages}
+            task = poll.json()
+            if task["status"] in ("succeed", "failed", "cancelled"):
+                stages.update(timeline_stages(task.get("timeline") or []))
+                ok = task["status"] == "succeed"
+                return {"ok": ok, "error": None if ok else (task.get("error") or task["status"])[:120], "latency": now - started, "stages": stages}
+        return {"ok": False, "error": "timeout", "latency": time.perf_counter() - started, "stages": stages}
+
+    def chat(self) -> Dict[str, Any]:
+        args = self.args
+        started = time.perf_counter()
+        files = [("image", (f"img_{i}.jpg", img, "image/jpeg")) for i, img in enumerate(self.images)]
+        data = {"messages": json.dumps([{"role": "user", "content": "Plan a hero shot for this product"}]), "model": "gemini-3-pro-preview"}
+        response = self.session.post(f"{args.target}/api/chat", data=data, files=files or None, timeout=args.timeout)
+        latency = time.perf_counter() - started
+        if response.status_code != 200:
+            return {"ok": False, "error": f"HTTP {response.status_code}", "latency": latency, "stages": {}}
+        # ChatService reports upstream failures as an apology message with HTTP 200
+        ok = not (response.json().get("response") or "").startswith("抱歉")
+        return {"ok": ok, "error": None if ok else "upstream error", "latency": latency, "stages": {}}
+
+
+def run_level(args, concurrency: int, images: List[bytes], server_pid: Optional[int]) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + args.duration
+
+    def loop():
+        worker = Worker(args, images)
+        call = worker.generate if args.scenario == "generate" else worker.chat
+        while time.perf_counter() < stop_at:
+            try:
+                result = call()
+            except requests.RequestException as e:
+                result = {"ok": False, "error": type(e).__name__, "latency": 0.0, "stages": {}}
+            result["finished"] = time.perf_counter()
+            with lock:
+                results.append(result)
+
+    started = time.perf_counter()
+    with RssSampler(server_pid) as rss:
+        threads = [threading.Thread(target=loop, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r["ok"]]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    stages = {}
+    if args.scenario == "generate":
+        stages = {stage: summarize([r["stages"][stage] for r in ok if stage in r["stages"]]) for stage in GENERATE_STAGES}
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else None,
+        "errors": errors,
+        "rps": round(len(ok) / elapsed, 3) if elapsed else None,
+        "elapsed_s": round(elapsed, 2),
+        "latency_ms": summarize([r["latency"] for r in ok]),
+        "stages_ms": stages,
+        "server_rss": rss.summary()
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """Regressions beyond max_regression percent in rps or p95 latency, per concurrency level."""
+    problems = []
+    base_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    for level in current["levels"]:
+        base = base_levels.get(level["concurrency"])
+        if not base:
+            continue
+        rps, base_rps = level["rps"], base["rps"]
+        p95, base_p95 = level["latency_ms"]["p95"], base["latency_ms"]["p95"]
+        line = f"c={level['concurrency']}: rps {base_rps} -> {rps}, p95 {base_p95} -> {p95} ms"
+        print(line)
+        if base_rps and rps is not None and rps < base_rps * (1 - max_regression / 100):
+            problems.append(f"{line} (throughput down more than {max_regression}%)")
+        if base_p95 and p95 is not None and p95 > base_p95 * (1 + max_regression / 100):
+            problems.append(f"{line} (p95 up more than {max_regression}%)")
+    return problems
+
+
+def start_processes(args) -> List[subprocess.Popen]:
+    processes = []
+    if not args.upstream_url:
+        port = free_port()
+        mock_args = [sys.executable, os.path.join(BENCH_DIR, "mock_upstream.py"), "--port", str(port), "--seed", str(args.seed)] + args.mock_arg
+        processes.append(subprocess.Popen(mock_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        args.upstream_url = f"http://127.0.0.1:{port}/v1"
+        wait_for(f"http://127.0.0.1:{port}/health")
+    if not args.target:
+        port = free_port()
+        args.scratch_dir = tempfile.mkdtemp(prefix="load-bench-")
+        env = dict(os.environ, BANANA_API_URL=args.upstream_url, BANANA_API_KEY="mock", **scratch_storage_env(args.scratch_dir))
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL if not args.server_logs else None, stderr=subprocess.DEVNULL if not args.server_logs else None
+        )
+        processes.append(server)
+        args.target = f"http://127.0.0.1:{port}"
+        args.server_pid = server.pid
+        wait_for(f"{args.target}/api/health")
+    return processes
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark for the generate/poll pipeline and chat.")
+    parser.add_argument("--scenario", choices=("generate", "chat"), default="generate")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency sweep")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per concurrency level")
+    parser.add_argument("--images", type=int, default=1, help="Images uploaded per request")
+    parser.add_argument("--image-kb", type=int, default=512, help="Size of each uploaded image")
+    parser.add_argument("--model", default="nano_banana_2")
+    parser.add_argument("--gen-scenario", default="general", help="scenario form field for /api/generate")
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout")
+    parser.add_argument("--target", help="Running backend base URL (default: start one)")
+    parser.add_argument("--server-pid", type=int, help="PID of --target, for RSS sampling")
+    parser.add_argument("--upstream-url", help="Upstream base URL for the started backend (default: start the mock)")
+    parser.add_argument("--mock-arg", action="append", default=[], help="Extra mock_upstream.py argument, e.g. --mock-arg=--error-rate=0.05")
+    parser.add_argument("--server-logs", action="store_true", help="Show backend output")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Result JSON path (default: benchmarks/results/load-<scenario>-<time>.json)")
+    parser.add_argument("--compare", help="Baseline result JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=20.0, help="Percent; with --compare, exit 1 beyond this")
+    args = parser.parse_args()
+
+    args.scratch_dir = None
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    rng = random.Random(args.seed)
+    images = [fake_image(args.image_kb, rng) for _ in range(args.images)]
+    processes = start_processes(args)
+    try:
+        report = {
+            "scenario": args.scenario,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "config": {
+                "duration_s": args.duration, "images": args.images, "image_kb": args.image_kb, "model": args.model,
+                "poll_interval_s": args.poll_interval, "mock_args": args.mock_arg, "target": args.target
+            },
+            "levels": []
+        }
+        for concurrency in levels:
+            level = run_level(args, concurrency, images, args.server_pid)
+            report["levels"].append(level)
+            lat = level["latency_ms"]
+            print(
+                f"c={concurrency:<4} {level['requests']:>5} req  {level['rps']:>8} rps  "
+                f"p50 {lat['p50']} p95 {lat['p95']} p99 {lat['p99']} ms  "
+                f"errors {level['error_rate']:.2%}  rss max {level['server_rss']['max_mb']} MB"
+            )
+            for stage, stats in level["stages_ms"].items():
+                print(f"        {stage:<9} p50 {stats['p50']} p95 {stats['p95']} p99 {stats['p99']} ms")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.scratch_dir:
+            shutil.rmtree(args.scratch_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{args.scenario}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare(report, baseline, args.max_regression)
+        if problems:
+            print("Regressions:\n  " + "\n  ".join(problems))
+            sys.exit(1)
+        print("No regressions beyond threshold")
+
+
+if __name__ == "__main__":
+    main()
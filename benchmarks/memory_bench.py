@@ -0,0 +1,326 @@
+"""Memory profile of large multi-image /api/chat and /api/generate requests.
+
+Replays requests in-process through the real app (FastAPI TestClient) against
+the mock upstream, with the request path split into stages by wrapping the
+functions that implement them:
+
+    parse_multipart   Starlette parsing the multipart body
+    read_uploads      uploads.read_uploads (spooled files to bytes or mmap)
+    build_payload     ChatService.build_payload (system prompt, base64 images)
+    optimize_prompt   PromptService.optimize_prompt
+    generate_image    BananaService.generate_image
+    generation_task   run_generation_task (download, decode, history submit)
+    history_submit    HistoryWriter.submit
+    http              every outgoing requests call (JSON encoding + send)
+
+Stages nest, e.g. "generation_task/generate_image/http". For each stage it
+records tracemalloc's peak above the level at entry and what is still
+allocated at exit, both also per input byte (copy amplification), RSS at exit,
+and the top allocation sites still alive at exit, attributed to the innermost
+backend line. Process peak RSS (VmHWM) is reset and read per request on Linux.
+
+    python benchmarks/memory_bench.py
+    python benchmarks/memory_bench.py --scenario chat --images-per-field 3 --image-mb 6
+    python benchmarks/memory_bench.py --no-tracemalloc     # RSS only, without tracing overhead
+
+The "request" stage also holds the in-process client's own copy of the body
+(httpx/_models.py), about one byte per input byte that a real deployment does
+not pay. Background threads (the history writer) allocate while stages are
+open and are counted in whichever stage is open at the time.
+"""
+import argparse
+import functools
+import inspect
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from load_bench import BACKEND_DIR, BENCH_DIR, RESULTS_DIR, free_port, git_commit, rss_bytes, scratch_storage_env, wait_for
+
+MB = 1024 * 1024
+HOTSPOT_MIN_BYTES = 64 * 1024
+
+
+def fake_upload(size: int, seed: int) -> bytes:
+    # JPEG magic plus incompressible bytes, like a real photo upload
+    return b"\xff\xd8\xff\xe0" + random.Random(seed).getrandbits((size - 4) * 8).to_bytes(size - 4, "little")
+
+
+def peak_rss() -> Optional[int]:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # Linux resets VmHWM to the current RSS when "5" is written to clear_refs
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class StageProfiler:
+    def __init__(self, trace: bool, top: int):
+        self.trace = trace
+        self.top = top
+        self.input_bytes = 0
+        self.records: List[Dict[str, Any]] = []
+        self._stack: List[Dict[str, Any]] = []
+        self._lock = threading.RLock()
+
+    def wrap(self, owner: Any, attr: str, stage: str):
+        original = getattr(owner, attr)
+        profiler = self
+
+        if inspect.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def wrapper(*args, **kwargs):
+                frame = profiler.enter(stage)
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    profiler.exit(frame)
+        else:
+            @functools.wraps(original)
+            def wrapper(*args, **kwargs):
+                frame = profiler.enter(stage)
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    profiler.exit(frame)
+        setattr(owner, attr, wrapper)
+
+    def enter(self, stage: str) -> Dict[str, Any]:
+        with self._lock:
+            path = "/".join([f["stage"] for f in self._stack] + [stage])
+            frame = {"stage": stage, "path": path, "rss_enter": rss_bytes(os.getpid())}
+            if tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                # tracemalloc keeps one peak: hand it to the open stages before resetting it
+                for outer in self._stack:
+                    outer["peak"] = max(outer["peak"], peak)
+                tracemalloc.reset_peak()
+                frame.update(start=current, peak=current, snapshot=tracemalloc.take_snapshot() if self.top else None)
+            self._stack.append(frame)
+            return frame
+
+    def exit(self, frame: Dict[str, Any]):
+        with self._lock:
+            if frame in self._stack:
+                self._stack.remove(frame)
+            record = {"stage": frame["path"], "rss_exit_mb": _mb(rss_bytes(os.getpid()))}
+            if "start" in frame:
+                current, peak = tracemalloc.get_traced_memory()
+                frame["peak"] = max(frame["peak"], peak)
+                for outer in self._stack:
+                    outer["peak"] = max(outer["peak"], frame["peak"])
+                record.update(
+                    peak_growth_mb=_mb(frame["peak"] - frame["start"]),
+                    retained_mb=_mb(current - frame["start"]),
+                    peak_per_input_byte=round((frame["peak"] - frame["start"]) / self.input_bytes, 2) if self.input_bytes else None,
+                    retained_per_input_byte=round((current - frame["start"]) / self.input_bytes, 2) if self.input_bytes else None
+                )
+                if frame["snapshot"] is not None:
+                    record["hotspots"] = self._hotspots(frame["snapshot"], tracemalloc.take_snapshot())
+            self.records.append(record)
+
+    def _hotspots(self, before, after) -> List[Dict[str, Any]]:
+        """Allocation growth over the stage, attributed to the innermost backend frame."""
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        sites: Dict[str, int] = {}
+        for stat in after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "traceback"):
+            if stat.size_diff <= 0:
+                continue
+            frames = list(stat.traceback)  # oldest first
+            site = next((f for f in reversed(frames) if f.filename.startswith(BACKEND_DIR)), frames[-1])
+            if site.filename.startswith(BACKEND_DIR):
+                name = os.path.relpath(site.filename, os.path.dirname(BACKEND_DIR))
+            else:
+                name = "/".join(site.filename.split(os.sep)[-2:])  # e.g. httpx/_models.py
+            key = f"{name}:{site.lineno}"
+            sites[key] = sites.get(key, 0) + stat.size_diff
+        ranked = sorted(((site, size) for site, size in sites.items() if size >= HOTSPOT_MIN_BYTES), key=lambda item: item[1], reverse=True)[:self.top]
+        return [{"site": site, "mb": _mb(size)} for site, size in ranked]
+
+
+def _mb(value: Optional[int]) -> Optional[float]:
+    return round(value / MB, 2) if value is not None else None
+
+
+def instrument(profiler: StageProfiler, main_module):
+    import requests
+    from starlette.requests import Request
+    from services.chat_service import ChatService
+    from services.prompt_service import PromptService
+    from services.banana_service import BananaService
+    from services.history_writer import HistoryWriter
+
+    if hasattr(Request, "_get_form"):
+        profiler.wrap(Request, "_get_form", "parse_multipart")
+    profiler.wrap(main_module, "read_uploads", "read_uploads")
+    profiler.wrap(ChatService, "build_payload", "build_payload")
+    profiler.wrap(PromptService, "optimize_prompt", "optimize_prompt")
+    profiler.wrap(BananaService, "generate_image", "generate_image")
+    profiler.wrap(HistoryWriter, "submit", "history_submit")
+    profiler.wrap(requests.Session, "request", "http")
+    # Looked up as a module global when the endpoint schedules it
+    profiler.wrap(main_module, "run_generation_task", "generation_task")
+
+
+def summarize_records(records: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """One entry per stage path; repeated stages (several uploads, retries) keep their worst values."""
+    stages: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        entry = stages.setdefault(record["stage"], {"calls": 0})
+        entry["calls"] += 1
+        for key, value in record.items():
+            if key in ("stage", "hotspots") or value is None:
+                continue
+            entry[key] = max(entry.get(key, value), value)
+        if record.get("hotspots") and (not entry.get("hotspots") or record["hotspots"][0]["mb"] > entry["hotspots"][0]["mb"]):
+            entry["hotspots"] = record["hotspots"]
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage memory profile of large multi-image requests.")
+    parser.add_argument("--scenario", choices=("chat", "generate", "both"), default="both")
+    parser.add_argument("--images-per-field", type=int, default=2, help="Files per upload field (chat: image, track_a, track_b; generate: image)")
+    parser.add_argument("--image-mb", type=float, default=4.0, help="Size of each uploaded file")
+    parser.add_argument("--repeat", type=int, default=2, help="Requests per scenario; the first one warms caches and is not reported")
+    parser.add_argument("--top", type=int, default=5, help="Allocation sites listed per stage (0 = none, faster)")
+    parser.add_argument("--frames", type=int, default=12, help="Traceback depth kept by tracemalloc")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Only measure RSS")
+    parser.add_argument("--upstream-url", help="Upstream base URL (default: start the mock with zero latency)")
+    parser.add_argument("--mock-arg", action="append", default=[], help="Extra mock_upstream.py argument")
+    parser.add_argument("--output", help="Result JSON path (default: benchmarks/results/memory-<time>.json)")
+    args = parser.parse_args()
+
+    mock = None
+    if not args.upstream_url:
+        port = free_port()
+        mock = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, "mock_upstream.py"), "--port", str(port),
+             "--chat-latency", "fixed:0", "--image-latency", "fixed:0", "--download-latency", "fixed:0"] + args.mock_arg,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        args.upstream_url = f"http://127.0.0.1:{port}/v1"
+        wait_for(f"http://127.0.0.1:{port}/health")
+
+    # Config reads the environment at import time
+    os.environ["BANANA_API_URL"] = args.upstream_url
+    os.environ["BANANA_API_KEY"] = "mock"
+    # History, blobs and the index go to a temp dir, never the real data/ and static/
+    scratch_dir = tempfile.mkdtemp(prefix="memory-bench-")
+    os.environ.update(scratch_storage_env(scratch_dir))
+    sys.path.insert(0, BACKEND_DIR)
+    from fastapi.testclient import TestClient
+    import main as backend_main
+    from services.history_writer import history_writer
+
+    size = int(args.image_mb * MB)
+    fields = {"chat": ("image", "track_a", "track_b"), "generate": ("image",)}
+    scenarios = ["chat", "generate"] if args.scenario == "both" else [args.scenario]
+    report = {
+        "commit": git_commit(),
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"images_per_field": args.images_per_field, "image_mb": args.image_mb, "tracemalloc": not args.no_tracemalloc, "frames": args.frames},
+        "scenarios": {}
+    }
+    profiler = StageProfiler(trace=not args.no_tracemalloc, top=args.top)
+    instrument(profiler, backend_main)
+
+    try:
+        with TestClient(backend_main.app) as client, open(os.devnull, "w", encoding="utf-8") as devnull:
+            for scenario in scenarios:
+                names = [(field, n) for field in fields[scenario] for n in range(args.images_per_field)]
+                uploads = [(field, (f"{field}_{n}.jpg", fake_upload(size, seed), "image/jpeg")) for seed, (field, n) in enumerate(names)]
+                input_bytes = sum(len(f[1][1]) for f in uploads)
+                if scenario == "chat":
+                    data = {"messages": json.dumps([{"role": "user", "content": "Plan a hero shot for these product photos"}]), "model": "gemini-3-pro-preview"}
+                    url = "/api/chat"
+                else:
+                    data = {"prompt": "Hero shot on a walnut table", "ratio": "1:1", "scenario": "general", "model": "nano_banana_2"}
+                    url = "/api/generate"
+
+                repeat = max(1, args.repeat)
+                for attempt in range(repeat):
+                    history_writer.flush(timeout=60)
+                    # Trace only the reported request: startup and warm-up allocations stay out of the snapshots
+                    if profiler.trace and attempt == repeat - 1:
+                        tracemalloc.start(args.frames)
+                    profiler.records = []
+                    profiler.input_bytes = input_bytes
+                    reset_peak_rss()
+                    rss_before = rss_bytes(os.getpid())
+                    stdout, sys.stdout = sys.stdout, devnull  # the services print on every step
+                    try:
+                        frame = profiler.enter("request")
+                        response = client.post(url, data=data, files=uploads)
+                        # Background generation runs inside the TestClient call; land the history files too
+                        history_writer.flush(timeout=60)
+                        profiler.exit(frame)
+                    finally:
+                        sys.stdout = stdout
+                        tracemalloc.stop()
+                    if response.status_code != 200:
+                        raise SystemExit(f"{url} answered {response.status_code}: {response.text[:200]}")
+                    if scenario == "generate":
+                        task = backend_main.task_service.get_task(response.json()["task_id"]) or {}
+                        if task.get("status") != "succeed":
+                            raise SystemExit(f"generation task ended {task.get('status')}: {task.get('error')}")
+
+                peak = peak_rss()
+                report["scenarios"][scenario] = {
+                    "input_files": len(uploads),
+                    "input_mb": _mb(input_bytes),
+                    "rss_before_mb": _mb(rss_before),
+                    "peak_rss_mb": _mb(peak),
+                    "peak_rss_growth_per_input_byte": round((peak - rss_before) / input_bytes, 2) if peak and rss_before else None,
+                    "stages": summarize_records(profiler.records)
+                }
+                print_scenario(scenario, report["scenarios"][scenario])
+    finally:
+        if mock:
+            mock.terminate()
+            mock.wait(timeout=10)
+        history_writer.flush(timeout=60)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"memory-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def print_scenario(name: str, result: Dict[str, Any]):
+    print(f"\n{name}: {result['input_files']} files, {result['input_mb']} MB in; "
+          f"peak RSS {result['peak_rss_mb']} MB ({result['peak_rss_growth_per_input_byte']} bytes per input byte above the start)")
+    for stage, stats in sorted(result["stages"].items(), key=lambda item: item[0]):
+        if "peak_growth_mb" in stats:
+            print(f"  {stage:<52} x{stats['calls']:<3} peak +{stats['peak_growth_mb']:>8} MB ({stats['peak_per_input_byte']}/B)  "
+                  f"retained +{stats['retained_mb']:>8} MB  rss {stats['rss_exit_mb']} MB")
+        else:
+            print(f"  {stage:<52} x{stats['calls']:<3} rss {stats['rss_exit_mb']} MB")
+        for hotspot in stats.get("hotspots", [])[:3]:
+            print(f"      {hotspot['mb']:>8} MB  {hotspot['site']}")
+
+
+if __name__ == "__main__":
+    main()
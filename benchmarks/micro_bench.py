@@ -0,0 +1,273 @@
+"""Microbenchmarks for CPU-bound helpers on the request path, with a stored baseline.
+
+Cases run in-process against the real helpers with realistic payload sizes:
+base64 of multi-MB images, BananaService response-shape probing and request
+building, optimized-prompt JSON parsing, ChatService payload assembly and
+streaming the request body.
+Nothing touches the network; the upstream response is canned.
+
+    python benchmarks/micro_bench.py                       # run and print
+    python benchmarks/micro_bench.py --save-baseline       # store benchmarks/baselines/micro.json
+    python benchmarks/micro_bench.py --compare             # exit 1 if a case regressed
+    python benchmarks/micro_bench.py --compare --filter b64 --max-regression 10
+
+Each case is timed like timeit: the loop count is calibrated so one sample takes
+at least --min-time, then --repeat samples are taken with the GC disabled. The
+median and minimum per-call times must both be slower than the baseline by more
+than --max-regression to count as a regression; the IQR is reported so noisy
+cases stand out.
+Baselines only mean something on the machine that recorded them.
+"""
+import argparse
+import base64
+import contextlib
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+BACKEND_DIR = os.path.join(PROJECT_ROOT, "backend")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baselines", "micro.json")
+
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from services.banana_service import banana_service, extract_image_result
+from services.chat_service import chat_service
+from services.prompt_service import parse_optimized_prompt
+from services.upstream_body import json_body
+
+MB = 1024 * 1024
+
+
+def payload(size: int, seed: int) -> bytes:
+    # Random bytes: uploaded JPEG/PNG data is already compressed, so it looks like noise
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, "little")
+
+
+class CannedResponse:
+    """Stands in for requests.Response in the request-building cases."""
+
+    def __init__(self, body: str):
+        self.text = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _dual_core_prompt() -> str:
+    return json.dumps({
+        "thinking_level": "high",
+        "proposal": {"identity_ref": 0, "logic_ref": 1},
+        "nano_banana_en": "Studio hero shot of a brushed aluminium espresso machine, " * 40,
+        "seadream_cn": "拉丝铝浓缩咖啡机的棚拍主图，柔和的侧光，浅景深，" * 60,
+        "layout_logic": "Subject centred on the golden ratio line, negative space top-left for copy. " * 10
+    }, ensure_ascii=False)
+
+
+def _luxury_prompt() -> str:
+    screens = [{
+        "screen_name_zh": f"第{n}屏",
+        "positive_prompt": f"Screen {n}: macro detail of the portafilter, warm rim light, " * 30,
+        "negative_prompt": "text, watermark, extra handles, deformed logo, " * 10
+    } for n in range(1, 9)]
+    return json.dumps({
+        "luxury_visual_strategy": {
+            "screens": screens,
+            "visual_grammar_handbook": {"composition_rules": {f"rule_{n}": "Keep the logo upright and unobstructed. " * 5 for n in range(20)}}
+        }
+    }, ensure_ascii=False)
+
+
+def _chat_history(turns: int) -> List[Dict[str, str]]:
+    messages = []
+    for n in range(turns):
+        messages.append({"role": "user", "content": f"Turn {n}: make the background warmer and move the product left. " * 4})
+        messages.append({"role": "assistant", "content": f"Proposal {n}: " + "Warm tungsten key light, walnut tabletop, soft shadow. " * 20})
+    messages.append({"role": "user", "content": "Generate the final hero image."})
+    return messages
+
+
+def build_cases() -> List[Tuple[str, Callable[[], Any]]]:
+    image_4mb = payload(4 * MB, 1)
+    image_16mb = payload(16 * MB, 2)
+    b64_4mb = base64.b64encode(image_4mb).decode("utf-8")
+    b64_16mb = base64.b64encode(image_16mb).decode("utf-8")
+    chat_images = [payload(2 * MB, seed) for seed in range(10, 13)]
+    track_images = [payload(2 * MB, seed) for seed in range(20, 22)]
+    dual_core = _dual_core_prompt()
+    luxury = _luxury_prompt()
+    history = _chat_history(10)
+    visual_dna = json.dumps({"palette": ["#2b2b2b", "#c8a165", "#f4efe6"], "materials": ["brushed aluminium", "walnut"], "notes": "Matte, low-gloss finish. " * 50})
+
+    shapes = {
+        "url": {"data": [{"url": "https://cdn.example.com/generated/abc.png"}], "thought_signature": "sig"},
+        "output_list": {"output": ["https://cdn.example.com/generated/abc.png"]},
+        "image_url": {"image_url": "https://cdn.example.com/generated/abc.png"},
+        "fallback_key": {"status": "ok", "img_url": "https://cdn.example.com/generated/abc.png"},
+        "list": [{"url": "https://cdn.example.com/generated/abc.png", "thought_signature": "sig"}]
+    }
+    b64_response = json.dumps({"created": 1, "data": [{"b64_json": b64_4mb}]})
+
+    def generate_image(model_id: str, images: Optional[List[bytes]]):
+        banana_service._make_request = lambda *args, **kwargs: CannedResponse(json.dumps(shapes["url"]))
+        try:
+            return banana_service.generate_image("hero shot of an espresso machine", "1:1", images=images, model_id=model_id, api_key="bench", api_url="http://bench.invalid/v1")
+        finally:
+            del banana_service._make_request
+
+    cases = [
+        ("b64encode_4mb", lambda: base64.b64encode(image_4mb)),
+        ("b64encode_16mb", lambda: base64.b64encode(image_16mb)),
+        ("b64decode_4mb", lambda: base64.b64decode(b64_4mb)),
+        ("b64decode_16mb", lambda: base64.b64decode(b64_16mb)),
+        ("data_url_4mb", lambda: f"data:image/png;base64,{base64.b64encode(image_4mb).decode('utf-8')}"),
+    ]
+    for name, shape in shapes.items():
+        cases.append((f"response_shape_{name}", lambda shape=shape: extract_image_result(shape)))
+    cases += [
+        ("response_b64_json_4mb", lambda: extract_image_result(json.loads(b64_response))),
+        ("generate_request_json_4mb", lambda: generate_image("nano_banana_2", [image_4mb])),
+        ("generate_request_comfly_json_4mb", lambda: generate_image("doubao_seedream_4_5", [image_4mb])),
+        ("generate_request_multipart_4mb", lambda: generate_image("comfly_nano_banana", [image_4mb])),
+        ("parse_prompt_dual_core", lambda: parse_optimized_prompt(dual_core, "nano_banana", "dual")),
+        ("parse_prompt_luxury", lambda: parse_optimized_prompt(luxury, "nano_banana")),
+        ("parse_prompt_plain_text", lambda: parse_optimized_prompt("A plain prompt the optimizer returned as text", "nano_banana")),
+        ("chat_payload_text_only", lambda: chat_service.build_payload(history, image_model="nano_banana_2")),
+        ("chat_payload_dna", lambda: chat_service.build_payload(history, visual_dna=visual_dna, product_identity="Espresso machine, 58mm portafilter", image_model="nano_banana_2")),
+        ("chat_payload_3x2mb_images", lambda: chat_service.build_payload(history, images=chat_images)),
+        ("chat_payload_dual_track_7x2mb", lambda: chat_service.build_payload(history, images=chat_images, track_a_images=track_images, track_b_images=track_images)),
+        ("chat_body_stream_3x2mb_images", lambda: drain(json_body(chat_service.build_payload(history, images=chat_images)))),
+    ]
+    return cases
+
+
+def drain(body) -> int:
+    """Read a StreamingBody the way urllib3 sends it."""
+    reader = body.reader()
+    total = 0
+    while True:
+        block = reader.read(16384)
+        if not block:
+            return total
+        total += len(block)
+
+
+def time_case(func: Callable[[], Any], repeat: int, min_time: float) -> Dict[str, Any]:
+    func()  # warm-up: imports, caches, first allocation of big buffers
+    loops = 1
+    while True:
+        elapsed = _sample(func, loops)
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    samples = sorted(_sample(func, loops) / loops for _ in range(repeat))
+    quartiles = statistics.quantiles(samples, n=4) if len(samples) >= 2 else [samples[0]] * 3
+    median = statistics.median(samples)
+    return {
+        "loops": loops,
+        "repeat": repeat,
+        "median_us": round(median * 1e6, 3),
+        "min_us": round(samples[0] * 1e6, 3),
+        "iqr_us": round((quartiles[2] - quartiles[0]) * 1e6, 3),
+        "rel_iqr": round((quartiles[2] - quartiles[0]) / median, 4) if median else 0.0
+    }
+
+
+def _sample(func: Callable[[], Any], loops: int) -> float:
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        return time.perf_counter() - started
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    problems = []
+    base_cases = baseline.get("cases", {})
+    for name, result in current["cases"].items():
+        base = base_cases.get(name)
+        if not base:
+            print(f"  {name:<36} (not in baseline)")
+            continue
+        change = (result["median_us"] / base["median_us"] - 1) * 100 if base["median_us"] else 0.0
+        min_change = (result["min_us"] / base["min_us"] - 1) * 100 if base["min_us"] else 0.0
+        noisy = " noisy" if max(result["rel_iqr"], base["rel_iqr"]) * 100 > max_regression else ""
+        line = f"{name:<36} {base['median_us']:>12.1f} -> {result['median_us']:>12.1f} us  {change:+6.1f}% (min {min_change:+6.1f}%){noisy}"
+        print(f"  {line}")
+        # Both the typical and the best run must be slower: one noisy sample cannot fail the gate
+        if change > max_regression and min_change > max_regression:
+            problems.append(line)
+    return problems
+
+
+def machine() -> Dict[str, Any]:
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(), "machine": platform.machine(), "processor": platform.processor(), "host": platform.node(), "cpus": os.cpu_count()}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for hot helper code, with a regression gate.")
+    parser.add_argument("--filter", help="Only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=15, help="Samples per case")
+    parser.add_argument("--min-time", type=float, default=0.1, help="Minimum seconds per sample")
+    parser.add_argument("--output", help="Also write the results as JSON here")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON path")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results to --baseline")
+    parser.add_argument("--compare", action="store_true", help="Compare with --baseline; exit 1 on regressions")
+    parser.add_argument("--max-regression", type=float, default=25.0, help="Percent slower than the baseline that fails --compare")
+    args = parser.parse_args()
+
+    cases = [(name, func) for name, func in build_cases() if not args.filter or args.filter in name]
+    report = {"commit": git_commit(), "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "machine": machine(), "cases": {}}
+    # The services print debug output on every call; keep it out of the numbers' way
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        for name, func in cases:
+            with contextlib.redirect_stdout(devnull):
+                result = time_case(func, args.repeat, args.min_time)
+            report["cases"][name] = result
+            print(f"{name:<36} {result['median_us']:>12.1f} us  (min {result['min_us']:.1f}, iqr {result['rel_iqr']:.1%}, {result['loops']} loops)")
+
+    for path in filter(None, (args.output, args.baseline if args.save_baseline else None)):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {path}")
+
+    if args.compare:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("machine", {}).get("host") != report["machine"]["host"]:
+            print(f"Warning: baseline was recorded on {baseline.get('machine', {}).get('host')}, not this host")
+        print(f"Against {args.baseline} (commit {baseline.get('commit')}):")
+        problems = compare(report, baseline, args.max_regression)
+        if problems:
+            print(f"Regressions beyond {args.max_regression}%:\n  " + "\n  ".join(problems))
+            sys.exit(1)
+        print("No regressions beyond threshold")
+
+
+if __name__ == "__main__":
+    main()
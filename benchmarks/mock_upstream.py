@@ -0,0 +1,330 @@
+"""Local stand-in for the OpenAI-compatible upstream (BANANA_API_URL).
+
+Implements /chat/completions, /images/generations and /images/edits with the
+response shapes the backend parses, so the whole pipeline can be exercised
+offline and without paying for calls:
+
+    python benchmarks/mock_upstream.py --port 9100 --image-latency lognormal:8000,0.4
+    BANANA_API_URL=http://127.0.0.1:9100/v1 BANANA_API_KEY=mock python -m backend.main
+
+Latency specs: fixed:MS | uniform:LO,HI | normal:MEAN,STD | lognormal:MEDIAN,SIGMA (ms).
+Faults: --error-rate (500/502/503), --rate-limit-rate and --max-concurrency
+(429 with Retry-After), --hang-rate (no response for --hang-seconds) and
+--slow-body-bps (bodies trickle out at that rate).
+Placeholder PNGs are built with zlib at the requested size and cached.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from services.banana_service import SIZE_MAP_1K, SIZE_MAP_2K, SIZE_MAP_4K
+
+IMAGE_FORMATS = ("url", "b64_json", "output", "image_url")
+SIZE_TIERS = {"1K": SIZE_MAP_1K, "2K": SIZE_MAP_2K, "4K": SIZE_MAP_4K}
+
+
+class LatencySpec:
+    """A latency distribution in milliseconds, parsed from "kind:a,b"."""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, args = spec.partition(":")
+        self.kind = kind
+        self.args = [float(a) for a in args.split(",") if a.strip()]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if kind not in expected or len(self.args) != expected[kind]:
+            raise argparse.ArgumentTypeError(f"bad latency spec {spec!r}; use fixed:MS, uniform:LO,HI, normal:MEAN,STD or lognormal:MEDIAN,SIGMA")
+
+    def sample(self, rng: random.Random) -> float:
+        """Seconds."""
+        if self.kind == "fixed":
+            ms = self.args[0]
+        elif self.kind == "uniform":
+            ms = rng.uniform(*self.args)
+        elif self.kind == "normal":
+            ms = rng.gauss(*self.args)
+        else:
+            median, sigma = self.args
+            ms = median * rng.lognormvariate(0, sigma)
+        return max(ms, 0.0) / 1000.0
+
+
+class MockSettings:
+    def __init__(self, args: Optional[argparse.Namespace] = None):
+        args = args or build_parser().parse_args([])
+        self.chat_latency: LatencySpec = args.chat_latency
+        self.image_latency: LatencySpec = args.image_latency
+        self.download_latency: LatencySpec = args.download_latency
+        self.error_rate = args.error_rate
+        self.rate_limit_rate = args.rate_limit_rate
+        self.retry_after = args.retry_after
+        self.max_concurrency = args.max_concurrency
+        self.hang_rate = args.hang_rate
+        self.hang_seconds = args.hang_seconds
+        self.slow_body_bps = args.slow_body_bps
+        self.image_format = args.image_format
+        self.image_entropy = args.image_entropy
+        self.image_variants = args.image_variants
+        self.rng = random.Random(args.seed)
+
+
+def png_bytes(width: int, height: int, variant: int = 0, entropy: float = 0.0) -> bytes:
+    """An RGB PNG: a tinted gradient, with `entropy` of each row random so it compresses like a photo."""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    tint = hashlib.sha1(str(variant).encode()).digest()[:3]
+    row_len = width * 3
+    noisy = int(row_len * max(0.0, min(entropy, 1.0)))
+    rng = random.Random(variant)
+    bands = []
+    for band in range(16):
+        level = band * 255 // 15
+        bands.append(bytes((level + tint[i % 3]) & 0xFF for i in range(row_len - noisy)))
+    compressor = zlib.compressobj(6)
+    parts = []
+    for y in range(height):
+        row = b"\x00" + bands[y * 16 // height]
+        if noisy:
+            row += rng.randbytes(noisy) if hasattr(rng, "randbytes") else os.urandom(noisy)
+        parts.append(compressor.compress(row))
+    parts.append(compressor.flush())
+    header = struct.pack(">2I5B", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", b"".join(parts)) + chunk(b"IEND", b"")
+
+
+class ImageCache:
+    def __init__(self, max_items: int = 32):
+        self.items: "OrderedDict[Tuple[int, int, int], bytes]" = OrderedDict()
+        self.max_items = max_items
+        self._lock = threading.Lock()
+
+    def get(self, width: int, height: int, variant: int, entropy: float) -> bytes:
+        key = (width, height, variant)
+        with self._lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        data = png_bytes(width, height, variant, entropy)
+        with self._lock:
+            self.items[key] = data
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+        return data
+
+
+def requested_size(params: Dict[str, Any]) -> Tuple[int, int]:
+    """Pixel size the backend asked for: size=WxH, width/height, or aspect_ratio + image_size tier."""
+    size = str(params.get("size") or "")
+    if "x" in size:
+        w, _, h = size.partition("x")
+        if w.isdigit() and h.isdigit():
+            return int(w), int(h)
+    if str(params.get("width", "")).isdigit() and str(params.get("height", "")).isdigit():
+        return int(params["width"]), int(params["height"])
+    tier = SIZE_TIERS.get(str(params.get("image_size") or "1K").upper(), SIZE_MAP_1K)
+    dims = tier.get(str(params.get("aspect_ratio") or "1:1"), tier["1:1"])
+    return dims["width"], dims["height"]
+
+
+def chat_content(payload: Dict[str, Any]) -> str:
+    """Shape the reply like the caller expects: fingerprint JSON, dual-core prompt JSON or a Director reply."""
+    text = json.dumps(payload.get("messages", []), ensure_ascii=False)[:200000]
+    wants_json = (payload.get("response_format") or {}).get("type") == "json_object"
+    if wants_json and "extract the visual fingerprint" in text:
+        return json.dumps({
+            "product_identity": {"category": "mock product", "material": "matte plastic", "color": "white"},
+            "visual_dna": {"lighting": "soft studio", "palette": ["#ffffff", "#222222"], "composition": "centered"}
+        }, ensure_ascii=False)
+    if wants_json:
+        return json.dumps({
+            "nano_banana_en": "Mock product on a clean studio background, soft light, high detail.",
+            "seadream_cn": "干净的影棚背景上的模拟产品，柔和光线，高细节。",
+            "layout_logic": "centered subject, negative space on the right"
+        }, ensure_ascii=False)
+    proposal = {
+        "analysis": {"visual_dna_v2": "soft studio light, neutral palette", "product_identity_en": "mock product"},
+        "proposals": [
+            {"title": f"Mock proposal {i + 1}", "prompt": f"Mock product hero shot variant {i + 1}", "ratio": "1:1", "identity_ref": 0}
+            for i in range(3)
+        ]
+    }
+    return "Here are three directions.\n```json\n" + json.dumps(proposal, ensure_ascii=False) + "\n```"
+
+
+def create_app(settings: Optional[MockSettings] = None) -> FastAPI:
+    settings = settings or MockSettings()
+    images = ImageCache()
+    state = {"in_flight": 0, "requests": 0, "faults": {}}
+    app = FastAPI(title="Mock upstream")
+    app.state.settings = settings
+    app.state.stats = state
+
+    def fault(kind: str):
+        state["faults"][kind] = state["faults"].get(kind, 0) + 1
+
+    async def delay(spec: LatencySpec):
+        await asyncio.sleep(spec.sample(settings.rng))
+
+    def body_response(body: bytes, media_type: str, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+        if not settings.slow_body_bps:
+            return Response(content=body, media_type=media_type, status_code=status_code, headers=headers)
+
+        async def trickle():
+            step = max(1024, settings.slow_body_bps // 10)
+            for start in range(0, len(body), step):
+                yield body[start:start + step]
+                await asyncio.sleep(step / settings.slow_body_bps)
+
+        headers = dict(headers or {}, **{"Content-Length": str(len(body))})
+        return StreamingResponse(trickle(), media_type=media_type, status_code=status_code, headers=headers)
+
+    def json_response(data: Any, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+        return body_response(json.dumps(data, ensure_ascii=False).encode("utf-8"), "application/json", status_code, headers)
+
+    @app.middleware("http")
+    async def inject_faults(request: Request, call_next):
+        if request.url.path in ("/health", "/stats") or request.url.path.startswith("/files/"):
+            return await call_next(request)
+        state["requests"] += 1
+        if settings.max_concurrency and state["in_flight"] >= settings.max_concurrency:
+            fault("429_concurrency")
+            return JSONResponse(status_code=429, content={"error": {"message": "Too many concurrent requests", "type": "rate_limit"}}, headers={"Retry-After": str(settings.retry_after)})
+        roll = settings.rng.random()
+        if roll < settings.rate_limit_rate:
+            fault("429")
+            return JSONResponse(status_code=429, content={"error": {"message": "Rate limit exceeded", "type": "rate_limit"}}, headers={"Retry-After": str(settings.retry_after)})
+        roll -= settings.rate_limit_rate
+        if roll < settings.error_rate:
+            status = settings.rng.choice([500, 502, 503])
+            fault(str(status))
+            return JSONResponse(status_code=status, content={"error": {"message": f"Mock upstream error {status}", "type": "server_error"}})
+        roll -= settings.error_rate
+        state["in_flight"] += 1
+        try:
+            if roll < settings.hang_rate:
+                fault("hang")
+                await asyncio.sleep(settings.hang_seconds)
+            return await call_next(request)
+        finally:
+            state["in_flight"] -= 1
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/stats")
+    async def stats():
+        return {"requests": state["requests"], "in_flight": state["in_flight"], "faults": state["faults"]}
+
+    @app.post("/{prefix:path}/chat/completions")
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request, prefix: str = ""):
+        payload = await request.json()
+        await delay(settings.chat_latency)
+        content = chat_content(payload)
+        return json_response({
+            "id": f"chatcmpl-mock-{int(time.time() * 1000)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(content), "total_tokens": len(content)}
+        })
+
+    async def image_reply(request: Request, params: Dict[str, Any]) -> Response:
+        await delay(settings.image_latency)
+        width, height = requested_size(params)
+        variant = settings.rng.randrange(max(1, settings.image_variants))
+        fmt = settings.image_format
+        if fmt == "cycle":
+            fmt = IMAGE_FORMATS[state["requests"] % len(IMAGE_FORMATS)]
+        base = str(request.base_url).rstrip("/")
+        url = f"{base}/files/{width}x{height}/{variant}.png"
+        if fmt == "b64_json":
+            data = await asyncio.to_thread(images.get, width, height, variant, settings.image_entropy)
+            body = {"created": int(time.time()), "data": [{"b64_json": base64.b64encode(data).decode("ascii")}]}
+        elif fmt == "output":
+            body = {"output": [url]}
+        elif fmt == "image_url":
+            body = {"image_url": url}
+        else:
+            body = {"created": int(time.time()), "data": [{"url": url}]}
+        if params.get("thought_signature") is not None or params.get("thinking_level") is not None:
+            body["thought_signature"] = f"mock-signature-{variant}"
+        return json_response(body)
+
+    @app.post("/{prefix:path}/images/generations")
+    @app.post("/images/generations")
+    async def images_generations(request: Request, prefix: str = ""):
+        return await image_reply(request, await request.json())
+
+    @app.post("/{prefix:path}/images/edits")
+    @app.post("/images/edits")
+    async def images_edits(request: Request, prefix: str = ""):
+        form = await request.form()
+        params = {k: v for k, v in form.items() if isinstance(v, str)}
+        if not any(k == "image" for k, _ in form.multi_items()):
+            return JSONResponse(status_code=400, content={"error": {"message": "image is required", "type": "invalid_request_error"}})
+        return await image_reply(request, params)
+
+    @app.get("/files/{size}/{variant}.png")
+    async def files(size: str, variant: int):
+        w, _, h = size.partition("x")
+        if not (w.isdigit() and h.isdigit()) or int(w) * int(h) > 8192 * 8192:
+            return JSONResponse(status_code=404, content={"error": "not found"})
+        await delay(settings.download_latency)
+        data = await asyncio.to_thread(images.get, int(w), int(h), variant, settings.image_entropy)
+        return body_response(data, "image/png")
+
+    return app
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible upstream for offline load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--chat-latency", type=LatencySpec, default=LatencySpec("lognormal:1500,0.5"), help="Latency of /chat/completions")
+    parser.add_argument("--image-latency", type=LatencySpec, default=LatencySpec("lognormal:6000,0.4"), help="Latency of /images/*")
+    parser.add_argument("--download-latency", type=LatencySpec, default=LatencySpec("fixed:50"), help="Latency before serving a generated file")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered 500/502/503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered 429")
+    parser.add_argument("--retry-after", type=int, default=2, help="Retry-After seconds on 429")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="429 once this many requests are in flight (0 = unlimited)")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="Fraction of requests that stall for --hang-seconds")
+    parser.add_argument("--hang-seconds", type=float, default=180.0)
+    parser.add_argument("--slow-body-bps", type=int, default=0, help="Send response bodies at this many bytes/s (0 = full speed)")
+    parser.add_argument("--image-format", choices=IMAGE_FORMATS + ("cycle",), default="url", help="Response shape for generated images")
+    parser.add_argument("--image-entropy", type=float, default=0.3, help="0..1: share of each PNG row that is random (bigger, photo-like files)")
+    parser.add_argument("--image-variants", type=int, default=4, help="Distinct placeholder images per size")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for latency and fault sampling")
+    return parser
+
+
+def main():
+    import uvicorn
+    args = build_parser().parse_args()
+    print(f"Mock upstream on http://{args.host}:{args.port}/v1 (chat {args.chat_latency.spec}, images {args.image_latency.spec})")
+    uvicorn.run(create_app(MockSettings(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
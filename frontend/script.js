@@ -199,6 +199,7 @@ class AIChatSidebar {
         this.visualDNA = localStorage.getItem('visual_dna_v2') || null;
         this.productIdentity = localStorage.getItem('product_identity_en') || null;
         this.thoughtSignature = null; // Store Gemini's thought signature for multi-turn
+        this.fingerprintId = null; // Visual DNA of the last chat turn, reused by /api/generate for the same images
         this.isCollapsed = false;
         this.selectedImages = [];
         this.trackAImages = []; // Track A: Product appearance/angles
@@ -793,6 +794,9 @@ class AIChatSidebar {
             if (this.imageModelSelect) formData.append('image_model', this.imageModelSelect.value);
             if (this.thoughtSignature) formData.append('thought_signature', this.thoughtSignature);
             if (this.groundingToggle?.checked) formData.append('grounding', 'true');
+            formData.append('client_id', this.app.clientId);
+            // 提前生成首个提案，确认时直接接管该任务（localStorage speculate_proposals=false 可关闭）
+            if (localStorage.getItem('speculate_proposals') !== 'false') formData.append('speculate', 'true');
 
             // Append images by category
             this.selectedImages.forEach(img => formData.append('image', img.file));
@@ -843,6 +847,7 @@ class AIChatSidebar {
             const data = await response.json();
             this.removeMessage(typingId);
             this.thoughtSignature = data.thought_signature || null;
+            this.fingerprintId = data.fingerprint_id || null;
             this.processAIResponse(data.response);
             this.messages.push({ role: 'assistant', content: data.response });
             
@@ -1314,6 +1319,11 @@ class App {
         this.logs = [];
         this.currentController = null;  // 添加: 跟踪当前任务的AbortController
         this.currentTimerInterval = null;  // 添加: 跟踪当前计时器
+        // 每个标签页一个客户端 ID：后端按它隔离指纹预取与推测生成
+        this.clientId = sessionStorage.getItem('client_id')
+            || (crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(16).slice(2)}`);
+        sessionStorage.setItem('client_id', this.clientId);
+        this.prefetchTimer = null;
 
         this.loadHistory();
         this.initTabs();
@@ -1397,7 +1407,7 @@ class App {
         console.log('Rendering history with', this.history.length, 'items');
         container.innerHTML = this.history.map(item => `
             <div class="history-item" data-id="${item.id}">
-                <img src="${item.url}" alt="Generated Image" onerror="this.src='data:image/svg+xml,<svg xmlns=%22http://www.w3.org/2000/svg%22 width=%22100%22 height=%22100%22><rect width=%22100%22 height=%22100%22 fill=%22%23333%22/><text x=%2250%%22 y=%2250%%22 dominant-baseline=%22middle%22 text-anchor=%22middle%22 fill=%22%23666%22 font-size=%2212%22>加载失败</text></svg>'">
+                <img src="${item.thumbnail_url || item.url}" alt="Generated Image" loading="lazy" onerror="this.src='data:image/svg+xml,<svg xmlns=%22http://www.w3.org/2000/svg%22 width=%22100%22 height=%22100%22><rect width=%22100%22 height=%22100%22 fill=%22%23333%22/><text x=%2250%%22 y=%2250%%22 dominant-baseline=%22middle%22 text-anchor=%22middle%22 fill=%22%23666%22 font-size=%2212%22>加载失败</text></svg>'">
             </div>
         `).join('');
 
@@ -1649,11 +1659,38 @@ class App {
                 this.uploadedImages.push(e.target.result);
                 this.renderGallery();
                 this.selectImage(this.uploadedImages.length - 1);
+                this.schedulePrefetch();
             };
             reader.readAsDataURL(file);
         });
     }
 
+    // 上传后提前提取产品指纹；同一客户端随后的 /api/generate 直接认领结果
+    schedulePrefetch() {
+        clearTimeout(this.prefetchTimer);
+        this.prefetchTimer = setTimeout(async () => {
+            if (this.uploadedImages.length === 0) return;
+            try {
+                const activeProvider = this.apiManager.getActiveProvider();
+                const formData = new FormData();
+                formData.append('client_id', this.clientId);
+                if (activeProvider) {
+                    formData.append('api_key', activeProvider.key);
+                    formData.append('api_url', activeProvider.url);
+                }
+                // Same conversion as handleGeneration, so the image hashes match on claim
+                for (let i = 0; i < this.uploadedImages.length; i++) {
+                    const blob = await this.base64ToBlob(this.uploadedImages[i]);
+                    formData.append('image', blob, `image_${i}.png`);
+                }
+                await fetch('/api/fingerprint/prefetch', { method: 'POST', body: formData });
+            } catch (e) {
+                // Prefetch is only an optimization; generation extracts the fingerprint itself
+                console.warn('Fingerprint prefetch failed:', e);
+            }
+        }, 500);
+    }
+
     renderGallery() {
         const gallery = document.getElementById('upload-gallery');
         if (!gallery) return;
@@ -1784,6 +1821,10 @@ class App {
             formData.append('ratio', this.selectedRatio.value);
             formData.append('scenario', this.selectedScenario);
             if (modelSelect) formData.append('model', modelSelect.value);
+            // Claims this client's prefetched fingerprint or speculative task; the chat's Visual DNA
+            // is reused when it was derived from the same images
+            formData.append('client_id', this.clientId);
+            if (this.aiChat?.fingerprintId) formData.append('fingerprint_id', this.aiChat.fingerprintId);
             
             // Add new Gemini 3 options
             if (options.thinking_level) formData.append('thinking_level', options.thinking_level);
@@ -1815,6 +1856,7 @@ class App {
             }
 
             const submitData = await response.json();
+            this.currentTaskId = submitData.task_id;
             const result = await this.pollTaskStatus(submitData.task_id, controller.signal);
 
             // Update AIChatSidebar's thought signature with the one from the generated image
@@ -1850,11 +1892,22 @@ class App {
             // 隐藏取消按钮并清空controller
             const cancelBtn = document.getElementById('cancel-btn');
             if (cancelBtn) cancelBtn.classList.add('hidden');
+            // 超时中止时同时取消服务端任务
+            if (controller.signal.aborted) this.cancelServerTask();
             this.currentController = null;
             this.currentTimerInterval = null;
+            this.currentTaskId = null;
         }
     }
 
+    // 通知后端取消任务，中断其上游请求并释放资源
+    cancelServerTask(keepalive = false) {
+        const taskId = this.currentTaskId;
+        if (!taskId) return;
+        this.currentTaskId = null;
+        fetch(`/api/tasks/${taskId}`, { method: 'DELETE', keepalive }).catch(() => {});
+    }
+
     async pollTaskStatus(taskId, signal) {
         let retryCount = 0;
         const maxRetries = 3;
@@ -1872,6 +1925,8 @@ class App {
                         resolve(task.result);
                     } else if (task.status === 'failed') {
                         reject(new Error(task.error || '生成失败'));
+                    } else if (task.status === 'cancelled') {
+                        reject(new Error('任务已取消'));
                     } else {
                         // 显示实时进度消息
                         if (task.progress_message) {
@@ -1902,12 +1957,16 @@ class App {
         this.addLog('info', '系统已启动', '准备接收生成请求');
     }
     initCancelButton() {
+        // 离开页面时取消进行中的任务，避免后端继续为无人等待的结果工作
+        window.addEventListener('pagehide', () => this.cancelServerTask(true));
+
         const cancelBtn = document.getElementById('cancel-btn');
         if (!cancelBtn) return;
 
         cancelBtn.addEventListener('click', () => {
             if (this.currentController) {
                 // 取消当前任务
+                this.cancelServerTask();
                 this.currentController.abort();
 
                 // 清除计时器